@@ -0,0 +1,535 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from file_db import FileDb, FileDbEntry
+from file_finder import FileFinder
+from sync_client import SyncClient
+
+# Names repeat between directories, like they do in most real trees
+def make_synthetic_db(path, count, files_per_dir=100):
+    root = FileDbEntry()
+    root.set_directory()
+    root.id = 0
+    with open(path, 'wb') as file:
+        buf = bytearray()
+        parent = root
+        for i in range(1, count + 1):
+            ent = FileDbEntry(f"file{i % (files_per_dir + 1)}.dat", parent)
+            ent.id = i
+            if i % (files_per_dir + 1) == 1:
+                ent.name = f"dir{i}"
+                ent.set_directory()
+                ent.parent = root
+                parent = ent
+            else:
+                ent.size = i * 4096
+                ent.mtime = 1600000000000000000 + i
+                ent.sha256 = i.to_bytes(32, 'little')
+            buf += ent.encode()
+            if len(buf) > 1024 * 1024:
+                file.write(buf)
+                buf = bytearray()
+        file.write(buf)
+
+def _decode_records(path, use_buffer):
+    root = FileDbEntry()
+    root.set_directory()
+    root.id = 0
+    db = {0: root}
+    with open(path, 'rb') as file:
+        if use_buffer:
+            data = file.read()
+            pos = 0
+            while pos < len(data):
+                ent, pos = FileDbEntry.decode_buffer(data, pos, db)
+                db[ent.id] = ent
+                ent.parent.add_child(ent)
+        else:
+            while True:
+                ent = FileDbEntry.decode(file, db)
+                if ent is None:
+                    break
+                db[ent.id] = ent
+                ent.parent.add_child(ent)
+    return db
+
+def bench_filedb_load(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'db.bin')
+        make_synthetic_db(path, args.entries)
+        print(f"{args.entries} entries, {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+        times = {}
+        for name, use_buffer in (('stream', False), ('buffer', True)):
+            start = time.perf_counter()
+            db = _decode_records(path, use_buffer)
+            times[name] = time.perf_counter() - start
+            assert len(db) == args.entries + 1
+            del db
+        print(f"stream decoder: {times['stream']:.2f}s")
+        print(f"buffer decoder: {times['buffer']:.2f}s ({times['stream'] / times['buffer']:.2f}x)")
+
+        start = time.perf_counter()
+        db = FileDb(path, readonly=True)
+        load_time = time.perf_counter() - start
+        assert len(db.db) == args.entries + 1
+        print(f"FileDb.load: {load_time:.2f}s")
+
+
+def bench_filedb_memory(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'db.bin')
+        make_synthetic_db(path, args.entries)
+        tracemalloc.start()
+        db = FileDb(path, readonly=True)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert len(db.db) == args.entries + 1
+        print(f"{args.entries} entries: {used / 1024 / 1024:.1f} MiB, {used / args.entries:.0f} bytes per entry")
+
+# Updates the files of a db until it was compacted a few times, with the compaction done at once and in slices
+def bench_filedb_append(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'db.bin')
+        for title, compact_slice in (('whole merge', args.entries * 4), ('slices', FileDb.COMPACT_SLICE)):
+            if os.path.exists(path + ".snap"):
+                os.remove(path + ".snap")
+            make_synthetic_db(path, args.entries)
+            db = FileDb(path)
+            db.COMPACT_SLICE = compact_slice
+            files = [(ent.parent, ent.name) for ent in db.db.values() if not ent.is_directory()]
+            latencies = []
+            for i in range(args.updates):
+                parent, name = files[i % len(files)]
+                old = parent.get_child(name)
+                ent = FileDbEntry(old.name, old.parent)
+                ent.size = old.size
+                ent.mtime = old.mtime + 1
+                ent.sha256 = old.sha256
+                start = time.perf_counter()
+                db.append(ent)
+                latencies.append(time.perf_counter() - start)
+            db.close()
+            latencies.sort()
+            print(f"{title}: mean {sum(latencies) / len(latencies) * 1e6:.0f}us, "
+                  f"p99.9 {latencies[len(latencies) * 999 // 1000] * 1e6:.0f}us, max {latencies[-1] * 1000:.1f}ms, "
+                  f"{(os.path.getsize(path) + os.path.getsize(path + '.snap')) / 1024 / 1024:.1f} MiB after close")
+
+# Appends new files to a db with commits of several sizes, every commit is fsynced
+def bench_filedb_commit(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        path = os.path.join(tmpdir, 'db.bin')
+        for commit_records in (1, 16, 256, 4096):
+            db = FileDb(path)
+            db.COMMIT_RECORDS = commit_records
+            db.COMMIT_INTERVAL = 3600
+            db.rewrite()
+            start = time.perf_counter()
+            for i in range(args.records):
+                ent = FileDbEntry(f"file{i}.dat", db.root)
+                ent.size = i
+                ent.mtime = 1600000000000000000 + i
+                ent.sha256 = i.to_bytes(32, 'little')
+                db.append(ent)
+            db.close()
+            elapsed = time.perf_counter() - start
+            print(f"{commit_records} records per commit: {args.records / elapsed:.0f} records/s")
+            os.remove(path)
+            os.remove(path + ".snap")
+
+# Opens dbs of several sizes from their snapshot and looks up a file, against decoding the whole log
+def bench_filedb_open(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'db.bin')
+        count = args.entries
+        while count >= 1000:
+            for name in ('db.bin', 'db.bin.snap'):
+                if os.path.exists(os.path.join(tmpdir, name)):
+                    os.remove(os.path.join(tmpdir, name))
+            make_synthetic_db(path, count)
+            start = time.perf_counter()
+            db = FileDb(path, readonly=True)
+            log_time = time.perf_counter() - start
+            del db
+            # converted to a snapshot on the first writable open
+            FileDb(path).close()
+            start = time.perf_counter()
+            db = FileDb(path)
+            ent = db.get_path(f"dir{count // 2 // 101 * 101 + 1}/file50.dat")
+            open_time = time.perf_counter() - start
+            assert len(db.db) == count + 1 and ent.size is not None
+            db.close()
+            print(f"{count} entries: whole log {log_time * 1000:.1f}ms, snapshot and lookup {open_time * 1000:.2f}ms")
+            count //= 10
+
+def _start_server(tmpdir, features, server_args=()):
+    rootdir = os.path.join(tmpdir, 'root')
+    os.makedirs(rootdir, exist_ok=True)
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    proc = subprocess.Popen([sys.executable, server_path, rootdir, os.path.join(tmpdir, 'db.bin'), *server_args],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=256 * 1024)
+    client = SyncClient(proc)
+    if features is not None:
+        client.FEATURES = features
+    client.get_file_db()
+    return proc, client
+
+def bench_protocol(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        srcdir = os.path.join(tmpdir, 'src')
+        os.mkdir(srcdir)
+        for i in range(args.files):
+            with open(os.path.join(srcdir, f"file{i}"), 'wb') as fh:
+                fh.write(os.urandom(args.file_size))
+        for name, features, bundle in (('text', [], False), ('binary', None, False), ('bundle', None, True)):
+            server_dir = os.path.join(tmpdir, name)
+            proc, client = _start_server(server_dir, features)
+            start = time.perf_counter()
+            for i in range(args.files):
+                fd = os.open(os.path.join(srcdir, f"file{i}"), os.O_RDONLY)
+                if bundle:
+                    client.bundle_file(f"file{i}", fd)
+                else:
+                    client.upload_file(f"file{i}", fd)
+                os.close(fd)
+            sent = time.perf_counter() - start
+            client.close()
+            proc.wait()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {args.files / elapsed:.0f} files/s, client done after {sent:.2f}s of {elapsed:.2f}s")
+
+def bench_zero_copy(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src_path = os.path.join(tmpdir, 'src.bin')
+        with open(src_path, 'wb') as fh:
+            for i in range(args.size):
+                fh.write(os.urandom(1024 * 1024))
+        features = [f for f in SyncClient.FEATURES if f != 'upload_sha256']
+        for name, zero_copy in (('copy', False), ('zero-copy', True)):
+            server_dir = os.path.join(tmpdir, name)
+            proc, client = _start_server(server_dir, features, ['--zero-copy'] if zero_copy else [])
+            client.zero_copy = zero_copy
+            start_times = os.times()
+            start = time.perf_counter()
+            fd = os.open(src_path, os.O_RDONLY)
+            client.upload_file('file', fd)
+            os.close(fd)
+            client.close()
+            proc.wait()
+            elapsed = time.perf_counter() - start
+            times = os.times()
+            client_cpu = times.user + times.system - start_times.user - start_times.system
+            server_cpu = times.children_user + times.children_system - start_times.children_user - \
+                start_times.children_system
+            print(f"{name}: {args.size / elapsed:.0f} MiB/s, CPU time: client {client_cpu:.2f}s, "
+                  f"server {server_cpu:.2f}s (including hashing)")
+
+# The first pass warms the dentry cache, run it on a network filesystem or after dropping the caches to see the
+# metadata latency
+def bench_scan(args):
+    file_finder = FileFinder()
+    file_finder.add_from_text('/', ['+ ' + os.path.realpath(args.path)])
+    for threads in (0, args.threads):
+        counts = [0, 0]
+
+        def on_file(path, entry):
+            counts[0] += 1
+
+        def on_dir(path, entry):
+            counts[1] += 1
+
+        start = time.perf_counter()
+        file_finder.process('/', on_file, on_dir, scan_threads=threads)
+        elapsed = time.perf_counter() - start
+        print(f"{threads} threads: {counts[0]} files in {counts[1]} dirs, {elapsed:.2f}s "
+              f"({counts[1] / elapsed:.0f} dirs/s)")
+
+# A filter file in the style of a multi-user backup: global exclusions and per-user rules
+def _make_filter_lines(users):
+    lines = ['+ /home']
+    for ext in ('tmp', 'o', 'pyc', 'class', 'swp', 'part', 'iso', 'log', 'bak', 'lock'):
+        lines.append(f"- **.{ext}")
+    for name in ('node_modules', '.git', '__pycache__', '.cache', 'build', 'target', '.venv', 'dist'):
+        lines.append(f"- **/{name}")
+    for i in range(users):
+        lines += [f"- /home/u{i}/*.iso", f"- /home/u{i}/Downloads/**", f"+ /home/u{i}/Downloads/*.pdf",
+                  f"- /home/u{i}/**/*.mkv", f"+ /home/u{i}/**/keep.log"]
+    return lines
+
+def bench_rules(args):
+    file_finder = FileFinder()
+    lines = _make_filter_lines(args.users)
+    file_finder.add_from_text('/', lines)
+    names = ['src', 'docs', 'Downloads', 'build', 'a.c', 'b.pdf', 'c.log', 'keep.log', 'x.o', 'movie.mkv']
+    paths = []
+    for i in range(args.paths):
+        depth = 1 + i % 5
+        paths.append(f"home/u{i % args.users}/" + '/'.join(names[(i * 7 + j * 3) % len(names)] for j in range(depth)))
+
+    # the dirs with rules above the path, with the offset of the path relative to them, as in the walk
+    def stack_of(path):
+        ret = []
+        d = file_finder.root_dir
+        dpath = ''
+        for name in [None] + path.split('/')[:-1]:
+            if name is not None:
+                d = d.subdirs.get(name, None)
+                if d is None:
+                    break
+                dpath = os.path.join(dpath, name)
+            if d.wildcards:
+                ret.append((len(dpath) + 1, d))
+        return ret
+
+    # the rules of every dir, as the walk had them before they were compiled
+    def each_rule(path, stack):
+        include_id, exclude_id = -1, -1
+        for wlen, d in stack:
+            for w in d.wildcards:
+                if max(w.include, w.exclude) < max(include_id, exclude_id):
+                    continue
+                if w.regex.match(path[wlen:]):
+                    include_id = max(include_id, w.include)
+                    exclude_id = max(exclude_id, w.exclude)
+        return include_id > exclude_id
+
+    def compiled(path, stack):
+        include_id, exclude_id = FileFinder._process_wildcards(path, [(wlen, d.get_matcher()) for wlen, d in stack],
+                                                               -1, -1)
+        return include_id > exclude_id
+
+    stacks = [stack_of(path) for path in paths]
+    rule_count = max(sum(len(d.wildcards) for wlen, d in stack) for stack in stacks)
+    results = {}
+    for name, func in (('each rule', each_rule), ('compiled', compiled)):
+        start = time.perf_counter()
+        results[name] = [func(path, stack) for path, stack in zip(paths, stacks)]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(paths) / elapsed:.0f} paths/s")
+    assert results['each rule'] == results['compiled']
+    print(f"{len(lines)} filter lines, up to {rule_count} wildcards on the path of a file, "
+          f"{sum(results['compiled'])} of {len(paths)} paths included")
+
+# Wraps a DirEntry to count the stat calls which are not answered from its cache
+class _CountingDirEntry:
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.counts = counts
+        self.name = entry.name
+        self.path = entry.path
+        self.stat_cached = set()
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def inode(self):
+        return self.entry.inode()
+
+    def stat(self, follow_symlinks=True):
+        follow_symlinks = follow_symlinks and self.entry.is_symlink()
+        if follow_symlinks not in self.stat_cached:
+            self.stat_cached.add(follow_symlinks)
+            self.counts['stat' if follow_symlinks else 'lstat'] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+# Counts the metadata and open calls of a client run per file, by wrapping the os functions used for them
+def bench_syscalls(args):
+    import builtins
+    import collections
+    import contextlib
+    import runpy
+    counts = collections.Counter()
+    names = ('stat', 'lstat', 'fstat', 'open', 'listxattr', 'getxattr', 'readlink')
+    originals = {name: getattr(os, name) for name in names + ('scandir',)}
+    original_open = builtins.open
+
+    def counting(name, func):
+        def wrapper(*a, **kw):
+            counts[name] += 1
+            return func(*a, **kw)
+        return wrapper
+
+    class CountingScandir:
+        def __init__(self, path):
+            counts['scandir'] += 1
+            self.it = originals['scandir'](path)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.it.close()
+
+        def __iter__(self):
+            return (_CountingDirEntry(e, counts) for e in self.it)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src_dir = os.path.join(os.path.realpath(tmpdir), 'src')
+        for i in range(args.files):
+            path = os.path.join(src_dir, f"d{i // 100}", f"f{i}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with original_open(path, 'wb') as fh:
+                fh.write(os.urandom(args.file_size))
+        filters_path = os.path.join(tmpdir, 'filters.txt')
+        with original_open(filters_path, 'w') as fh:
+            fh.write(f"+ {src_dir}\n")
+        server = f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')}"
+        command = f"{server} {os.path.join(tmpdir, 'dest')} {os.path.join(tmpdir, 'db.bin')}"
+        os.mkdir(os.path.join(tmpdir, 'dest'))
+
+        def run(title):
+            counts.clear()
+            for name in names:
+                setattr(os, name, counting(name, originals[name]))
+            os.scandir = CountingScandir
+            builtins.open = counting('open', original_open)
+            sys.argv = ['client.py', '-f', filters_path, '-c', command, '--hash-threads', '1']
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py'))
+            finally:
+                for name, func in originals.items():
+                    setattr(os, name, func)
+                builtins.open = original_open
+            total = sum(counts.values())
+            print(f"{title}: {total / args.files:.2f} calls per file (" +
+                  ", ".join(f"{name} {counts[name] / args.files:.2f}" for name in sorted(counts)) + ")")
+
+        run('new files')
+        run('unchanged files')
+        for i in range(args.files):
+            path = os.path.join(src_dir, f"d{i // 100}", f"f{i}")
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        run('touched files')
+        # the new mtimes were recorded on the server by the previous run
+        run('touched files, next run')
+
+# Each connection is limited to the stream rate, like an ssh stream on a long link
+def bench_channels(args):
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src_dir = os.path.join(os.path.realpath(tmpdir), 'src')
+        for i in range(args.files):
+            path = os.path.join(src_dir, f"d{i // 10}", f"f{i}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fh:
+                # a few large files among the small ones
+                fh.write(os.urandom(args.large_size * 1024 * 1024 if i % 50 == 0 else args.file_size * 1024))
+        filters_path = os.path.join(tmpdir, 'filters.txt')
+        with open(filters_path, 'w') as fh:
+            fh.write(f"+ {src_dir}\n")
+        socket_path = os.path.join(tmpdir, 'server.sock')
+        daemon = subprocess.Popen([sys.executable, os.path.join(package_dir, 'server.py'), '--listen', socket_path])
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        try:
+            for channels in (1, args.channels):
+                dest_dir = os.path.join(tmpdir, f"dest{channels}")
+                os.mkdir(dest_dir)
+                command = f"{sys.executable} {os.path.abspath(__file__)} throttle {args.stream_rate} " \
+                          f"{sys.executable} {os.path.join(package_dir, 'server.py')} --connect {socket_path} " \
+                          f"--session $PSY_SESSION {dest_dir} {dest_dir}.db"
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.join(package_dir, 'client.py'), '-f', filters_path,
+                                '-c', command, '--channels', str(channels)], stdout=subprocess.DEVNULL, check=True)
+                elapsed = time.perf_counter() - start
+                print(f"{channels} channels: {elapsed:.2f}s")
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+# Runs a command with its input relayed at a limited rate
+def throttle(args):
+    proc = subprocess.Popen(args.command, stdin=subprocess.PIPE)
+    start = time.monotonic()
+    sent = 0
+    while True:
+        data = os.read(sys.stdin.fileno(), 64 * 1024)
+        if not data:
+            break
+        proc.stdin.write(data)
+        proc.stdin.flush()
+        sent += len(data)
+        delay = sent / (args.rate * 1024 * 1024) - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+    proc.stdin.close()
+    sys.exit(proc.wait())
+
+
+parser = argparse.ArgumentParser(description='Runs benchmarks')
+subparsers = parser.add_subparsers(required=True)
+
+filedb_load_parser = subparsers.add_parser('filedb-load', help='compares the FileDb decoders')
+filedb_load_parser.add_argument("-n", "--entries", help="number of entries in the db", type=int, default=2000000)
+filedb_load_parser.set_defaults(func=bench_filedb_load)
+
+filedb_memory_parser = subparsers.add_parser('filedb-memory', help='measures the memory used by a loaded FileDb')
+filedb_memory_parser.add_argument("-n", "--entries", help="number of entries in the db", type=int, default=1000000)
+filedb_memory_parser.set_defaults(func=bench_filedb_memory)
+
+filedb_append_parser = subparsers.add_parser('filedb-append', help='measures the append latency while the log is compacted')
+filedb_append_parser.add_argument("-n", "--entries", help="number of entries in the db", type=int, default=200000)
+filedb_append_parser.add_argument("-u", "--updates", help="number of appended updates", type=int, default=600000)
+filedb_append_parser.set_defaults(func=bench_filedb_append)
+
+filedb_commit_parser = subparsers.add_parser('filedb-commit', help='measures the append throughput with several commit sizes')
+filedb_commit_parser.add_argument("-n", "--records", help="number of appended records", type=int, default=20000)
+filedb_commit_parser.add_argument("-d", "--dir", help="directory on the file system to test, fsync does nothing on tmpfs")
+filedb_commit_parser.set_defaults(func=bench_filedb_commit)
+
+filedb_open_parser = subparsers.add_parser('filedb-open', help='measures the time taken to open a db and look up a file')
+filedb_open_parser.add_argument("-n", "--entries", help="number of entries in the largest db", type=int, default=1000000)
+filedb_open_parser.set_defaults(func=bench_filedb_open)
+
+protocol_parser = subparsers.add_parser('protocol', help='uploads small files using the text and binary protocols and in bundles')
+protocol_parser.add_argument("-n", "--files", help="number of files", type=int, default=5000)
+protocol_parser.add_argument("-s", "--file-size", help="size of the files", type=int, default=100)
+protocol_parser.set_defaults(func=bench_protocol)
+
+zero_copy_parser = subparsers.add_parser('zero-copy', help='uploads a large file through a local pipe with and without sendfile/splice')
+zero_copy_parser.add_argument("-s", "--size", help="size of the file (MiB)", type=int, default=512)
+zero_copy_parser.set_defaults(func=bench_zero_copy)
+
+scan_parser = subparsers.add_parser('scan', help='walks a tree with and without the scandir threads')
+scan_parser.add_argument("path", help="root of the tree")
+scan_parser.add_argument("-t", "--threads", help="number of scandir threads", type=int, default=16)
+scan_parser.set_defaults(func=bench_scan)
+
+rules_parser = subparsers.add_parser('rules', help='matches paths against a filter file rule by rule and with the compiled matchers')
+rules_parser.add_argument("-u", "--users", help="number of users with their own rules in the filter file", type=int, default=60)
+rules_parser.add_argument("-n", "--paths", help="number of paths", type=int, default=100000)
+rules_parser.set_defaults(func=bench_rules)
+
+syscalls_parser = subparsers.add_parser('syscalls', help='counts the stat, open and xattr calls of the client per file')
+syscalls_parser.add_argument("-n", "--files", help="number of files", type=int, default=2000)
+syscalls_parser.add_argument("-s", "--file-size", help="size of the files", type=int, default=1000)
+syscalls_parser.set_defaults(func=bench_syscalls)
+
+channels_parser = subparsers.add_parser('channels', help='uploads a tree through a daemon over one and several channels')
+channels_parser.add_argument("-n", "--files", help="number of files", type=int, default=500)
+channels_parser.add_argument("-s", "--file-size", help="size of the small files (KiB)", type=int, default=256)
+channels_parser.add_argument("-l", "--large-size", help="size of the large files, every 50th file (MiB)", type=int, default=16)
+channels_parser.add_argument("-c", "--channels", help="number of channels", type=int, default=4)
+channels_parser.add_argument("-r", "--stream-rate", help="maximal rate of a connection (MiB/s)", type=float, default=20)
+channels_parser.set_defaults(func=bench_channels)
+
+throttle_parser = subparsers.add_parser('throttle', help='runs a command with its input limited to a rate, used by the channels benchmark')
+throttle_parser.add_argument("rate", help="maximal rate (MiB/s)", type=float)
+throttle_parser.add_argument("command", help="command and its arguments", nargs=argparse.REMAINDER)
+throttle_parser.set_defaults(func=throttle)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
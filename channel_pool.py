@@ -0,0 +1,69 @@
+import os
+import queue
+import threading
+
+# Spreads uploads over the extra channels of a session, each driven by its own thread, so a large file doesn't
+# hold up the others and the transfer isn't limited to one stream. The commands whose order matters (mkdir,
+# symlink, delete, ...) stay on the main channel, an upload is only queued once the main channel got the acks of
+# the commands sent for its path and its parents.
+class ChannelPool:
+    def __init__(self, main, clients, max_pending=None):
+        self.main = main
+        self.clients = clients
+        self.tasks = queue.Queue(max_pending if max_pending is not None else len(clients) * 4)
+        # exceptions of the tasks, raised by sync()
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, args=(client,), daemon=True) for client in clients]
+        for thread in self.threads:
+            thread.start()
+
+    # Queues task, which is called with the SyncClient of a channel, to send the file at path
+    def submit(self, path, task):
+        if self._waits_for_main(path):
+            self.main.sync()
+        self.tasks.put(task)
+
+    def _waits_for_main(self, path):
+        paths = set()
+        while path and path not in paths:
+            paths.add(path)
+            path = os.path.dirname(path)
+        # bundles only hold files, nothing depends on them
+        return any(op != 'bundle' and p in paths for seq, op, p in self.main.unacknowledged())
+
+    def _run(self, client):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                task(client)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.tasks.task_done()
+
+    # Waits until the queued tasks are done and acknowledged by the server
+    def sync(self):
+        self.tasks.join()
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+        for client in self.clients:
+            client.sync()
+
+    # Returns (op, path, message) of the commands which failed on the channels since the last call
+    def take_failures(self):
+        ret = []
+        for client in self.clients:
+            ret += client.take_failures()
+        return ret
+
+    def close(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        for client in self.clients:
+            client.close()
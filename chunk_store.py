@@ -0,0 +1,447 @@
+import argparse
+import bisect
+import hashlib
+import os
+import sys
+import threading
+from file_db import FileDb
+from util import *
+
+# Files are cut into content-defined chunks with a gear hash, so an insertion only changes the chunks around
+# it. The chunks are stored once in append-only pack files, chunks.idx maps their sha256 to the location.
+# The chunk list of a file (recipe) is stored under recipes/ and keyed by the sha256 of the whole file, which
+# is the one recorded in the FileDb entry.
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# the top bits of the hash depend on the last 32 bytes, 16 of them give 64 KiB chunks on average
+CHUNK_MASK = 0xffff0000
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)]
+# translation tables to the bytes of the GEAR values
+GEAR_BYTES = [bytes(g >> shift & 0xff for g in GEAR) for shift in (0, 8, 16, 24)]
+# the low 32 bits of each 64 bit lane, for the hashes of a whole chunk
+GEAR_LANE_MASK = int.from_bytes(b'\xff\xff\xff\xff\0\0\0\0' * MAX_CHUNK_SIZE, 'little')
+
+PACK_SIZE = 64 * 1024 * 1024
+
+
+# Returns the end of the first chunk cut in buf[start:end], if any. The hash after the byte at i is the sum of the
+# GEAR values of the previous 32 bytes from MIN_CHUNK_SIZE on, each shifted left by its distance to i. It is
+# computed for all the positions at once, with an integer holding one 64 bit lane per position.
+def _gear_cut(buf, start, end):
+    first = max(MIN_CHUNK_SIZE, start - 31)
+    data = bytes(buf[first:end])
+    count = len(data)
+    lanes = bytearray(8 * count)
+    for i, table in enumerate(GEAR_BYTES):
+        lanes[i::8] = data.translate(table)
+    h = int.from_bytes(lanes, 'little')
+    # doubles the number of bytes summed in each step, from 1 to 32. The lanes stay below 2**51 until the last
+    # step, only the low 32 bits of the hash matter and they don't depend on the higher ones.
+    for shift in (1, 2, 4, 8, 16):
+        if shift == 16:
+            h &= GEAR_LANE_MASK
+        h += h << (65 * shift)
+    # the shifts moved the sums of the last positions into up to 31 lanes past count
+    h = h.to_bytes(8 * (count + 31), 'little')
+    # the cut is where bytes 2 and 3 of the hash, the bits of CHUNK_MASK, are zero
+    top = int.from_bytes(h[2:8 * count:8], 'little') | int.from_bytes(h[3:8 * count:8], 'little')
+    i = top.to_bytes(count, 'little').find(0, start - first)
+    return first + i + 1 if i >= 0 else None
+
+
+class ChunkWriter:
+    def __init__(self, store):
+        self.store = store
+        self.buf = bytearray()
+        self.scan_pos = 0
+        # (chunk sha256, size)
+        self.recipe = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self.buf += data
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            self._add_chunk(cut)
+
+    def _find_cut(self):
+        end = min(len(self.buf), MAX_CHUNK_SIZE)
+        start = max(self.scan_pos, MIN_CHUNK_SIZE)
+        if start < end:
+            cut = _gear_cut(self.buf, start, end)
+            if cut is not None:
+                return cut
+        if end == MAX_CHUNK_SIZE:
+            return end
+        self.scan_pos = max(start, end)
+        return None
+
+    def _add_chunk(self, size):
+        chunk = bytes(self.buf[:size])
+        del self.buf[:size]
+        self.scan_pos = 0
+        self.recipe.append((self.store.put_chunk(chunk), size))
+
+    def close(self):
+        if len(self.buf) > 0:
+            self._add_chunk(len(self.buf))
+
+    # Records the file once its sha256 is known
+    def commit(self, sha256):
+        self.store.write_recipe(sha256, self.recipe)
+
+
+class ChunkReader:
+    def __init__(self, store, recipe):
+        self.store = store
+        self.recipe = recipe
+        self.offsets = []
+        self.size = 0
+        for digest, size in recipe:
+            self.offsets.append(self.size)
+            self.size += size
+        self.pos = 0
+        self.chunk_index = None
+        self.chunk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.pos) - 1
+        if index != self.chunk_index:
+            self.chunk = self.store.read_chunk(self.recipe[index][0])
+            self.chunk_index = index
+        start = self.pos - self.offsets[index]
+        n = min(len(b), len(self.chunk) - start)
+        b[:n] = self.chunk[start:start + n]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        ret = bytearray()
+        b = bytearray(min(size, MAX_CHUNK_SIZE))
+        while len(ret) < size:
+            n = self.readinto(memoryview(b)[:size - len(ret)])
+            if not n:
+                break
+            ret += b[:n]
+        return bytes(ret)
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'packs'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'recipes'), exist_ok=True)
+        # chunk sha256 -> (pack, offset, size)
+        self.chunks = {}
+        self.pack_handles = {}
+        self.append_pack = None
+        self.append_handle = None
+        self.index_handle = None
+        # recipes written since the last sync(), they keep their temporary name until the chunks are on the disk
+        self.pending_recipes = set()
+        # dirs which got new files since the last sync()
+        self.unsynced_dirs = set()
+        # the channels of a session write from several threads
+        self.lock = threading.RLock()
+        self.load()
+
+    def _index_path(self):
+        return os.path.join(self.path, 'chunks.idx')
+
+    def _pack_path(self, pack):
+        return os.path.join(self.path, 'packs', f"{pack:08d}.pack")
+
+    def _recipe_path(self, sha256):
+        name = sha256.hex()
+        return os.path.join(self.path, 'recipes', name[:2], name)
+
+    @staticmethod
+    def _encode_location(digest, location):
+        buf = bytearray(digest)
+        for v in location:
+            encode_varint(buf, v)
+        return buf
+
+    def load(self):
+        self.chunks = {}
+        if not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path(), 'rb') as file:
+            data = file.read()
+        pos = 0
+        try:
+            while pos < len(data):
+                digest = data[pos:pos + 32]
+                pos += 32
+                pack, pos = decode_varint_buffer(data, pos)
+                offset, pos = decode_varint_buffer(data, pos)
+                size, pos = decode_varint_buffer(data, pos)
+                self.chunks[digest] = (pack, offset, size)
+        except EOFError:
+            # the chunks of a torn record were not referenced by any recipe yet
+            print('Chunk index is truncated', file=sys.stderr)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            for handle in self.pack_handles.values():
+                handle.close()
+            self.pack_handles = {}
+            for handle in (self.append_handle, self.index_handle):
+                if handle is not None:
+                    handle.close()
+            self.append_handle = None
+            self.index_handle = None
+
+    def flush(self):
+        with self.lock:
+            # the pack data goes first, so the index never points past it
+            if self.append_handle is not None:
+                self.append_handle.flush()
+            if self.index_handle is not None:
+                self.index_handle.flush()
+
+    # Makes the chunks and recipes written so far durable. Called before the db records referring to them are
+    # committed, the recipes become visible under their final name once the chunks they list are on the disk.
+    def sync(self):
+        with self.lock:
+            self.flush()
+            for handle in (self.append_handle, self.index_handle):
+                if handle is not None:
+                    os.fsync(handle.fileno())
+            for sha256 in self.pending_recipes:
+                path = self._recipe_path(sha256)
+                fd = os.open(path + '.tmp', os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.rename(path + '.tmp', path)
+                self.unsynced_dirs.add(os.path.dirname(path))
+            self.pending_recipes = set()
+            for path in self.unsynced_dirs:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self.unsynced_dirs = set()
+
+    def _packs(self):
+        return sorted(int(name.split('.')[0]) for name in os.listdir(os.path.join(self.path, 'packs'))
+                      if name.endswith('.pack'))
+
+    def _open_append_pack(self):
+        if self.append_handle is not None and self.append_handle.tell() < PACK_SIZE:
+            return
+        if self.append_handle is not None:
+            self.append_handle.close()
+            self.append_pack += 1
+        else:
+            packs = self._packs()
+            self.append_pack = packs[-1] if packs else 0
+        self.append_handle = open(self._pack_path(self.append_pack), 'ab')
+        self.unsynced_dirs.add(os.path.dirname(self._pack_path(self.append_pack)))
+        if self.append_handle.tell() >= PACK_SIZE:
+            return self._open_append_pack()
+
+    def _write_chunk(self, digest, chunk):
+        self._open_append_pack()
+        location = (self.append_pack, self.append_handle.tell(), len(chunk))
+        self.append_handle.write(chunk)
+        self.chunks[digest] = location
+        return location
+
+    def put_chunk(self, chunk):
+        digest = hashlib.sha256(chunk).digest()
+        with self.lock:
+            if digest in self.chunks:
+                return digest
+            location = self._write_chunk(digest, chunk)
+            if self.index_handle is None:
+                self.index_handle = open(self._index_path(), 'ab')
+                self.unsynced_dirs.add(self.path)
+            self.index_handle.write(self._encode_location(digest, location))
+        return digest
+
+    def read_chunk(self, digest):
+        with self.lock:
+            pack, offset, size = self.chunks[digest]
+            if pack == self.append_pack and self.append_handle is not None:
+                self.append_handle.flush()
+            handle = self.pack_handles.get(pack, None)
+            if handle is None:
+                handle = self.pack_handles[pack] = open(self._pack_path(pack), 'rb')
+        return os.pread(handle.fileno(), size, offset)
+
+    def writer(self):
+        return ChunkWriter(self)
+
+    def write_recipe(self, sha256, recipe):
+        path = self._recipe_path(sha256)
+        buf = bytearray()
+        for digest, size in recipe:
+            buf += digest
+            encode_varint(buf, size)
+        with self.lock:
+            if sha256 in self.pending_recipes or os.path.exists(path):
+                return
+            if not os.path.isdir(os.path.dirname(path)):
+                os.mkdir(os.path.dirname(path))
+                self.unsynced_dirs.add(os.path.dirname(os.path.dirname(path)))
+            with open(path + '.tmp', 'wb') as file:
+                file.write(buf)
+            self.pending_recipes.add(sha256)
+
+    def read_recipe(self, sha256):
+        path = self._recipe_path(sha256)
+        try:
+            with self.lock:
+                file = open(path + '.tmp' if sha256 in self.pending_recipes else path, 'rb')
+            with file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        ret = []
+        pos = 0
+        while pos < len(data):
+            digest = data[pos:pos + 32]
+            size, pos = decode_varint_buffer(data, pos + 32)
+            ret.append((digest, size))
+        return ret
+
+    def has_file(self, sha256):
+        with self.lock:
+            return sha256 in self.pending_recipes or os.path.exists(self._recipe_path(sha256))
+
+    # Returns a reader of the file, None when it isn't stored
+    def open(self, sha256):
+        recipe = self.read_recipe(sha256)
+        if recipe is None:
+            return None
+        return ChunkReader(self, recipe)
+
+    def _recipes(self):
+        recipes_dir = os.path.join(self.path, 'recipes')
+        for prefix in os.listdir(recipes_dir):
+            for name in os.listdir(os.path.join(recipes_dir, prefix)):
+                if not name.endswith('.tmp'):
+                    yield bytes.fromhex(name)
+
+    # Removes the recipes of the files which are not in live_sha256 and rewrites the packs containing
+    # unreferenced chunks. Must not run while the store is written by a server, the command line takes the
+    # lock of the db for it. Returns the freed bytes.
+    def gc(self, live_sha256):
+        self.close()
+        live_chunks = set()
+        dead_recipes = []
+        for sha256 in self._recipes():
+            if sha256 in live_sha256:
+                live_chunks.update(digest for digest, size in self.read_recipe(sha256))
+            else:
+                dead_recipes.append(sha256)
+        dead_size = {}
+        for digest, (pack, offset, size) in self.chunks.items():
+            if digest not in live_chunks:
+                dead_size[pack] = dead_size.get(pack, 0) + size
+        old_packs = set(dead_size)
+        freed = sum(dead_size.values())
+
+        # the live chunks of the old packs are moved to new ones, then the index is replaced
+        self.append_pack = max(self._packs(), default=-1) + 1
+        self.append_handle = open(self._pack_path(self.append_pack), 'ab')
+        chunks = {}
+        for digest, location in sorted(self.chunks.items(), key=lambda item: item[1]):
+            if digest not in live_chunks:
+                continue
+            if location[0] in old_packs:
+                chunk = self.read_chunk(digest)
+                location = self._write_chunk(digest, chunk)
+            chunks[digest] = location
+        self.append_handle.flush()
+        os.fsync(self.append_handle.fileno())
+        self.chunks = chunks
+        with open(self._index_path() + '.tmp', 'wb') as file:
+            for digest, location in chunks.items():
+                file.write(self._encode_location(digest, location))
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(self._index_path() + '.tmp', self._index_path())
+        self.close()
+
+        for pack in old_packs:
+            os.remove(self._pack_path(pack))
+        for sha256 in dead_recipes:
+            os.remove(self._recipe_path(sha256))
+        return freed
+
+    # Returns (size of the files, size of the stored chunks, number of chunks) for the given file digests
+    def stats(self, sha256_list):
+        logical_size = 0
+        for sha256 in sha256_list:
+            recipe = self.read_recipe(sha256)
+            if recipe is not None:
+                logical_size += sum(size for digest, size in recipe)
+        stored_size = sum(size for pack, offset, size in self.chunks.values())
+        return logical_size, stored_size, len(self.chunks)
+
+
+def _db_sha256_list(db_path):
+    filedb = FileDb(db_path, readonly=True)
+    ret = [ent.sha256 for ent in filedb.db.values() if ent.sha256 is not None and not ent.is_directory()]
+    filedb.close()
+    return ret
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintains a chunk store of a server')
+    parser.add_argument("store", help="chunk store directory")
+    parser.add_argument("db", help="file db of the server")
+    parser.add_argument("command", choices=['gc', 'report'])
+    args = parser.parse_args()
+
+    db_lock = None
+    if args.command == 'gc':
+        # the server holds the lock while it writes the store, an upload may refer to chunks gc would delete
+        try:
+            db_lock = lock_file(args.db + ".lock")
+        except BlockingIOError:
+            print(f"{args.db} is used by a server", file=sys.stderr)
+            sys.exit(1)
+    store = ChunkStore(args.store)
+    sha256_list = _db_sha256_list(args.db)
+    if args.command == 'gc':
+        freed = store.gc(set(sha256_list))
+        print(f"Freed {freed / 1024 / 1024:.1f} MiB")
+    else:
+        logical_size, stored_size, count = store.stats(sha256_list)
+        ratio = logical_size / stored_size if stored_size > 0 else 1.0
+        print(f"Files: {logical_size / 1024 / 1024:.1f} MiB, stored: {stored_size / 1024 / 1024:.1f} MiB in "
+              f"{count} chunks, dedup ratio {ratio:.2f}")
+    store.close()
+    if db_lock is not None:
+        db_lock.close()
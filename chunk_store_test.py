@@ -0,0 +1,104 @@
+import unittest
+import hashlib
+import random
+import tempfile
+
+import chunk_store
+from chunk_store import ChunkStore
+from file_db import FileDb, FileDbEntry
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = ChunkStore(self.tmpdir.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmpdir.cleanup()
+
+    def put(self, data):
+        sha256 = hashlib.sha256(data).digest()
+        with self.store.writer() as writer:
+            for i in range(0, len(data), 100000):
+                writer.write(data[i:i + 100000])
+        writer.commit(sha256)
+        return sha256
+
+    def test_dedup(self):
+        data = random.Random(1).randbytes(1000000)
+        changed = data[:500000] + b'inserted' + data[500000:]
+        sha256 = self.put(data)
+        changed_sha256 = self.put(changed)
+        self.assertEqual(self.put(data), sha256)
+        logical_size, stored_size, count = self.store.stats([sha256, changed_sha256])
+        self.assertEqual(logical_size, len(data) + len(changed))
+        self.assertLess(stored_size, len(data) + 300000)
+
+        self.store.close()
+        self.store = ChunkStore(self.tmpdir.name)
+        self.assertEqual(self.store.open(changed_sha256).read(), changed)
+        reader = self.store.open(sha256)
+        reader.seek(600000)
+        self.assertEqual(reader.read(100), data[600000:600100])
+        self.assertIsNone(self.store.open(hashlib.sha256(b'other').digest()))
+
+    def test_cut_points(self):
+        def chunk_sizes(data):
+            ret = []
+            while data:
+                h = 0
+                cut = min(len(data), chunk_store.MAX_CHUNK_SIZE)
+                for i in range(chunk_store.MIN_CHUNK_SIZE, cut):
+                    h = ((h << 1) + chunk_store.GEAR[data[i]]) & 0xffffffff
+                    if not h & chunk_store.CHUNK_MASK:
+                        cut = i + 1
+                        break
+                ret.append(cut)
+                data = data[cut:]
+            return ret
+
+        rnd = random.Random(4)
+        data = rnd.randbytes(1500000) + bytes(600000) + rnd.randbytes(100000)
+        with self.store.writer() as writer:
+            pos = 0
+            while pos < len(data):
+                size = rnd.choice([1, 100, 5000, 70000])
+                writer.write(data[pos:pos + size])
+                pos += size
+        self.assertEqual([size for digest, size in writer.recipe], chunk_sizes(data))
+
+    def test_gc(self):
+        rnd = random.Random(2)
+        data = rnd.randbytes(500000)
+        other = rnd.randbytes(500000)
+        sha256 = self.put(data)
+        other_sha256 = self.put(other)
+        self.assertGreater(self.store.gc({sha256}), 400000)
+        self.assertFalse(self.store.has_file(other_sha256))
+        self.assertEqual(self.store.open(sha256).read(), data)
+
+        self.store = ChunkStore(self.tmpdir.name)
+        self.assertEqual(self.store.open(sha256).read(), data)
+        self.assertLess(self.store.stats([sha256])[1], 600000)
+
+    def test_sync(self):
+        data = random.Random(3).randbytes(300000)
+        sha256 = self.put(data)
+        self.assertEqual(self.store.open(sha256).read(), data)
+        # the recipe is only found after a crash once the store is synced
+        self.assertFalse(ChunkStore(self.tmpdir.name).has_file(sha256))
+
+        # the db syncs the store before it commits a record referring to the file
+        filedb = FileDb(self.tmpdir.name + '/db.bin')
+        filedb.before_commit = self.store.sync
+        ent = FileDbEntry('file', filedb.root)
+        ent.size = len(data)
+        ent.sha256 = sha256
+        filedb.append(ent)
+        filedb.close()
+        self.assertEqual(ChunkStore(self.tmpdir.name).open(sha256).read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
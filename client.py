@@ -2,137 +2,404 @@ import argparse
 import subprocess
 import sys
 import os
+import signal
+import threading
+import time
 from sync_client import SyncClient
+from channel_pool import ChannelPool
+from file_db import FileDbEntry
 from file_finder import FileFinder
-import util
+import diff_engine
+from hash_pool import HashPool
+from hash_cache import HashCache
+import compression
+import inotify
 
 parser = argparse.ArgumentParser(description='Creates a backup')
 parser.add_argument("-f", "--file-list", help="specifies the file list", required=True)
 parser.add_argument("-c", "--command", help="specifies the command to run", required=True)
 parser.add_argument("-m", "--size-and-time", help="assume files with same size and mtime are equal", action='store_true')
 parser.add_argument("--dry-run", help="don't copy files", action='store_true')
+parser.add_argument("--scan-threads", help="number of threads listing directories ahead of the walk (0 to list them one at a time)", type=int, default=0)
+parser.add_argument("--hash-threads", help="number of threads used for SHA256 calculation", type=int, default=os.cpu_count() or 1)
+parser.add_argument("--hash-memory", help="memory limit for the SHA256 read buffers (MiB)", type=int, default=64)
+parser.add_argument("--delta-min-size", help="minimal size of a modified file to send it as a delta (MiB, -1 to disable)", type=int, default=1)
+parser.add_argument("--hash-cache", help="file used to cache the SHA256 of local files between runs")
+parser.add_argument("--hash-cache-size", help="maximal number of entries in the hash cache", type=int, default=1000000)
+parser.add_argument("--bundle-size", help="maximal size of the data sent in one bundle of small files (KiB)", type=int, default=1024)
+parser.add_argument("--bundle-file-size", help="maximal size of a file sent in a bundle (KiB, 0 to disable bundles)", type=int, default=64)
+parser.add_argument("--have-min-size", help="minimal size of a new file to look for its content on the server before uploading it (KiB, -1 to disable)", type=int, default=64)
+parser.add_argument("--zero-copy", help="send file data with sendfile, the server doesn't verify the uploads against a client digest then", action='store_true')
+parser.add_argument("--compression", help="codec used to compress the transferred data when the server supports it", choices=sorted(compression.CODECS))
+parser.add_argument("--db-cache", help="file used to keep a copy of the server db, so only the changes are transferred")
+parser.add_argument("--watch", help="keep running and send the changes reported by inotify", action='store_true')
+parser.add_argument("--watch-delay", help="time without events after which the collected changes are sent (seconds)", type=float, default=2)
+parser.add_argument("--rescan-interval", help="time between the full walks in watch mode (seconds)", type=float, default=3600)
+parser.add_argument("--channels", help="number of connections to the server, the files which aren't bundled are uploaded over the ones after the first. Each one runs the command with $PSY_SESSION set to the id to pass to server.py --connect --session, the extra ones also with $PSY_CHANNEL set for --channel", type=int, default=1)
 args = parser.parse_args()
 
 root_dir = "/"
 
-proc = subprocess.Popen(args.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+# the connections of one run share the session id
+command_env = dict(os.environ, PSY_SESSION=os.urandom(8).hex())
+
+def start_command(channel=False):
+    env = dict(command_env, PSY_CHANNEL='1') if channel else command_env
+    return subprocess.Popen(args.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=sys.stderr, bufsize=256 * 1024, env=env)
+
+proc = start_command()
 client = SyncClient(proc)
-server_files = client.get_file_db()
+client.bundle_size = args.bundle_size * 1024
+if args.compression:
+    client.codecs = [args.compression]
+if args.zero_copy:
+    client.zero_copy = True
+    client.FEATURES = [f for f in client.FEATURES if f != 'upload_sha256']
+server_files = client.get_file_db(args.db_cache)
+
+# The channels which can't be opened are left out, a standalone server.py only takes one
+def open_channels(count):
+    clients = []
+    for i in range(count):
+        channel = SyncClient(start_command(channel=True))
+        try:
+            channel.join(client)
+        except (EOFError, ValueError, OSError) as e:
+            print(f"Cannot open channel {i + 1}: {e}", file=sys.stderr)
+            channel.outpipe.close()
+            channel.proc.wait()
+            break
+        clients.append(channel)
+    return ChannelPool(client, clients) if clients else None
+
+channels = None
+if args.channels > 1 and not args.dry_run:
+    if 'join' in client.features:
+        channels = open_channels(args.channels - 1)
+    else:
+        print("The server doesn't support channels, using one", file=sys.stderr)
 file_finder = FileFinder()
+hash_pool = HashPool(args.hash_threads, args.hash_memory * 1024 * 1024)
+hash_cache = None
+if args.hash_cache:
+    hash_cache = HashCache(args.hash_cache, args.hash_cache_size)
 with open(args.file_list, "r") as filters_file:
     file_finder.add_from_text(root_dir, filters_file)
 
-created_dirs = {}
-local_dirs = {}
-local_files = {}
 total_uploaded_size = 0
+# the deltas are sent from the threads of the channels
+total_uploaded_lock = threading.Lock()
+# with 'have', the deletes wait for the end of the walk, so moved files can still be found on the server
+deferred_deletes = []
 
-def create_parent_dirs(path):
-    path_dir = os.path.dirname(path)
-    dirs_to_create = []
-    while not path_dir in created_dirs and path_dir:
-        dirs_to_create.append(path_dir)
-        path_dir = os.path.dirname(path_dir)
-    for dirp in reversed(dirs_to_create):
-        print(f"Creating parent dir {dirp}")
-        if not args.dry_run:
-            try:
-                fh = os.open(os.path.join(root_dir, dirp), os.O_RDONLY)
-            except PermissionError:
-                print("Error opening parent directory", file=sys.stderr)
-                return False
-            client.mkdir(dirp, fh)
-            os.close(fh)
-    return True
+# The callbacks are called in the order of the calls
+def hash_local_file(full_path, stat_info, callback):
+    def on_hashed(local_sha256):
+        hash_cache.put(stat_info, local_sha256)
+        callback(local_sha256)
 
-def process_local_file(path):
-    global total_uploaded_size
-    local_files[path] = True
-    full_path = os.path.join(root_dir, path)
-    is_symlink = os.path.islink(full_path)
-    symlink_to = None
-    if is_symlink:
-        symlink_to = os.readlink(full_path)
-        if symlink_to[0] == '/': # absolute path
-            symlink_to = '/' + os.path.relpath(symlink_to, root_dir)
-    server_file = server_files.find_path(path)
-    if server_file is not None:
-        if server_file.is_symlink() and is_symlink and symlink_to == server_file.symlink:
-            return
-        if not server_file.is_directory() and not server_file.is_symlink() and not is_symlink:
-            stat_info = os.stat(full_path)
-            if stat_info.st_size == server_file.size and stat_info.st_mtime_ns == server_file.mtime:
-                # print(f"Skipping {path} - already uploaded (time)")
-                return
+    cached_sha256 = hash_cache.get(stat_info) if hash_cache is not None else None
+    if cached_sha256 is not None:
+        hash_pool.submit(None, lambda _: callback(cached_sha256))
+    elif hash_cache is not None:
+        hash_pool.submit(full_path, on_hashed)
+    else:
+        hash_pool.submit(full_path, callback)
 
-            try:
-                with open(full_path, 'rb') as fh:
-                    local_sha256 = util.sha256_file(fh)
-            except PermissionError:
-                print("Error opening file for SHA256 calculation", file=sys.stderr)
-                return
-
-            if local_sha256 == server_file.sha256:
-                # print(f"Skipping {path} - already uploaded (sha256)")
-                return
-    if not create_parent_dirs(path):
+def on_change(change):
+    path = change.path
+    full_path = os.path.join(root_dir, path)
+    if change.kind == diff_engine.CHANGE_DELETE:
+        if 'have' in client.features:
+            deferred_deletes.append(path)
+        else:
+            delete_file(path)
         return
-    if is_symlink:
-        print(f"Symlinking {full_path} -> {symlink_to}")
-        if not args.dry_run:
-            client.symlink(path, symlink_to, full_path)
+    if change.kind == diff_engine.CHANGE_METADATA:
+        if 'setmeta' in client.features:
+            # the server records the new mtime, so the file isn't hashed again on the next run
+            update_metadata(path, full_path, change.server_file.sha256, change.stat)
+        return
+    if change.server_file is not None and change.server_file.is_directory() != change.is_dir:
+        # the old entry was deleted just before, its deletes must reach the server first
+        delete_deferred(path)
+    if change.is_dir:
+        create_dir(path, full_path)
+        return
+    server_file = change.server_file if change.kind == diff_engine.CHANGE_UPDATE else None
+    if change.kind == diff_engine.CHANGE_CREATE and not change.is_symlink and 'have' in client.features and \
+            not args.dry_run and 0 <= args.have_min_size * 1024 <= change.stat.st_size:
+        # the content may be on the server under another path
+        hash_local_file(full_path, change.stat,
+                        lambda local_sha256: offer_local_file(path, full_path, local_sha256, change.stat))
         return
-    print(f"Uploading {full_path}")
-    if not is_symlink:
-        total_uploaded_size += os.stat(full_path).st_size
+    # keep the uploads in the order in which the files were found
+    hash_pool.submit(None, lambda _: upload_local_file(path, full_path, change.is_symlink, change.symlink_to,
+                                                       server_file, change.stat))
+
+def create_dir(path, full_path):
+    print(f"Creating dir {full_path}")
     if not args.dry_run:
         try:
             fh = os.open(full_path, os.O_RDONLY)
         except PermissionError:
-            print("Error opening file", file=sys.stderr)
+            print("Error opening directory", file=sys.stderr)
             return
-        client.upload_file(path, fh)
+        client.mkdir(path, fh)
         os.close(fh)
+        record_server_file(path, None, is_dir=True)
+
+def delete_file(path):
+    print(f"Deleting {path}")
+    if not args.dry_run:
+        client.delete(path)
+        forget_server_file(path)
+
+# In watch mode, server_files follows the changes sent to the server, as it is compared with the local tree
+# again. They are applied once the walk or batch is done, the walk must not find the new entries.
+server_changes = []
+
+def record_server_file(path, stat_info, is_dir=False, symlink_to=None, sha256=None):
+    if args.watch:
+        server_changes.append((path, True, stat_info, is_dir, symlink_to, sha256))
+
+def forget_server_file(path):
+    if args.watch:
+        server_changes.append((path, False, None, False, None, None))
+
+# The failed paths are forgotten, so they are sent again when they change or on the next full walk
+def apply_server_changes(failed_paths):
+    for path, exists, stat_info, is_dir, symlink_to, sha256 in server_changes:
+        if exists and path not in failed_paths:
+            _set_server_file(path, stat_info, is_dir, symlink_to, sha256)
+        else:
+            ent = server_files.find_path(path)
+            if ent is not None and ent.parent is not None:
+                _forget_server_entry(ent)
+    server_changes.clear()
+
+def _set_server_file(path, stat_info, is_dir, symlink_to, sha256):
+    parent = server_files.find_path(os.path.dirname(path))
+    if parent is None or not parent.is_directory():
+        return
+    ent = parent.get_child(os.path.basename(path))
+    if is_dir and ent is not None and ent.is_directory():
+        return
+    if ent is not None and ent.children:
+        _forget_server_entry(ent)
+    ent = FileDbEntry(os.path.basename(path), parent)
+    if is_dir:
+        ent.set_directory()
+    elif symlink_to is not None:
+        ent.symlink = symlink_to
+    else:
+        ent.size = stat_info.st_size
+        ent.sha256 = sha256
+    if stat_info is not None:
+        ent.mtime = stat_info.st_mtime_ns
+    server_files.apply(ent)
+
+def _forget_server_entry(ent):
+    if ent.children is not None:
+        for child in list(ent.children.values()):
+            _forget_server_entry(child)
+    ent.set_removed()
+    server_files.apply(ent)
+
+# Without a path, runs all the deferred deletes. Otherwise only the ones of the tree at path, which were
+# deferred last.
+def delete_deferred(path=None):
+    if path is None:
+        for deferred_path in deferred_deletes:
+            delete_file(deferred_path)
+        deferred_deletes.clear()
+        return
+    tree = []
+    while deferred_deletes and (deferred_deletes[-1] == path or deferred_deletes[-1].startswith(path + '/')):
+        tree.append(deferred_deletes.pop())
+    for deferred_path in reversed(tree):
+        delete_file(deferred_path)
 
-def process_local_dir(path):
-    if path == '':
+def upload_local_file(path, full_path, is_symlink, symlink_to, server_file, stat_info=None):
+    global total_uploaded_size
+    if is_symlink:
+        print(f"Symlinking {full_path} -> {symlink_to}")
+        if not args.dry_run:
+            client.symlink(path, symlink_to, full_path, stat_info)
+            record_server_file(path, stat_info, symlink_to=symlink_to)
         return
-    local_dirs[path] = True
-    server_file = server_files.find_path(path)
-    if server_file is not None:
-        if server_file.is_directory():
-            # print(f"Skipping {path} - dir already created")
+    if stat_info is None:
+        try:
+            stat_info = os.stat(full_path)
+        except FileNotFoundError:
+            print("Error opening file", file=sys.stderr)
             return
-    if not create_parent_dirs(path):
+    file_size = stat_info.st_size
+    use_delta = server_file is not None and 'delta' in client.features and \
+        0 <= args.delta_min_size * 1024 * 1024 <= file_size
+    if use_delta:
+        print(f"Uploading {full_path} (delta)")
+    else:
+        print(f"Uploading {full_path}")
+        with total_uploaded_lock:
+            total_uploaded_size += file_size
+    if args.dry_run:
         return
-    full_path = os.path.join(root_dir, path)
-    print(f"Creating dir {full_path}")
+    bundled = not use_delta and 'bundle' in client.features and 0 < args.bundle_file_size * 1024 >= file_size
+    if channels is not None and not bundled:
+        channels.submit(path, lambda channel: send_file(channel, path, full_path, use_delta, False, stat_info))
+    else:
+        # the bundles stay on the main channel, in order with the other small commands
+        send_file(client, path, full_path, use_delta, bundled, stat_info)
+
+# Called on the thread of the channel of sync_client
+def send_file(sync_client, path, full_path, use_delta, bundled, stat_info):
+    global total_uploaded_size
+    try:
+        fh = os.open(full_path, os.O_RDONLY)
+    except PermissionError:
+        print("Error opening file", file=sys.stderr)
+        return
+    if use_delta:
+        size = sync_client.upload_file_delta(path, fh, stat_info)
+        with total_uploaded_lock:
+            total_uploaded_size += size
+    elif bundled:
+        sync_client.bundle_file(path, fh, stat_info)
+    else:
+        sync_client.upload_file(path, fh, stat_info)
+    os.close(fh)
+    record_server_file(path, stat_info)
+
+def update_metadata(path, full_path, sha256, stat_info):
+    print(f"Updating metadata of {full_path}")
     if not args.dry_run:
         try:
-            fh = os.open(full_path, os.O_RDONLY)
-        except PermissionError:
-            print("Error opening directory", file=sys.stderr)
+            client.setmeta(path, full_path, sha256, stat_info)
+        except OSError:
+            print("Error reading file attributes", file=sys.stderr)
             return
-        client.mkdir(path, fh)
-        os.close(fh)
-    created_dirs[path] = True
+        record_server_file(path, stat_info, sha256=sha256)
+
+def offer_local_file(path, full_path, local_sha256, stat_info):
+    print(f"Offering {full_path}")
+    try:
+        fh = os.open(full_path, os.O_RDONLY)
+    except PermissionError:
+        print("Error opening file", file=sys.stderr)
+        return
+    client.have(path, fh, local_sha256, stat_info)
+    os.close(fh)
+    record_server_file(path, stat_info, sha256=local_sha256)
+    upload_missing()
 
-file_finder.process(root_dir, process_local_file, process_local_dir)
+def upload_missing():
+    for path in client.take_missing():
+        upload_local_file(path, os.path.join(root_dir, path), False, None, None)
 
-def delete_files(el, current_path = ""):
-    if el.children is not None:
-        for chld in el.children.values():
-            delete_files(chld, os.path.join(current_path, chld.name))
-    if current_path not in local_files and current_path not in local_dirs and current_path != '':
-        print(f"Deleting {current_path}")
-        if not args.dry_run:
-            client.delete(current_path)
+# operations which failed on the server are retried once, the ones failing again are skipped
+def retry_failed(failures):
+    for op, path, message in failures:
+        print(f"Retrying {op} {path} - {message}", file=sys.stderr)
+        full_path = os.path.join(root_dir, path)
+        if op == 'delete':
+            client.delete(path)
+        elif op == 'mkdir':
+            try:
+                fh = os.open(full_path, os.O_RDONLY)
+            except OSError:
+                print("Error opening directory", file=sys.stderr)
+                continue
+            client.mkdir(path, fh)
+            os.close(fh)
+        elif os.path.lexists(full_path):
+            is_symlink = os.path.islink(full_path)
+            symlink_to = diff_engine.get_symlink_to(root_dir, full_path) if is_symlink else None
+            upload_local_file(path, full_path, is_symlink, symlink_to, None)
+
+def sync_channels():
+    client.sync()
+    if channels is not None:
+        channels.sync()
+
+def take_failures():
+    failures = client.take_failures()
+    if channels is not None:
+        failures += channels.take_failures()
+    return failures
+
+# Waits for the changes found so far to reach the server
+def finish_changes():
+    hash_pool.drain()
+    sync_channels()
+    upload_missing()
+    delete_deferred()
+    sync_channels()
+    retry_failed(take_failures())
+    sync_channels()
+    failed_paths = set()
+    for op, path, message in take_failures():
+        print(f"Skipping {path} - {op} failed: {message}", file=sys.stderr)
+        failed_paths.add(path)
+    apply_server_changes(failed_paths)
+
+# Collects the changes until no event came for watch_delay, then sends them. Dirs named by the rules, overflowed
+# event queues and the rescan interval lead to a full walk.
+def watch(engine, watcher):
+    last_walk = time.monotonic()
+    print("Watching for changes")
+    while True:
+        changed = set()
+        timeout = max(0, last_walk + args.rescan_interval - time.monotonic())
+        if watcher.read_changes(changed, timeout):
+            batch_start = time.monotonic()
+            while time.monotonic() - batch_start < 10 * args.watch_delay and \
+                    watcher.read_changes(changed, args.watch_delay):
+                pass
+        full_walk = watcher.overflowed or time.monotonic() - last_walk >= args.rescan_interval
+        if not full_walk:
+            full_walk = not engine.process_paths(file_finder, changed)
+            hash_pool.drain()
+        if full_walk:
+            print("Walking the whole tree")
+            watcher.overflowed = False
+            engine.process(file_finder, args.scan_threads)
+            last_walk = time.monotonic()
+        finish_changes()
 
-delete_files(server_files.root)
+watcher = inotify.DirWatcher(root_dir) if args.watch else None
+engine = diff_engine.DiffEngine(root_dir, server_files, on_change, hash_local_file,
+                                watcher.add if watcher is not None else None)
+engine.process(file_finder, args.scan_threads)
+finish_changes()
+if watcher is not None:
+    # stops like on Ctrl-C, after sending what was collected
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        watch(engine, watcher)
+    except KeyboardInterrupt:
+        finish_changes()
+    watcher.close()
+hash_pool.close()
+if hash_cache is not None:
+    hash_cache.close()
 
+server_files.close()
 print("Done")
 
-proc.stdin.close()
+client.close()
 proc.wait()
+stats = client.compression_stats
+if channels is not None:
+    channels.close()
+    for channel in channels.clients:
+        channel.proc.wait()
+        stats.raw_size += channel.compression_stats.raw_size
+        stats.compressed_size += channel.compression_stats.compressed_size
+        stats.cpu_time += channel.compression_stats.cpu_time
 
-print(f"Uploaded {int(total_uploaded_size/1024/1024)}MB")
\ No newline at end of file
+print(f"Uploaded {int(total_uploaded_size/1024/1024)}MB")
+if stats.raw_size > 0:
+    print(f"Compressed {int(stats.raw_size/1024/1024)}MB to {int(stats.compressed_size/1024/1024)}MB "
+          f"(ratio {stats.ratio():.2f}, {stats.cpu_time:.1f}s CPU)")
\ No newline at end of file
@@ -0,0 +1,57 @@
+import lzma
+import os
+import time
+import zlib
+
+# name -> (compressor factory, decompressor factory), the objects follow the zlib compressobj/decompressobj
+# interface: compress(data)/flush() and decompress(data)
+CODECS = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+    'lzma': (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor),
+}
+
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 3
+# files whose samples don't shrink below this ratio are sent uncompressed
+MIN_RATIO = 0.9
+
+def register_codec(name, compressor, decompressor):
+    CODECS[name] = (compressor, decompressor)
+
+def compressor(name):
+    return CODECS[name][0]()
+
+def decompressor(name):
+    return CODECS[name][1]()
+
+# Compresses a few samples spread over the file with fast zlib, already compressed data (media, archives)
+# doesn't shrink
+def is_compressible(fd, size):
+    if size == 0:
+        return False
+    raw_size = 0
+    compressed_size = 0
+    for i in range(SAMPLE_COUNT):
+        offset = max(0, (size - SAMPLE_SIZE) * i // max(1, SAMPLE_COUNT - 1))
+        sample = os.pread(fd, SAMPLE_SIZE, offset)
+        raw_size += len(sample)
+        compressed_size += len(zlib.compress(sample, 1))
+        if offset + SAMPLE_SIZE >= size:
+            break
+    return compressed_size < raw_size * MIN_RATIO
+
+class CompressionStats:
+    def __init__(self):
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.cpu_time = 0.0
+
+    def add(self, raw_size, compressed_size, start_cpu_time):
+        self.raw_size += raw_size
+        self.compressed_size += compressed_size
+        self.cpu_time += time.thread_time() - start_cpu_time
+
+    def ratio(self):
+        if self.raw_size == 0:
+            return 1.0
+        return self.compressed_size / self.raw_size
@@ -0,0 +1,246 @@
+import array
+import collections
+import functools
+import hashlib
+import itertools
+import math
+import struct
+import sys
+import zlib
+from util import *
+
+ADLER_MOD = 65521
+
+DELTA_END = 0
+DELTA_COPY = 1
+DELTA_LITERAL = 2
+
+SIGNATURE_RECORD = struct.Struct('<I16s')
+
+MAX_LITERAL_SIZE = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+# the most block positions whose weak checksums are computed at once
+MAX_SCAN_SIZE = 256 * 1024
+# scanned data after which the delta is given up when it is mostly literal
+LITERAL_CHECK_SIZE = 2 * 1024 * 1024
+
+
+def choose_block_size(file_size):
+    block_size = 1 << max(0, math.isqrt(file_size).bit_length() - 1)
+    return max(2048, min(block_size, 128 * 1024))
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def write_signature(file, block_size, out):
+    b = bytearray(block_size)
+    mv = memoryview(b)
+    count = 0
+    while True:
+        n = file.readinto(mv)
+        if not n:
+            break
+        # short reads are only expected at the end of the file
+        while n < block_size:
+            m = file.readinto(mv[n:])
+            if not m:
+                break
+            n += m
+        out.write(SIGNATURE_RECORD.pack(zlib.adler32(mv[:n]), strong_checksum(mv[:n])))
+        count += 1
+    return count
+
+def read_signature(stream, count):
+    data = read_exactly(stream, SIGNATURE_RECORD.size * count)
+    ret = {}
+    for idx, (weak, strong) in enumerate(SIGNATURE_RECORD.iter_unpack(data)):
+        ret.setdefault(weak, {}).setdefault(strong, idx)
+    return ret
+
+
+class DeltaWriter:
+    def __init__(self, out):
+        self.out = out
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_size = 0
+
+    def _flush_copy(self):
+        if self.copy_start is None:
+            return
+        buf = bytearray()
+        buf.append(DELTA_COPY)
+        encode_varint(buf, self.copy_start)
+        encode_varint(buf, self.copy_count)
+        self.out.write(buf)
+        self.copy_start = None
+
+    def copy(self, index):
+        if self.copy_start is not None and self.copy_start + self.copy_count == index:
+            self.copy_count += 1
+            return
+        self._flush_copy()
+        self.copy_start = index
+        self.copy_count = 1
+
+    def literal(self, data):
+        if len(data) == 0:
+            return
+        self._flush_copy()
+        buf = bytearray()
+        buf.append(DELTA_LITERAL)
+        encode_varint(buf, len(data))
+        self.out.write(buf)
+        self.out.write(data)
+        self.literal_size += len(data)
+
+    def end(self):
+        self._flush_copy()
+        self.out.write(bytes([DELTA_END]))
+
+
+def _write_literals(writer, data):
+    for i in range(0, len(data), MAX_LITERAL_SIZE):
+        writer.literal(data[i:i + MAX_LITERAL_SIZE])
+
+# Integer with value in each of the 64 bit lanes of a scan, the shorter scans use the low lanes
+@functools.lru_cache(maxsize=None)
+def _full_lanes(value):
+    return int.from_bytes(value.to_bytes(8, sys.byteorder) * MAX_SCAN_SIZE, sys.byteorder)
+
+def _lanes(value, count):
+    if count == MAX_SCAN_SIZE:
+        return _full_lanes(value)
+    return _full_lanes(value) >> (64 * (MAX_SCAN_SIZE - count))
+
+# Reduces the lanes of x, each below bound, modulo ADLER_MOD, using 2**16 = 15 (mod ADLER_MOD)
+def _mod_lanes(x, count, bound):
+    while bound >= 2 * ADLER_MOD:
+        x = (x & _lanes(0xFFFF, count)) + 15 * ((x >> 16) & _lanes((1 << 48) - 1, count))
+        bound = 0xFFFF + 15 * (bound >> 16)
+    # x + 15 reaches 2**16 exactly when x >= ADLER_MOD
+    ones = _lanes(1, count)
+    return x - ADLER_MOD * (((x + 15 * ones) >> 16) & ones)
+
+# Returns the positions start .. start + count - 1 of buf where the weak checksum of the block is in the signature.
+# The checksums of all the positions are computed at once from the prefix sums of the data, with an integer
+# holding one 64 bit lane per position, so there is no Python level step per byte.
+def _weak_matches(buf, start, count, block_size, signature):
+    sums = list(itertools.accumulate(buf[start:start + count + block_size - 1], initial=0))
+    sums_of_sums = array.array('Q', itertools.accumulate(sums, initial=0))
+    sums = array.array('Q', sums)
+    def lanes(a):
+        return int.from_bytes(a, sys.byteorder)
+    low = lanes(sums[:count])
+    weak_a = lanes(sums[block_size:block_size + count]) - low + _lanes(1, count)
+    # the block is weighted block_size .. 1: sums[i + 1] - sums[i] + ... + sums[i + block_size] - sums[i]
+    weak_b = lanes(sums_of_sums[block_size + 1:block_size + 1 + count]) - lanes(sums_of_sums[1:count + 1]) - \
+        block_size * low + block_size * _lanes(1, count)
+    weak = (_mod_lanes(weak_b, count, block_size + 255 * block_size * (block_size + 1) // 2) << 16) | \
+        _mod_lanes(weak_a, count, 1 + 255 * block_size)
+    weak = memoryview(weak.to_bytes(8 * count, sys.byteorder)).cast('Q')
+    return itertools.compress(itertools.count(start), map(signature.__contains__, weak))
+
+# Writes the delta of file against the signature to the DeltaWriter, returns the sha256 of the file.
+# Once more than half of the data scanned is literal, the rest of the file is sent as literals without scanning it.
+def write_delta(file, block_size, signature, writer):
+    h = hashlib.sha256()
+    buf = b''
+    offset = 0 # offset of buf in the file
+    pos = 0 # start of the next block to match
+    lit = 0 # start of the pending literal data
+    eof = False
+    # the blocks starting before scan_end were checked, those in candidates have a matching weak checksum
+    scan_end = 0
+    candidates = collections.deque()
+    scan_size = block_size
+    while signature:
+        if pos >= scan_end:
+            if len(buf) - pos < block_size + scan_size and not eof:
+                scanned = offset + pos
+                if scanned >= LITERAL_CHECK_SIZE and 2 * (writer.literal_size + pos - lit) > scanned:
+                    break
+                data = file.read(READ_SIZE)
+                if not data:
+                    eof = True
+                h.update(data)
+                buf = buf[lit:] + data
+                offset += lit
+                pos -= lit
+                lit = 0
+                scan_end = pos
+                candidates.clear()
+                continue
+            if len(buf) - pos < block_size:
+                break
+            # the block following a match usually matches too, it is tried before scanning
+            block = buf[pos:pos + block_size]
+            index = signature.get(zlib.adler32(block), {}).get(strong_checksum(block), None)
+            if index is None:
+                count = min(scan_size, len(buf) - block_size - pos)
+                candidates.extend(_weak_matches(buf, pos + 1, count, block_size, signature))
+                scan_end = pos + 1 + count
+                scan_size = min(2 * scan_size, MAX_SCAN_SIZE)
+                pos += 1
+                continue
+        else:
+            while candidates and candidates[0] < pos:
+                candidates.popleft()
+            if not candidates:
+                pos = scan_end
+                while pos - lit >= MAX_LITERAL_SIZE:
+                    writer.literal(buf[lit:lit + MAX_LITERAL_SIZE])
+                    lit += MAX_LITERAL_SIZE
+                continue
+            pos = candidates.popleft()
+            block = buf[pos:pos + block_size]
+            index = signature[zlib.adler32(block)].get(strong_checksum(block), None)
+            if index is None:
+                pos += 1
+                continue
+        _write_literals(writer, buf[lit:pos])
+        writer.copy(index)
+        pos += block_size
+        lit = pos
+        scan_size = block_size
+    if eof and 0 < len(buf) - pos < block_size:
+        # the last block of the base file is usually shorter
+        tail = buf[pos:]
+        index = signature.get(zlib.adler32(tail), {}).get(strong_checksum(tail), None)
+        if index is not None:
+            writer.literal(buf[lit:pos])
+            writer.copy(index)
+            lit = len(buf)
+    _write_literals(writer, buf[lit:])
+    # with an empty signature or too many literals, the rest is sent as it is read
+    while not eof:
+        data = file.read(READ_SIZE)
+        if not data:
+            break
+        h.update(data)
+        _write_literals(writer, data)
+    writer.end()
+    return h.digest()
+
+# A missing base doesn't stop reading the delta, so that the stream stays usable for the next commands
+def apply_delta(stream, base, block_size, out):
+    missing_base = False
+    while True:
+        op = decode_varint_stream(stream)
+        if op == DELTA_END:
+            if missing_base:
+                raise ValueError('Delta references a missing base file')
+            return
+        if op == DELTA_COPY:
+            index = decode_varint_stream(stream)
+            count = decode_varint_stream(stream)
+            if base is None:
+                missing_base = True
+                continue
+            base.seek(index * block_size)
+            copy_file_limited(base, out, count * block_size)
+        elif op == DELTA_LITERAL:
+            size = decode_varint_stream(stream)
+            copy_file_limited(stream, out, size)
+        else:
+            raise ValueError('Invalid delta op: ' + str(op))
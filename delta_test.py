@@ -0,0 +1,67 @@
+import unittest
+import io
+import os
+import hashlib
+import zlib
+
+import delta
+
+class DeltaTest(unittest.TestCase):
+
+    def roundtrip(self, base, new, block_size=2048):
+        sig_data = io.BytesIO()
+        count = delta.write_signature(io.BytesIO(base), block_size, sig_data)
+        sig_data.seek(0)
+        signature = delta.read_signature(sig_data, count)
+        out = io.BytesIO()
+        writer = delta.DeltaWriter(out)
+        sha256 = delta.write_delta(io.BytesIO(new), block_size, signature, writer)
+        self.assertEqual(sha256, hashlib.sha256(new).digest())
+        out.seek(0)
+        result = io.BytesIO()
+        delta.apply_delta(out, io.BytesIO(base), block_size, result)
+        self.assertEqual(result.getvalue(), new)
+        return writer.literal_size
+
+    def test_unchanged(self):
+        base = os.urandom(100000)
+        self.assertEqual(self.roundtrip(base, base), 0)
+
+    def test_modified(self):
+        base = os.urandom(100000)
+        self.assertEqual(self.roundtrip(base, base[:50000] + b'x' * 10 + base[50010:]), 2048)
+        self.assertLess(self.roundtrip(base, base[:1000] + b'inserted' + base[1000:]), 4096)
+        self.assertLess(self.roundtrip(base, base[7000:]), 2048)
+        self.assertLess(self.roundtrip(base, base + b'appended'), 2048)
+
+    def test_no_base(self):
+        new = os.urandom(10000)
+        self.assertEqual(self.roundtrip(b'', new), len(new))
+        self.assertEqual(self.roundtrip(b'', b''), 0)
+        self.assertEqual(self.roundtrip(new, b'abc'), 3)
+
+    def test_large(self):
+        # larger than the reads of write_delta
+        new = os.urandom(delta.READ_SIZE * 2 + 1000000)
+        self.assertEqual(self.roundtrip(b'', new), len(new))
+        base = new[:delta.READ_SIZE] + b'x' * 100 + new[delta.READ_SIZE + 100:]
+        self.assertLess(self.roundtrip(base, new + b'appended', 65536), 2 * 65536)
+
+    def test_literal_fallback(self):
+        # the start of the file has nothing in common with the base, the rest isn't looked at
+        base = os.urandom(delta.READ_SIZE * 2)
+        new = os.urandom(delta.READ_SIZE) + base
+        self.assertEqual(self.roundtrip(base, new, 65536), len(new))
+        self.assertLess(self.roundtrip(base, base[:delta.READ_SIZE] + new[:1000] + base[delta.READ_SIZE:], 65536),
+                        1000 + 65536)
+
+    def test_weak_matches(self):
+        for block_size in (2048, 131072):
+            for data in (os.urandom(block_size + 3000), b'\xff' * (block_size + 3000)):
+                weak = [zlib.adler32(data[i:i + block_size]) for i in range(3001)]
+                signature = {weak[i]: {} for i in (1, 1234, 3000)}
+                self.assertEqual(list(delta._weak_matches(data, 1, 3000, block_size, signature)),
+                                 [i for i in range(1, 3001) if weak[i] in signature])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import stat
+
+CHANGE_CREATE = 'create'
+CHANGE_UPDATE = 'update' # the content differs
+CHANGE_METADATA = 'metadata' # only the mtime differs, the content is the same
+CHANGE_DELETE = 'delete'
+
+class Change:
+    __slots__ = ('kind', 'path', 'server_file', 'is_dir', 'is_symlink', 'symlink_to', 'stat')
+
+    def __init__(self, kind, path, server_file, is_dir=False, is_symlink=False, symlink_to=None, stat=None):
+        self.kind = kind
+        self.path = path
+        # the entry of the path in the server db, None when there isn't one
+        self.server_file = server_file
+        self.is_dir = is_dir
+        self.is_symlink = is_symlink
+        self.symlink_to = symlink_to
+        self.stat = stat
+
+def get_symlink_to(root_dir, full_path):
+    symlink_to = os.readlink(full_path)
+    if symlink_to[0] == '/': # absolute path
+        symlink_to = '/' + os.path.relpath(symlink_to, root_dir)
+    return symlink_to
+
+# Compares the local tree walked by a FileFinder with the server db, without keeping the local paths. The
+# server entries found locally are marked as visited, the rest of the entries of a dir is deleted as soon as
+# the walk of the dir is done. An entry replaced by one of another type (a dir by a file or the other way around)
+# is deleted right before the change creating the new one.
+# Files with the same size but a different mtime are hashed with hash_file(full_path, stat, callback), which
+# calls back with the sha256, to tell content changes from metadata-only ones. The changes are passed to
+# change_cb in the order of the walk, except for those waiting for the hash.
+class DiffEngine:
+    def __init__(self, root_dir, server_files, change_cb, hash_file, dir_cb=None):
+        self.root_dir = root_dir
+        self.server_files = server_files
+        self.change_cb = change_cb
+        self.hash_file = hash_file
+        # called with the path of every walked dir
+        self.dir_cb = dir_cb
+        # server entries of the local dirs being walked
+        self.dirs = {'': server_files.root}
+
+    def process(self, file_finder, scan_threads=0):
+        file_finder.process(self.root_dir, self._on_file, self._on_dir, self._on_dir_done, scan_threads=scan_threads)
+        # the parents of the included paths are not scanned
+        for path in sorted(self.dirs, key=len, reverse=True):
+            self._delete_unvisited(self.dirs[path], path)
+        self.dirs = {'': self.server_files.root}
+
+    # Diffs only the given paths, the subtrees of the dirs among them are walked. The paths excluded by the
+    # rules are only deleted when they are gone locally. Returns False without going further when a dir named
+    # by the rules is among them, a full walk is needed then.
+    def process_paths(self, file_finder, paths):
+        # the dirs walked or deleted with their subtrees
+        done = set()
+        for path in sorted(paths):
+            if path == '' or any(parent in done for parent in self._parents(path)):
+                continue
+            full_path = os.path.join(self.root_dir, path)
+            try:
+                stat_info = os.lstat(full_path)
+            except FileNotFoundError:
+                stat_info = None
+            is_dir = stat_info is not None and stat.S_ISDIR(stat_info.st_mode)
+            parent = self.server_files.find_path(os.path.dirname(path))
+            if parent is not None and not parent.is_directory():
+                parent = None
+            server_file = parent.get_child(os.path.basename(path)) if parent is not None else None
+            if stat_info is None:
+                if server_file is not None:
+                    self._delete_tree(server_file, path)
+                    done.add(path)
+                continue
+            if not file_finder.is_included(path, is_dir):
+                continue
+            if is_dir and file_finder.is_rule_dir(path):
+                return False
+            self.dirs = {os.path.dirname(path): parent} if parent is not None else {}
+            if is_dir:
+                file_finder.process_dir(self.root_dir, path, self._on_file, self._on_dir, self._on_dir_done)
+                done.add(path)
+            else:
+                self._on_file(path)
+            if server_file is not None:
+                server_file.set_visited(False)
+        self.dirs = {'': self.server_files.root}
+        return True
+
+    @staticmethod
+    def _parents(path):
+        while True:
+            path = os.path.dirname(path)
+            if not path:
+                return
+            yield path
+
+    def _find_server_file(self, path):
+        parent = self.dirs.get(os.path.dirname(path), None)
+        if parent is None:
+            return None
+        ent = parent.get_child(os.path.basename(path))
+        if ent is not None:
+            ent.set_visited()
+        return ent
+
+    def _on_dir(self, path, entry=None):
+        if self.dir_cb is not None:
+            self.dir_cb(path)
+        if path == '':
+            return
+        server_file = self._find_server_file(path)
+        if server_file is not None and server_file.is_directory():
+            self.dirs[path] = server_file
+            return
+        if server_file is not None:
+            self._delete_tree(server_file, path)
+        self.change_cb(Change(CHANGE_CREATE, path, server_file, is_dir=True))
+
+    def _on_dir_done(self, path):
+        server_dir = self.dirs.pop(path, None)
+        if server_dir is not None:
+            self._delete_unvisited(server_dir, path)
+
+    # entry is the os.DirEntry of the file, its cached type and stat save the syscalls
+    def _on_file(self, path, entry=None):
+        server_file = self._find_server_file(path)
+        if server_file is not None and server_file.is_directory():
+            self._delete_tree(server_file, path)
+        full_path = os.path.join(self.root_dir, path)
+        if entry is not None:
+            is_symlink = entry.is_symlink()
+        else:
+            is_symlink = os.path.islink(full_path)
+        if is_symlink:
+            symlink_to = get_symlink_to(self.root_dir, full_path)
+            if server_file is not None and server_file.is_symlink() and symlink_to == server_file.symlink:
+                return
+            stat_info = entry.stat(follow_symlinks=False) if entry is not None else os.lstat(full_path)
+            self.change_cb(Change(CHANGE_CREATE, path, server_file, is_symlink=True, symlink_to=symlink_to,
+                                  stat=stat_info))
+            return
+        stat_info = entry.stat() if entry is not None else os.stat(full_path)
+        if server_file is None or server_file.is_directory() or server_file.is_symlink():
+            self.change_cb(Change(CHANGE_CREATE, path, server_file, stat=stat_info))
+            return
+        if stat_info.st_size != server_file.size:
+            self.change_cb(Change(CHANGE_UPDATE, path, server_file, stat=stat_info))
+            return
+        if stat_info.st_mtime_ns == server_file.mtime:
+            return
+
+        def compare_sha256(local_sha256):
+            kind = CHANGE_METADATA if local_sha256 == server_file.sha256 else CHANGE_UPDATE
+            self.change_cb(Change(kind, path, server_file, stat=stat_info))
+
+        self.hash_file(full_path, stat_info, compare_sha256)
+
+    def _delete_unvisited(self, server_dir, path):
+        if server_dir.children is None:
+            return
+        for child in list(server_dir.children.values()):
+            if child.is_visited():
+                child.set_visited(False)
+                continue
+            self._delete_tree(child, os.path.join(path, child.name))
+
+    def _delete_tree(self, server_file, path):
+        if server_file.children is not None:
+            for child in list(server_file.children.values()):
+                self._delete_tree(child, os.path.join(path, child.name))
+        self.change_cb(Change(CHANGE_DELETE, path, server_file))
@@ -0,0 +1,123 @@
+import unittest
+import hashlib
+import os
+import tempfile
+
+import diff_engine
+from file_db import FileDb, FileDbEntry
+from file_finder import FileFinder
+
+class DiffEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmpdir.name)
+        self.db = FileDb(os.path.join(self.root, 'db.bin'))
+        self.prefix = self.root.lstrip('/')
+        parent = self.db.root
+        for name in self.prefix.split('/') + ['src']:
+            ent = FileDbEntry(name, parent)
+            ent.set_directory()
+            self.db.append(ent)
+            parent = ent
+        os.mkdir(os.path.join(self.root, 'src'))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.root, 'src', name), 'wb') as fh:
+            fh.write(data)
+        return os.stat(os.path.join(self.root, 'src', name))
+
+    def add_server_file(self, name, data, mtime, is_dir=False):
+        parent = self.db.get_path(os.path.dirname(os.path.join(self.prefix, 'src', name)))
+        ent = FileDbEntry(os.path.basename(name), parent)
+        if is_dir:
+            ent.set_directory()
+        else:
+            ent.size = len(data)
+            ent.mtime = mtime
+            ent.sha256 = hashlib.sha256(data).digest()
+        self.db.append(ent)
+
+    def diff(self, paths=None):
+        file_finder = FileFinder()
+        file_finder.add_from_text('/', ['+ ' + os.path.join(self.root, 'src'), '- **.log'])
+        changes = []
+
+        def hash_file(full_path, stat_info, callback):
+            with open(full_path, 'rb') as fh:
+                callback(hashlib.sha256(fh.read()).digest())
+
+        def on_change(change):
+            changes.append((change.kind, os.path.relpath(change.path, os.path.join(self.prefix, 'src'))))
+
+        engine = diff_engine.DiffEngine('/', self.db, on_change, hash_file)
+        if paths is None:
+            engine.process(file_finder)
+        else:
+            self.assertTrue(engine.process_paths(file_finder, [os.path.join(self.prefix, 'src', p) for p in paths]))
+        return changes
+
+    def test_changes(self):
+        same = self.write('same', b'same')
+        self.add_server_file('same', b'same', same.st_mtime_ns)
+        self.write('touched', b'touched')
+        self.add_server_file('touched', b'touched', 1)
+        self.write('modified', b'new')
+        self.add_server_file('modified', b'old', 1)
+        self.write('resized', b'longer data')
+        self.add_server_file('resized', b'data', 1)
+        self.write('created', b'created')
+        os.symlink('same', os.path.join(self.root, 'src', 'link'))
+        self.add_server_file('removed_dir', None, None, is_dir=True)
+        self.add_server_file('removed_dir/file', b'removed', 1)
+        self.add_server_file('removed', b'removed', 1)
+
+        changes = self.diff()
+        self.assertEqual(sorted(changes), sorted([
+            ('metadata', 'touched'), ('update', 'modified'), ('update', 'resized'), ('create', 'created'),
+            ('create', 'link'), ('delete', 'removed_dir/file'), ('delete', 'removed_dir'), ('delete', 'removed')]))
+        # the contents of a dir are deleted before the dir
+        self.assertLess(changes.index(('delete', 'removed_dir/file')), changes.index(('delete', 'removed_dir')))
+        self.assertFalse(any(ent.is_visited() for ent in self.db.db.values()))
+
+        # the visited marks are cleared, a second walk finds the same changes
+        self.assertEqual(len(self.diff()), len(changes))
+
+    def test_type_change(self):
+        self.add_server_file('was_dir', None, None, is_dir=True)
+        self.add_server_file('was_dir/file', b'file', 1)
+        self.write('was_dir', b'file')
+        self.add_server_file('was_file', b'file', 1)
+        os.mkdir(os.path.join(self.root, 'src', 'was_file'))
+
+        changes = self.diff()
+        self.assertEqual(changes.index(('delete', 'was_dir')) + 1, changes.index(('create', 'was_dir')))
+        self.assertEqual(changes.index(('delete', 'was_file')) + 1, changes.index(('create', 'was_file')))
+        self.assertIn(('delete', 'was_dir/file'), changes)
+
+    def test_paths(self):
+        same = self.write('same', b'same')
+        self.add_server_file('same', b'same', same.st_mtime_ns)
+        self.add_server_file('removed_dir', None, None, is_dir=True)
+        self.add_server_file('removed_dir/file', b'removed', 1)
+        self.add_server_file('dir', None, None, is_dir=True)
+        self.add_server_file('dir/removed', b'removed', 1)
+        os.makedirs(os.path.join(self.root, 'src', 'dir', 'new_dir'))
+        self.write('dir/new_dir/file', b'file')
+        self.write('new', b'new')
+        self.write('skipped.log', b'log')
+
+        changes = self.diff(['same', 'new', 'skipped.log', 'removed_dir', 'removed_dir/file', 'dir',
+                             'dir/new_dir/file', 'unknown'])
+        self.assertEqual(changes, [('create', 'dir/new_dir'), ('create', 'dir/new_dir/file'),
+                                   ('delete', 'dir/removed'), ('create', 'new'), ('delete', 'removed_dir/file'),
+                                   ('delete', 'removed_dir')])
+        self.assertFalse(any(ent.is_visited() for ent in self.db.db.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
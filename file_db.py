@@ -1,36 +1,94 @@
+import array
+import heapq
+import itertools
+import mmap
 import os
+import shutil
+import struct
 import sys
 import time
+import zlib
 from util import *
 
 class FileDbEntry:
     FLAG_DIRECTORY = 1
     FLAG_REMOVED = 2
+    # only kept in memory, used by the client to mark the entries found locally
+    FLAG_VISITED = 0x80
 
     ENTRY_META_SIZE = 1
     ENTRY_META_MTIME = 2
     ENTRY_META_SHA256 = 3
     ENTRY_META_SYMLINK = 4
 
+    # size, mtime and sha256 are packed into a single bytes object (_meta), which takes much less memory
+    # than three separate objects: byte presence mask, int64 size, int64 mtime, sha256 data
+    PACKED_META_HEADER = struct.Struct('<Bqq')
+    PACKED_META_SIZE = 1
+    PACKED_META_MTIME = 2
+    PACKED_META_SHA256 = 4
+
+    __slots__ = ('id', 'name', 'parent', 'children', '_meta', 'symlink', 'flags')
+
     def __init__(self, name = None, parent = None):
         self.id = None
-        self.name = name
+        # names repeat a lot between directories
+        self.name = sys.intern(name) if name is not None else None
         self.parent = parent
         self.children = None
-        self.size = None
-        self.mtime = None
-        self.sha256 = None
+        self._meta = None
         self.symlink = None
         self.flags = 0
 
+    def _pack_meta(self, size, mtime, sha256):
+        if size is None and mtime is None and sha256 is None:
+            self._meta = None
+            return
+        mask = 0
+        if size is not None:
+            mask |= self.PACKED_META_SIZE
+        if mtime is not None:
+            mask |= self.PACKED_META_MTIME
+        if sha256 is not None:
+            mask |= self.PACKED_META_SHA256
+        self._meta = self.PACKED_META_HEADER.pack(mask, size or 0, mtime or 0) + (sha256 or b'')
+
+    @property
+    def size(self):
+        if self._meta is None or not self._meta[0] & self.PACKED_META_SIZE:
+            return None
+        return self.PACKED_META_HEADER.unpack_from(self._meta)[1]
+
+    @size.setter
+    def size(self, val):
+        self._pack_meta(val, self.mtime, self.sha256)
+
+    @property
+    def mtime(self):
+        if self._meta is None or not self._meta[0] & self.PACKED_META_MTIME:
+            return None
+        return self.PACKED_META_HEADER.unpack_from(self._meta)[2]
+
+    @mtime.setter
+    def mtime(self, val):
+        self._pack_meta(self.size, val, self.sha256)
+
+    @property
+    def sha256(self):
+        if self._meta is None or not self._meta[0] & self.PACKED_META_SHA256:
+            return None
+        return self._meta[self.PACKED_META_HEADER.size:]
+
+    @sha256.setter
+    def sha256(self, val):
+        self._pack_meta(self.size, self.mtime, val)
+
     def reset_meta(self):
         if self.is_directory():
             if self.children is not None and len(self.children) > 0:
                 raise ValueError('Directory not empty')
         self.children = None
-        self.size = None
-        self.mtime = None
-        self.sha256 = None
+        self._meta = None
         self.symlink = None
         self.flags = 0
 
@@ -66,6 +124,23 @@ class FileDbEntry:
     def is_symlink(self):
         return self.symlink is not None
 
+    def set_visited(self, val=True):
+        if val:
+            self.flags |= self.FLAG_VISITED
+        else:
+            self.flags &= ~self.FLAG_VISITED
+
+    def is_visited(self):
+        return (self.flags & self.FLAG_VISITED) != 0
+
+    def get_path(self):
+        names = []
+        ent = self
+        while ent.parent is not None:
+            names.append(ent.name)
+            ent = ent.parent
+        return '/'.join(reversed(names))
+
     def encode(self):
         buf = bytearray()
         # varint id, varint parent
@@ -76,7 +151,7 @@ class FileDbEntry:
         encode_varint(buf, len(name_encoded))
         buf += name_encoded
         # byte flags
-        buf.append(self.flags)
+        buf.append(self.flags & ~self.FLAG_VISITED)
         # metadata (byte type, ...)
         if self.sha256 is not None:
             buf.append(self.ENTRY_META_SHA256)
@@ -128,57 +203,750 @@ class FileDbEntry:
                 raise ValueError('Invalid metadata: ' + str(meta_type))
         return ent
 
+    # Same as decode, but parses the record at pos of a bytes-like object. The varints which are
+    # present in every record are decoded inline, as this is the hot path of FileDb.load.
+    @staticmethod
+    def decode_buffer(buf, pos, parents):
+        try:
+            b = buf[pos]
+            pos += 1
+            file_id = b & 0x7f
+            shift = 7
+            while b & 0x80:
+                b = buf[pos]
+                pos += 1
+                file_id |= (b & 0x7f) << shift
+                shift += 7
+            b = buf[pos]
+            pos += 1
+            parent = b & 0x7f
+            shift = 7
+            while b & 0x80:
+                b = buf[pos]
+                pos += 1
+                parent |= (b & 0x7f) << shift
+                shift += 7
+            if parent not in parents:
+                raise ValueError('Invalid parent: ' + str(parent))
+            name, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+            ent = FileDbEntry(name.decode(), parents[parent])
+            ent.id = file_id
+            ent.flags = buf[pos]
+            pos += 1
+            size = None
+            mtime = None
+            sha256 = None
+            while True:
+                meta_type = buf[pos]
+                pos += 1
+                if meta_type == 0:
+                    break
+                if meta_type == FileDbEntry.ENTRY_META_SHA256:
+                    sha256, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+                elif meta_type == FileDbEntry.ENTRY_META_SIZE:
+                    size, pos = decode_varint_buffer(buf, pos)
+                elif meta_type == FileDbEntry.ENTRY_META_MTIME:
+                    mtime, pos = decode_varint_buffer(buf, pos)
+                elif meta_type == FileDbEntry.ENTRY_META_SYMLINK:
+                    symlink, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+                    ent.symlink = symlink.decode()
+                else:
+                    raise ValueError('Invalid metadata: ' + str(meta_type))
+            ent._pack_meta(size, mtime, sha256)
+        except IndexError:
+            raise EOFError()
+        return ent, pos
+
+# The log starts with a LOG_HEADER (LOG_MAGIC, uint64 generation) and is made of blocks of records: uint32 length,
+# uint32 crc32 of the records, records. Every commit writes one block, a block cut short by a crash is found by its
+# length or checksum. The log holds the changes made since the snapshot of the same generation.
+# Logs from before the snapshots start with LOG_MAGIC_V1 and no generation, logs without any magic are plain
+# records from before the blocks. Both are rewritten on load.
+LOG_MAGIC = b'PSYFDB\x00\x02'
+LOG_MAGIC_V1 = b'PSYFDB\x00\x01'
+LOG_HEADER = struct.Struct('<8sQ')
+BLOCK_HEADER = struct.Struct('<II')
+
+def encode_block(records):
+    if len(records) == 0:
+        return b''
+    return BLOCK_HEADER.pack(len(records), zlib.crc32(records)) + records
+
+class TornLogError(ValueError):
+    def __init__(self, pos, message):
+        super().__init__(f"{message} at offset {pos}")
+        self.pos = pos
+
+# Yields the records of every block between pos and end, raises a TornLogError at the first damaged one
+def iter_blocks(data, pos, end):
+    while pos < end:
+        if end - pos < BLOCK_HEADER.size:
+            raise TornLogError(pos, 'Incomplete block header')
+        length, crc = BLOCK_HEADER.unpack_from(data, pos)
+        start = pos + BLOCK_HEADER.size
+        if end - start < length:
+            raise TornLogError(pos, 'Incomplete block')
+        records = data[start:start + length]
+        if zlib.crc32(records) != crc:
+            raise TornLogError(pos, 'Block checksum mismatch')
+        pos = start + length
+        yield records
+
+
+# The snapshot holds every entry of the db as of a point of the log, it is read through mmap and only the looked
+# up entries are decoded. Layout:
+# - SNAPSHOT_HEADER: magic, generation, covered (the log offset up to which the previous log was folded in),
+#   number of records, offsets of the order index, of the id index (with its length) and of the sha256 index
+#   (with its length)
+# - the records, sorted by parent id and name, so that the children of a dir are next to each other
+# - order index: uint64 offset of every record, in the order of the records
+# - id index: uint64 offset of the record of every id, 0 for the unused ids
+# - sha256 index: (sha256 padded to 32 bytes, uint64 record offset), sorted by sha256
+SNAPSHOT_MAGIC = b'PSYSNP\x00\x01'
+SNAPSHOT_HEADER = struct.Struct('<8s8Q')
+SNAPSHOT_OFFSET = struct.Struct('<Q')
+SNAPSHOT_SHA256 = struct.Struct('<32sQ')
+
+def _sha256_key(sha256):
+    return sha256[:32].ljust(32, b'\0')
+
+def _entry_key(ent):
+    return ent.parent.id, ent.name.encode()
+
+# Entries standing in for the parents of records decoded without a db
+class _DetachedParents(dict):
+    def __contains__(self, ent_id):
+        return True
+
+    def __missing__(self, ent_id):
+        ent = FileDbEntry()
+        ent.id = ent_id
+        ent.set_directory()
+        self[ent_id] = ent
+        return ent
+
+class _Snapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < SNAPSHOT_HEADER.size or self.data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self.data.close()
+            raise ValueError(f"{path}: invalid snapshot")
+        (magic, self.generation, self.covered, self.count, self.order_start, self.id_start, self.id_count,
+         self.sha256_start, self.sha256_count) = SNAPSHOT_HEADER.unpack_from(self.data)
+
+    def close(self):
+        self.data.close()
+
+    # Returns the offset of the index-th record in the order of the records
+    def record_offset(self, index):
+        return SNAPSHOT_OFFSET.unpack_from(self.data, self.order_start + index * SNAPSHOT_OFFSET.size)[0]
+
+    # Returns the offset of the record of the id, 0 when there isn't one
+    def id_offset(self, ent_id):
+        if ent_id >= self.id_count:
+            return 0
+        return SNAPSHOT_OFFSET.unpack_from(self.data, self.id_start + ent_id * SNAPSHOT_OFFSET.size)[0]
+
+    def read_id(self, offset):
+        return decode_varint_buffer(self.data, offset)[0]
+
+    # Returns (id, parent id, encoded name) of the record at offset
+    def read_key(self, offset):
+        ent_id, pos = decode_varint_buffer(self.data, offset)
+        parent_id, pos = decode_varint_buffer(self.data, pos)
+        name, pos = decode_varint_prefixed_bytes_buffer(self.data, pos)
+        return ent_id, parent_id, name
+
+    # Returns the raw record at offset
+    def read_record(self, offset):
+        end = FileDbEntry.decode_buffer(self.data, offset, _DetachedParents())[1]
+        return self.data[offset:end]
+
+    # Returns the position in the order of the records of the first key not lower than (parent id, name)
+    def _lower_bound(self, parent_id, name):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.read_key(self.record_offset(mid))[1:] < (parent_id, name):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Yields the offsets of the records of the children of a dir
+    def children_offsets(self, parent_id):
+        index = self._lower_bound(parent_id, b'')
+        while index < self.count:
+            offset = self.record_offset(index)
+            if self.read_key(offset)[1] != parent_id:
+                break
+            yield offset
+            index += 1
+
+    # Returns the offset of the record of a child of a dir, 0 when there isn't one
+    def child_offset(self, parent_id, name):
+        index = self._lower_bound(parent_id, name)
+        if index == self.count:
+            return 0
+        offset = self.record_offset(index)
+        if self.read_key(offset)[1:] != (parent_id, name):
+            return 0
+        return offset
+
+    # Returns (padded sha256, record offset) of the index-th entry of the sha256 index
+    def sha256_entry(self, index):
+        return SNAPSHOT_SHA256.unpack_from(self.data, self.sha256_start + index * SNAPSHOT_SHA256.size)
+
+    # Yields the offsets of the records which may have the sha256
+    def sha256_offsets(self, sha256):
+        key = _sha256_key(sha256)
+        lo = 0
+        hi = self.sha256_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha256_entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.sha256_count:
+            entry_key, offset = self.sha256_entry(lo)
+            if entry_key != key:
+                break
+            yield offset
+            lo += 1
+
+# Writes a snapshot: the records are added in order, then the sha256 index entries in order
+class _SnapshotWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(bytes(SNAPSHOT_HEADER.size))
+        self.pos = SNAPSHOT_HEADER.size
+        self.buf = bytearray()
+        self.order = array.array('Q')
+        self.ids = array.array('Q')
+        self.order_start = None
+        self.id_start = None
+        self.sha256_start = None
+        self.sha256_count = 0
+
+    def add(self, ent_id, record):
+        self.order.append(self.pos)
+        if ent_id >= len(self.ids):
+            self.ids.frombytes(bytes((ent_id + 1 - len(self.ids)) * self.ids.itemsize))
+        self.ids[ent_id] = self.pos
+        self._write(record)
+
+    def end_records(self):
+        self.order_start = self.pos
+        self._write_array(self.order)
+        self.id_start = self.pos
+        self._write_array(self.ids)
+        self.sha256_start = self.pos
+
+    def add_sha256(self, key, ent_id):
+        self._write(SNAPSHOT_SHA256.pack(key, self.ids[ent_id]))
+        self.sha256_count += 1
+
+    # Writes the header and waits until the file is on the disk
+    def finish(self, generation, covered):
+        self.file.write(self.buf)
+        self.file.seek(0)
+        self.file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, covered, len(self.order), self.order_start,
+                                             self.id_start, len(self.ids), self.sha256_start, self.sha256_count))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+    def _write(self, data):
+        self.buf += data
+        self.pos += len(data)
+        if len(self.buf) >= 1024 * 1024:
+            self.file.write(self.buf)
+            self.buf = bytearray()
+
+    def _write_array(self, values):
+        if sys.byteorder != 'little':
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        self.file.write(self.buf)
+        self.buf = bytearray()
+        values.tofile(self.file)
+        self.pos += len(values) * values.itemsize
+
+
+_ENTRY_CHILDREN = FileDbEntry.children
+
+# A dir of a db loaded from a snapshot, whose children are decoded on the first access. Until then, the children
+# slot holds the _Entries of the db, and get_child only decodes the child it looks up.
+class _LazyDirEntry(FileDbEntry):
+    __slots__ = ()
+
+    def get_child(self, val):
+        children = _ENTRY_CHILDREN.__get__(self)
+        if type(children) is _Entries:
+            return children.find_child(self, val)
+        if children is None:
+            return None
+        return children.get(val, None)
+
+    @property
+    def children(self):
+        children = _ENTRY_CHILDREN.__get__(self)
+        if type(children) is _Entries:
+            children.load_children(self)
+            children = _ENTRY_CHILDREN.__get__(self)
+        return children
+
+    @children.setter
+    def children(self, val):
+        _ENTRY_CHILDREN.__set__(self, val)
+
+# The id -> entry dict of a db loaded from a snapshot. The entries are decoded from the snapshot when they are
+# looked up, the ids marked in touched are the ones the dict is authoritative for: the decoded and the changed
+# ones. Iterating decodes all of them.
+class _Entries(dict):
+    def __init__(self, snapshot, root):
+        super().__init__()
+        self.snapshot = snapshot
+        self.touched = bytearray(snapshot.id_count)
+        self.count = snapshot.count + 1
+        dict.__setitem__(self, 0, root)
+        root.__class__ = _LazyDirEntry
+        _ENTRY_CHILDREN.__set__(root, self)
+
+    def _is_touched(self, ent_id):
+        return ent_id < len(self.touched) and self.touched[ent_id]
+
+    def _touch(self, ent_id):
+        if ent_id >= len(self.touched):
+            self.touched.extend(bytes(ent_id + 1 - len(self.touched)))
+        self.touched[ent_id] = 1
+
+    def _in_snapshot(self, ent_id):
+        return ent_id is not None and not self._is_touched(ent_id) and self.snapshot.id_offset(ent_id) != 0
+
+    def _materialize(self, offset):
+        ent, pos = FileDbEntry.decode_buffer(self.snapshot.data, offset, self)
+        if ent.is_directory():
+            ent.__class__ = _LazyDirEntry
+            _ENTRY_CHILDREN.__set__(ent, self)
+        dict.__setitem__(self, ent.id, ent)
+        self._touch(ent.id)
+        return ent
+
+    def __missing__(self, ent_id):
+        if not self._in_snapshot(ent_id):
+            raise KeyError(ent_id)
+        return self._materialize(self.snapshot.id_offset(ent_id))
+
+    def __contains__(self, ent_id):
+        return dict.__contains__(self, ent_id) or self._in_snapshot(ent_id)
+
+    def get(self, ent_id, default=None):
+        if dict.__contains__(self, ent_id):
+            return dict.__getitem__(self, ent_id)
+        if self._in_snapshot(ent_id):
+            return self[ent_id]
+        return default
+
+    def __setitem__(self, ent_id, ent):
+        if ent_id not in self:
+            self.count += 1
+        dict.__setitem__(self, ent_id, ent)
+        self._touch(ent_id)
+
+    def pop(self, ent_id, *default):
+        if ent_id not in self:
+            if default:
+                return default[0]
+            raise KeyError(ent_id)
+        ent = self[ent_id]
+        dict.__delitem__(self, ent_id)
+        self.count -= 1
+        return ent
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    # Decodes every entry which isn't in the dict yet, the parents go before their children
+    def load_all(self):
+        if dict.__len__(self) == self.count:
+            return
+        snapshot = self.snapshot
+        with paused_gc():
+            for i in range(snapshot.count):
+                offset = snapshot.record_offset(i)
+                if not self._is_touched(snapshot.read_id(offset)):
+                    self._materialize(offset)
+
+    def find_child(self, parent, name):
+        offset = self.snapshot.child_offset(parent.id, name.encode(errors='surrogateescape'))
+        if offset == 0:
+            return None
+        ent_id = self.snapshot.read_id(offset)
+        if self._is_touched(ent_id):
+            ent = dict.get(self, ent_id, None)
+            if ent is None or ent.parent.id != parent.id or ent.name != name:
+                return None
+            return ent
+        return self._materialize(offset)
+
+    def load_children(self, parent):
+        children = {}
+        for offset in self.snapshot.children_offsets(parent.id):
+            ent_id = self.snapshot.read_id(offset)
+            if self._is_touched(ent_id):
+                # changed since the snapshot, the id may even belong to another entry now
+                ent = dict.get(self, ent_id, None)
+                if ent is None or ent.parent.id != parent.id:
+                    continue
+            else:
+                ent = self._materialize(offset)
+            children[ent.name] = ent
+        _ENTRY_CHILDREN.__set__(parent, children or None)
+
+
+# Folds the log into a new snapshot a slice at a time, while the db keeps changing. Only the files are read: the
+# records of the log up to its size at the start are merged with the previous snapshot. The records appended
+# since then start the next log.
+class _Compaction:
+    def __init__(self, filedb):
+        filedb.commit()
+        self.filedb = filedb
+        self.log_end = os.path.getsize(filedb.file_path)
+        self.log_records = filedb.log_records
+        self.writer = _SnapshotWriter(filedb.file_path + ".snap.tmp")
+        self.done = False
+        self.steps = self._merge()
+
+    # Returns True once the snapshot is written
+    def run(self, count):
+        for step in itertools.islice(self.steps, count):
+            pass
+        return self.done
+
+    def abort(self):
+        self.steps.close()
+        self.writer.abort()
+
+    def _merge(self):
+        filedb = self.filedb
+        snapshot = filedb.snapshot
+        writer = self.writer
+        # id -> (parent id, encoded name, record, sha256) of the entries in the log, None for the removed ones
+        changes = {}
+        if self.log_end > filedb.log_start:
+            with open(filedb.file_path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), self.log_end, access=mmap.ACCESS_READ)
+            with data:
+                parents = _DetachedParents()
+                for records in iter_blocks(data, filedb.log_start, self.log_end):
+                    pos = 0
+                    while pos < len(records):
+                        ent, end = FileDbEntry.decode_buffer(records, pos, parents)
+                        if ent.is_removed():
+                            changes[ent.id] = None
+                        else:
+                            changes[ent.id] = (ent.parent.id, ent.name.encode(), records[pos:end], ent.sha256)
+                        pos = end
+                        yield
+        # sorted a run at a time, the runs are merged as the snapshot is written
+        runs = [[]]
+        sha256_runs = [[]]
+        for ent_id, change in changes.items():
+            if change is not None:
+                runs[-1].append(((change[0], change[1]), ent_id))
+                if change[3] is not None:
+                    sha256_runs[-1].append((_sha256_key(change[3]), ent_id))
+            if len(runs[-1]) >= 1000:
+                runs[-1].sort()
+                runs.append([])
+            if len(sha256_runs[-1]) >= 1000:
+                sha256_runs[-1].sort()
+                sha256_runs.append([])
+            yield
+        runs[-1].sort()
+        sha256_runs[-1].sort()
+
+        changed = heapq.merge(*runs)
+        next_changed = next(changed, None)
+        for i in range(snapshot.count if snapshot is not None else 0):
+            offset = snapshot.record_offset(i)
+            ent_id, parent_id, name = snapshot.read_key(offset)
+            if ent_id not in changes:
+                while next_changed is not None and next_changed[0] < (parent_id, name):
+                    writer.add(next_changed[1], changes[next_changed[1]][2])
+                    next_changed = next(changed, None)
+                    yield
+                writer.add(ent_id, snapshot.read_record(offset))
+            yield
+        while next_changed is not None:
+            writer.add(next_changed[1], changes[next_changed[1]][2])
+            next_changed = next(changed, None)
+            yield
+        writer.end_records()
+
+        changed = heapq.merge(*sha256_runs)
+        next_changed = next(changed, None)
+        for i in range(snapshot.sha256_count if snapshot is not None else 0):
+            key, offset = snapshot.sha256_entry(i)
+            ent_id = snapshot.read_id(offset)
+            if ent_id not in changes:
+                while next_changed is not None and next_changed[0] < key:
+                    writer.add_sha256(*next_changed)
+                    next_changed = next(changed, None)
+                    yield
+                writer.add_sha256(key, ent_id)
+            yield
+        while next_changed is not None:
+            writer.add_sha256(*next_changed)
+            next_changed = next(changed, None)
+            yield
+        self.done = True
+
+
 class FileDb:
+    # the log is folded into a new snapshot once it has COMPACT_RATIO times as many records as the db has entries,
+    # at least COMPACT_MIN_RECORDS. COMPACT_MAX_RECORDS bounds the records replayed when the db is opened.
+    COMPACT_RATIO = 0.5
+    COMPACT_MIN_RECORDS = 10000
+    COMPACT_MAX_RECORDS = 200000
+    # snapshot records and log records merged with every append during a compaction
+    COMPACT_SLICE = 1000
+    # the appended records are written and fsynced together, once there are COMMIT_RECORDS of them or the oldest
+    # one waits for COMMIT_INTERVAL seconds. flush() commits them right away.
+    COMMIT_RECORDS = 256
+    COMMIT_INTERVAL = 0.05
+
     def __init__(self, file_path, readonly=False):
         self.file_path = file_path
         self.readonly = readonly
-        self.unneeded_records = 0
+        self.snapshot = None
+        self.generation = 0
+        # offset of the first block of the log
+        self.log_start = LOG_HEADER.size
+        # records in the log since log_start
+        self.log_records = 0
+        self.compaction = None
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.pending_since = None
+        # called before records are written, so the data they refer to can be made durable first
+        self.before_commit = None
         self.next_id = 1
         self.append_handle = None
         self.root = FileDbEntry()
         self.root.set_directory()
         self.root.id = 0
         self.db = {0: self.root}
+        # sha256 -> entry id, built on the first find_sha256 call from the entries in memory
+        self.sha256_index = None
         self.load()
 
+    # Opens the snapshot and replays the log on top of it. The entries of the snapshot are only decoded when they
+    # are looked up, the time taken doesn't depend on the size of the db.
     def load(self):
-        if self.file_path is None or not os.path.exists(self.file_path):
+        if self.file_path is None:
+            return
+        if not os.path.exists(self.file_path) and not os.path.exists(self.file_path + ".snap"):
             return
+        self._abort_compaction()
+        self._close_append_handle()
+        self._drop_pending()
+        self._close_snapshot()
         self.root = FileDbEntry()
         self.root.set_directory()
         self.root.id = 0
         self.db = {0: self.root}
-        self.unneeded_records = 0
-        self.next_id = 0
-        self._close_append_handle()
+        self.sha256_index = None
+        self.generation = 0
+        self.log_start = LOG_HEADER.size
+        self.log_records = 0
+        self.next_id = 1
+        if os.path.exists(self.file_path + ".snap"):
+            self.snapshot = _Snapshot(self.file_path + ".snap")
+            self.generation = self.snapshot.generation
+            self.next_id = max(self.snapshot.id_count, 1)
+            self.db = _Entries(self.snapshot, self.root)
+        if not os.path.exists(self.file_path):
+            return
         with open(self.file_path, 'rb') as file:
-            while True:
-                try:
-                    ent = FileDbEntry.decode(file, self.db)
-                    if ent is None:
-                        break
-                    if ent.id in self.db:
-                        if self.db[ent.id].parent.id != ent.parent.id:
-                            raise ValueError(f"Parent is invalid")
-                        ent.children = self.db[ent.id].children
-                        self.unneeded_records += 1
-                    if ent.is_removed():
-                        self.db.pop(ent.id, None)
-                        ent.parent.remove_child(ent)
-                        if self.next_id == ent.id + 1:
-                            self.next_id = ent.id
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        torn_pos = None
+        with data:
+            if data[:len(LOG_MAGIC)] == LOG_MAGIC:
+                self._check_generation(LOG_HEADER.unpack_from(data)[1])
+            elif self.snapshot is not None:
+                raise ValueError(f"{self.file_path}: the log is older than the snapshot")
+            try:
+                if data[:len(LOG_MAGIC)] == LOG_MAGIC:
+                    for records in iter_blocks(data, self.log_start, len(data)):
+                        self._load_records(records)
+                else:
+                    if data[:len(LOG_MAGIC_V1)] == LOG_MAGIC_V1:
+                        self.log_start = len(LOG_MAGIC_V1)
+                        for records in iter_blocks(data, self.log_start, len(data)):
+                            self._load_records(records)
                     else:
-                        self.db[ent.id] = ent
-                        ent.parent.add_child(ent)
-                        if ent.id >= self.next_id:
-                            self.next_id = ent.id + 1
-                except (ValueError, EOFError) as e:
-                    print(e, file=sys.stderr)
-                    break
+                        self._load_records(data)
+                    if not self.readonly:
+                        self.rewrite()
+                        return
+            except TornLogError as e:
+                print(f"{self.file_path}: {e}, the rest of the log is dropped", file=sys.stderr)
+                torn_pos = e.pos
+            except (ValueError, EOFError) as e:
+                print(e, file=sys.stderr)
+        if torn_pos is not None and not self.readonly:
+            self._truncate_log(torn_pos)
+        self._maybe_compact()
+
+    # Sets the part of the log to replay. The log of the previous generation is found after a crash between the
+    # renames of a compaction, the part covered by the snapshot is skipped then.
+    def _check_generation(self, generation):
+        if self.snapshot is None:
+            if generation != 0:
+                raise ValueError(f"{self.file_path}: the snapshot of the log is missing")
+        elif generation + 1 == self.snapshot.generation:
+            self.log_start = self.snapshot.covered
+        elif generation != self.snapshot.generation:
+            raise ValueError(f"{self.file_path}: the log doesn't belong to the snapshot")
+        self.generation = generation
+
+    # Returns the generation in the header of the log file, 0 when there isn't one
+    def _read_log_generation(self):
+        if not os.path.exists(self.file_path):
+            return 0
+        with open(self.file_path, 'rb') as file:
+            header = file.read(LOG_HEADER.size)
+        if len(header) < LOG_HEADER.size or header[:len(LOG_MAGIC)] != LOG_MAGIC:
+            return 0
+        return LOG_HEADER.unpack(header)[1]
+
+    # Cuts off the damaged end of the log, so that the next commits can be read back. The offsets given out
+    # before are invalidated, they may point past the end or into new blocks.
+    def _truncate_log(self, pos):
+        with open(self.file_path, 'r+b') as file:
+            file.truncate(pos)
+            os.fsync(file.fileno())
+        if os.path.exists(self.file_path + ".id"):
+            self._write_log_id()
+
+    def _load_records(self, data):
+        with paused_gc():
+            pos = 0
+            while pos < len(data):
+                ent, pos = FileDbEntry.decode_buffer(data, pos, self.db)
+                self.log_records += 1
+                if ent.id in self.db:
+                    if self.db[ent.id].parent.id != ent.parent.id:
+                        raise ValueError(f"Parent is invalid")
+                    ent.children = self.db[ent.id].children
+                if ent.is_removed():
+                    if ent.id not in self.db:
+                        raise ValueError('Removed entry does not exist: ' + str(ent.id))
+                    ent.parent.remove_child(ent)
+                    self.db.pop(ent.id)
+                    if self.next_id == ent.id + 1:
+                        self.next_id = ent.id
+                else:
+                    self.db[ent.id] = ent
+                    ent.parent.add_child(ent)
+                    if ent.id >= self.next_id:
+                        self.next_id = ent.id + 1
+
+    # Applies raw records read from another db's log (see get_log_state) and appends them to this one.
+    def merge_log(self, data):
+        if self.readonly:
+            raise IOError('File opened as read-only')
+        self.sha256_index = None
+        self._load_records(data)
+        self.pending += data
+        self.commit()
         self._maybe_compact()
 
+    # Returns (log id, offset) of the end of the log. Records appended after the offset can be read with
+    # read_log as long as the log id does not change, which happens when the log is rewritten.
+    def get_log_state(self):
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return None
+        self.flush()
+        log_id = None
+        if os.path.exists(self.file_path + ".id"):
+            with open(self.file_path + ".id", 'r') as file:
+                log_id = file.read().strip()
+        elif not self.readonly:
+            log_id = self._write_log_id()
+        if not log_id:
+            return None
+        return log_id, os.path.getsize(self.file_path)
+
+    def _write_log_id(self):
+        log_id = os.urandom(16).hex()
+        with open(self.file_path + ".id.tmp", 'w') as file:
+            file.write(log_id)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(self.file_path + ".id.tmp", self.file_path + ".id")
+        return log_id
+
+    # Returns the records of the blocks between the offsets, without the framing
+    def read_log(self, offset, end):
+        with open(self.file_path, 'rb') as file:
+            file.seek(offset)
+            data = read_exactly(file, end - offset)
+        return b''.join(iter_blocks(data, 0, len(data)))
+
+    def flush(self):
+        self.commit()
+
+    # Writes the pending records as one block and waits until it is on the disk
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        if self.before_commit is not None:
+            self.before_commit()
+        if self.append_handle is None:
+            self.append_handle = open(self.file_path, 'ab')
+            if self.append_handle.tell() == 0:
+                self.append_handle.write(LOG_HEADER.pack(LOG_MAGIC, self.generation))
+        self.append_handle.write(encode_block(self.pending))
+        self.append_handle.flush()
+        os.fsync(self.append_handle.fileno())
+        self._drop_pending()
+
     def close(self):
+        if self.compaction is not None:
+            self._finish_compaction()
+        if self.file_path is not None and not self.readonly:
+            self.commit()
         self._close_append_handle()
+        self._close_snapshot()
         self.file_path = None
         self.db = None
 
@@ -187,30 +955,111 @@ class FileDb:
             self.append_handle.close()
             self.append_handle = None
 
+    def _close_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    # Starts or continues an incremental compaction, every call only merges COMPACT_SLICE records
     def _maybe_compact(self):
-        if self.unneeded_records >= 100000 and not self.readonly:
-            self.rewrite()
+        if self.readonly or self.file_path is None:
+            return
+        if self.compaction is None:
+            limit = max(self.COMPACT_RATIO * len(self.db), self.COMPACT_MIN_RECORDS)
+            if self.log_records < min(limit, self.COMPACT_MAX_RECORDS):
+                return
+            self.compaction = _Compaction(self)
+        if self.compaction.run(self.COMPACT_SLICE):
+            self._finish_compaction()
+
+    # Switches to the snapshot of the compaction. The records appended during the compaction are moved to the new
+    # log, a crash between the two renames leaves the new snapshot with the old log, which is replayed from the
+    # end of the merged part.
+    def _finish_compaction(self):
+        compaction = self.compaction
+        self.compaction = None
+        compaction.run(sys.maxsize)
+        self.commit()
+        self._close_append_handle()
+        generation = self.generation + 1
+        file = open(self.file_path + ".tmp", 'wb')
+        file.write(LOG_HEADER.pack(LOG_MAGIC, generation))
+        with open(self.file_path, 'rb') as old_file:
+            old_file.seek(compaction.log_end)
+            shutil.copyfileobj(old_file, file)
+        self._replace_snapshot(compaction.writer, generation, compaction.log_end)
+        self._replace_log(file)
+        self.generation = generation
+        self.log_start = LOG_HEADER.size
+        self.log_records -= compaction.log_records
 
+    def _abort_compaction(self):
+        if self.compaction is not None:
+            self.compaction.abort()
+            self.compaction = None
+
+    # Writes the whole db to a new snapshot and starts an empty log
     def rewrite(self):
         if self.readonly:
             raise IOError('File opened as read-only')
+        self._abort_compaction()
         self._close_append_handle()
-        self.unneeded_records = 0
-        with open(self.file_path + ".tmp", 'wb') as file:
-            for v in self.db.values():
-                if v == self.root:
-                    continue
-                file.write(v.encode())
+        if self.before_commit is not None:
+            self.before_commit()
+        self._drop_pending()
+        generation = max(self.generation, self._read_log_generation()) + 1
+        covered = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+        entries = sorted((ent for ent in self.db.values() if ent != self.root), key=_entry_key)
+        writer = _SnapshotWriter(self.file_path + ".snap.tmp")
+        for ent in entries:
+            writer.add(ent.id, ent.encode())
+        writer.end_records()
+        for key, ent_id in sorted((_sha256_key(ent.sha256), ent.id) for ent in entries if ent.sha256 is not None):
+            writer.add_sha256(key, ent_id)
+        file = open(self.file_path + ".tmp", 'wb')
+        file.write(LOG_HEADER.pack(LOG_MAGIC, generation))
+        self._replace_snapshot(writer, generation, covered)
+        self._replace_log(file)
+        self.generation = generation
+        self.log_start = LOG_HEADER.size
+        self.log_records = 0
+
+    def _drop_pending(self):
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.pending_since = None
+
+    # Replaces the snapshot with the one being written and looks up the entries in it from then on
+    def _replace_snapshot(self, writer, generation, covered):
+        writer.finish(generation, covered)
+        os.rename(writer.path, self.file_path + ".snap")
+        fsync_dir(os.path.dirname(os.path.abspath(self.file_path)))
+        old_snapshot = self.snapshot
+        self.snapshot = _Snapshot(self.file_path + ".snap")
+        if isinstance(self.db, _Entries):
+            self.db.snapshot = self.snapshot
+        if old_snapshot is not None:
+            old_snapshot.close()
+
+    # Replaces the log with the tmp file being written, a crash leaves either the old or the new one
+    def _replace_log(self, file):
+        with file:
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(self.file_path + ".id"):
+            # invalidates the offsets returned by get_log_state, before they can point into the new file
+            self._write_log_id()
         os.rename(self.file_path + ".tmp", self.file_path)
+        fsync_dir(os.path.dirname(os.path.abspath(self.file_path)))
 
     def find_path(self, path):
         entry = self.root
         if path == '':
             return entry
         for el in path.split('/'):
-            if entry.children is None or el not in entry.children:
+            entry = entry.get_child(el)
+            if entry is None:
                 return None
-            entry = entry.children[el]
         return entry
 
     def get_path(self, path):
@@ -219,13 +1068,60 @@ class FileDb:
             raise KeyError('Invalid path')
         return ret
 
+    # Returns a file with the given content. The indexes aren't updated on removals, the entries are checked here
+    # instead. The entries which weren't decoded from the snapshot yet are found with its own index.
+    def find_sha256(self, sha256):
+        if self.sha256_index is None:
+            self.sha256_index = {}
+            for ent in dict.values(self.db):
+                if ent.sha256 is not None:
+                    self.sha256_index[ent.sha256] = ent.id
+        ent = self.db.get(self.sha256_index.get(sha256, None), None)
+        if ent is not None and ent.sha256 == sha256:
+            return ent
+        if self.snapshot is not None:
+            for offset in self.snapshot.sha256_offsets(sha256):
+                ent = self.db.get(self.snapshot.read_id(offset), None)
+                if ent is not None and ent.sha256 == sha256:
+                    return ent
+        return None
+
     def append(self, entry):
+        self.append_many((entry,))
+
+    # Records the entries with a single write to the log
+    def append_many(self, entries):
         if self.readonly:
             raise IOError('File opened as read-only')
+        count = 0
+        for entry in entries:
+            if self._apply_entry(entry):
+                self.pending += entry.encode()
+                count += 1
+        if count == 0:
+            return
+        self.log_records += count
+
+        if self.append_handle is None and not os.path.exists(self.file_path):
+            self.rewrite()
+            return
+        now = time.monotonic()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending_count += count
+        if self.pending_count >= self.COMMIT_RECORDS or now - self.pending_since >= self.COMMIT_INTERVAL:
+            self.commit()
+        self._maybe_compact()
+
+    # Changes the tree like append, without writing to the log. The client follows its own changes in its copy
+    # of the server db with it.
+    def apply(self, entry):
+        self._apply_entry(entry)
+
+    # Returns False when the entry doesn't need to be written to the log
+    def _apply_entry(self, entry):
         if entry.parent is None:
             raise ValueError('Entry parent can not be None')
-        if entry.id in self.db:
-            self.unneeded_records += 1
         if entry.id is None:
             if entry.parent.children is not None and entry.name in entry.parent.children:
                 other_entry = entry.parent.children[entry.name]
@@ -240,14 +1136,9 @@ class FileDb:
             self.db[entry.id] = entry
         if entry.is_removed():
             if entry.id not in self.db:
-                return
-            self.db.pop(entry.id, None)
+                return False
             entry.parent.remove_child(entry)
-
-        if self.append_handle is None:
-            if not os.path.exists(self.file_path):
-                self.rewrite()
-                return
-            self.append_handle = open(self.file_path, 'ab')
-        self.append_handle.write(entry.encode())
-        self._maybe_compact()
\ No newline at end of file
+            self.db.pop(entry.id, None)
+        elif self.sha256_index is not None and entry.sha256 is not None:
+            self.sha256_index[entry.sha256] = entry.id
+        return True
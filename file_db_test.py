@@ -1,8 +1,14 @@
 import unittest
 import os
+import random
 
 
-from file_db import FileDb, FileDbEntry
+from file_db import FileDb, FileDbEntry, LOG_MAGIC
+
+def remove_db(path):
+    for suffix in ('', '.id', '.snap', '.tmp', '.snap.tmp'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
 
 class FileDbTest(unittest.TestCase):
 
@@ -20,7 +26,7 @@ class FileDbTest(unittest.TestCase):
             dir = db.get_path('test_dir')
             self.assertTrue(dir.is_directory())
         finally:
-            os.remove('test.bin')
+            remove_db('test.bin')
 
     def test_append(self):
         if os.path.exists('test.bin'):
@@ -45,7 +51,7 @@ class FileDbTest(unittest.TestCase):
             self.assertEqual(ent.sha256, b'1234')
             db.close()
         finally:
-            os.remove('test.bin')
+            remove_db('test.bin')
 
     def test_delete(self):
         if os.path.exists('test.bin'):
@@ -91,7 +97,237 @@ class FileDbTest(unittest.TestCase):
                 db.get_path('test_dir')
             db.close()
         finally:
-            os.remove('test.bin')
+            remove_db('test.bin')
+
+    def test_log_state(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+        try:
+            db = FileDb('test.bin')
+            dir = FileDbEntry('test_dir', db.root)
+            dir.set_directory()
+            db.append(dir)
+            log_id, offset = db.get_log_state()
+            file1 = FileDbEntry('file1.txt', dir)
+            file1.sha256 = b'1234'
+            db.append(file1)
+            self.assertEqual(db.get_log_state()[0], log_id)
+            log = db.read_log(offset, db.get_log_state()[1])
+            db.close()
+
+            copy = FileDb(None)
+            dir = FileDbEntry('test_dir', copy.root)
+            dir.set_directory()
+            dir.id = 1
+            copy.root.add_child(dir)
+            copy.db[dir.id] = dir
+            copy.file_path = 'test.bin'
+            copy.merge_log(log)
+            self.assertEqual(copy.get_path('test_dir/file1.txt').sha256, b'1234')
+            copy.close()
+
+            db = FileDb('test.bin')
+            self.assertEqual(db.get_log_state()[0], log_id)
+            db.rewrite()
+            self.assertNotEqual(db.get_log_state()[0], log_id)
+            db.close()
+        finally:
+            remove_db('test.bin')
+
+    def test_find_sha256(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+        try:
+            db = FileDb('test.bin')
+            dir = FileDbEntry('test_dir', db.root)
+            dir.set_directory()
+            file1 = FileDbEntry('file1.txt', dir)
+            file1.sha256 = b'1234'
+            db.append_many([dir, file1])
+            self.assertEqual(db.find_sha256(b'1234').get_path(), 'test_dir/file1.txt')
+            self.assertIsNone(db.find_sha256(b'5678'))
+
+            file2 = FileDbEntry('file2.txt', dir)
+            file2.sha256 = b'5678'
+            db.append(file2)
+            self.assertIs(db.find_sha256(b'5678'), file2)
+            file1 = FileDbEntry('file1.txt', dir)
+            file1.sha256 = b'9999'
+            db.append(file1)
+            self.assertIsNone(db.find_sha256(b'1234'))
+            db.close()
+        finally:
+            remove_db('test.bin')
+
+    def test_commits(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+        try:
+            db = FileDb('test.bin')
+            db.rewrite()
+            db.COMMIT_RECORDS = 3
+            db.COMMIT_INTERVAL = 3600
+            log_id, offset = db.get_log_state()
+            for name in ('a', 'b', 'c', 'd'):
+                db.append(FileDbEntry(name, db.root))
+                if name == 'b':
+                    self.assertEqual(os.path.getsize('test.bin'), offset)
+            committed_size = os.path.getsize('test.bin')
+            self.assertGreater(committed_size, offset)
+            db.flush()
+            self.assertEqual(len(db.read_log(offset, os.path.getsize('test.bin'))),
+                             sum(len(ent.encode()) for ent in db.root.children.values()))
+            db.close()
+
+            # a commit cut short by a crash is dropped with what follows it
+            with open('test.bin', 'ab') as file:
+                file.write(b'\x10\x00\x00\x00garbage')
+            db = FileDb('test.bin')
+            self.assertEqual(sorted(db.root.children), ['a', 'b', 'c', 'd'])
+            self.assertNotEqual(db.get_log_state(), (log_id, os.path.getsize('test.bin')))
+            db.append(FileDbEntry('e', db.root))
+            db.close()
+            db = FileDb('test.bin')
+            self.assertEqual(sorted(db.root.children), ['a', 'b', 'c', 'd', 'e'])
+            db.close()
+        finally:
+            remove_db('test.bin')
+
+    def test_old_log(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+        try:
+            db = FileDb(None)
+            ent = FileDbEntry('test.txt', db.root)
+            ent.sha256 = b'1234'
+            db.apply(ent)
+            with open('test.bin', 'wb') as file:
+                file.write(ent.encode())
+
+            db = FileDb('test.bin', readonly=True)
+            self.assertEqual(db.get_path('test.txt').sha256, b'1234')
+            db = FileDb('test.bin')
+            self.assertEqual(db.get_path('test.txt').sha256, b'1234')
+            db.close()
+            with open('test.bin', 'rb') as file:
+                self.assertEqual(file.read(len(LOG_MAGIC)), LOG_MAGIC)
+        finally:
+            remove_db('test.bin')
+
+    def test_compaction(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+
+        def open_db():
+            db = FileDb('test.bin')
+            db.COMPACT_MIN_RECORDS = 20
+            db.COMPACT_SLICE = 3
+            return db
+
+        def tree(db):
+            return {ent.get_path(): (ent.is_directory(), ent.sha256) for ent in db.db.values() if ent != db.root}
+
+        try:
+            rnd = random.Random(1)
+            db = open_db()
+            compactions = 0
+            compaction = None
+            for i in range(3000):
+                entries = [ent for ent in db.db.values()]
+                ent = rnd.choice(entries)
+                action = rnd.random()
+                if ent.is_directory() and action < 0.6:
+                    child = FileDbEntry(f"n{rnd.randint(0, 5)}", ent)
+                    if rnd.random() < 0.3:
+                        child.set_directory()
+                    else:
+                        child.sha256 = bytes([i % 256])
+                    if child.name not in (ent.children or {}) or not ent.children[child.name].children:
+                        db.append(child)
+                elif ent != db.root and not ent.children and action < 0.8:
+                    ent.set_removed()
+                    db.append(ent)
+                elif ent != db.root and not ent.is_directory():
+                    update = FileDbEntry(ent.name, ent.parent)
+                    update.sha256 = bytes([i % 256])
+                    db.append(update)
+                if db.compaction is not None and db.compaction is not compaction:
+                    compactions += 1
+                compaction = db.compaction
+                if i % 500 == 499:
+                    expected = tree(db)
+                    db.close()
+                    db = open_db()
+                    self.assertEqual(tree(db), expected)
+            self.assertGreater(compactions, 5)
+            self.assertLess(db.log_records, max(len(db.db), db.COMPACT_MIN_RECORDS) * 2)
+            db.close()
+        finally:
+            remove_db('test.bin')
+
+    def test_snapshot(self):
+        if os.path.exists('test.bin'):
+            raise FileExistsError()
+
+        def tree(db):
+            return {ent.get_path(): ent.sha256 for ent in db.db.values() if ent != db.root}
+
+        try:
+            db = FileDb('test.bin')
+            for i in range(10):
+                dir = FileDbEntry(f"d{i}", db.root)
+                dir.set_directory()
+                db.append(dir)
+                for j in range(20):
+                    ent = FileDbEntry(f"f{j}", dir)
+                    ent.sha256 = bytes([i, j])
+                    db.append(ent)
+            db.rewrite()
+            db.close()
+
+            # only the entries on the way are decoded
+            db = FileDb('test.bin')
+            self.assertEqual(len(db.db), 211)
+            self.assertEqual(db.get_path('d3/f5').sha256, bytes([3, 5]))
+            self.assertEqual(dict.__len__(db.db), 3)
+            self.assertEqual(len(db.get_path('d3').children), 20)
+            self.assertEqual(dict.__len__(db.db), 22)
+            self.assertEqual(db.find_sha256(bytes([7, 1])).get_path(), 'd7/f1')
+            db.get_path('d3/f5').set_removed()
+            db.append(db.get_path('d3/f5'))
+            self.assertIsNone(db.find_sha256(bytes([3, 5])))
+            db.append(FileDbEntry('new', db.get_path('d8')))
+            self.assertEqual(len(db.db), 211)
+            expected = tree(db)
+            db.close()
+            db = FileDb('test.bin')
+            self.assertEqual(tree(db), expected)
+
+            # a crash between the renames of a compaction leaves the new snapshot with the old log, the records
+            # appended during the compaction are still found in it
+            db.COMPACT_RATIO = 0
+            db.COMPACT_MIN_RECORDS = 5
+            db.COMPACT_SLICE = 50
+            db._replace_log = lambda file: file.close()
+            generation = db.generation
+            for i in range(20):
+                ent = FileDbEntry(f"f{i}", db.get_path('d9'))
+                ent.sha256 = bytes([99, i])
+                db.append(ent)
+                if db.generation != generation:
+                    db.flush()
+                    expected = tree(db)
+                    break
+            self.assertIsNotNone(db.find_sha256(bytes([99, 0])))
+            db = FileDb('test.bin')
+            self.assertEqual(db.generation + 1, db.snapshot.generation)
+            self.assertEqual(tree(db), expected)
+            db.close()
+            db = FileDb('test.bin')
+            self.assertEqual(tree(db), expected)
+            db.close()
+        finally:
+            remove_db('test.bin')
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import re
 
@@ -8,9 +9,17 @@ class FileFinderDir:
         self.include = -1
         self.exclude = -1
         self.wildcards = []
+        # combined matcher of the wildcards, built on the first use
+        self.matcher = None
+
+    def get_matcher(self):
+        if self.matcher is None:
+            self.matcher = FileFinderMatcher(self.wildcards)
+        return self.matcher
 
 class FileFinderWildcard:
     def __init__(self, regex, include, index):
+        self.pattern = regex
         self.regex = re.compile(regex)
         self.include = -1
         self.exclude = -1
@@ -19,11 +28,63 @@ class FileFinderWildcard:
         else:
             self.exclude = index
 
+# Matches the wildcards of a dir with a single regex. The alternatives are ordered by descending rule id, so the
+# first one matching is the rule that wins, its group number tells which one it is.
+class FileFinderMatcher:
+    def __init__(self, wildcards):
+        wildcards = sorted(wildcards, key=lambda w: max(w.include, w.exclude), reverse=True)
+        self.regex = re.compile('|'.join('(' + w.pattern + ')' for w in wildcards))
+        # group number -> (include id, exclude id)
+        self.rules = [None] + [(w.include, w.exclude) for w in wildcards]
+        self.max_id = max(max(w.include, w.exclude) for w in wildcards)
+
+    # Returns (include id, exclude id) of the winning rule, None when no rule matches
+    def match(self, path):
+        m = self.regex.match(path)
+        if m is None:
+            return None
+        return self.rules[m.lastindex]
+
+
+# Lists dirs, the ones passed to prefetch are listed in the background
+class _DirScanner:
+    def __init__(self, threads, max_prefetch):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self.max_prefetch = max_prefetch
+        # full path -> future of the entry list
+        self.pending = {}
+
+    @staticmethod
+    def _list_dir(full_path):
+        with os.scandir(full_path) as it:
+            return list(it)
+
+    def prefetch(self, full_paths):
+        if self.executor is None:
+            return
+        for full_path in full_paths:
+            if len(self.pending) >= self.max_prefetch:
+                break
+            if full_path not in self.pending:
+                self.pending[full_path] = self.executor.submit(self._list_dir, full_path)
+
+    def scandir(self, full_path):
+        future = self.pending.pop(full_path, None)
+        if future is None:
+            return os.scandir(full_path)
+        return future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.pending = {}
+
 
 class FileFinder:
     def __init__(self):
         self.root_dir = FileFinderDir()
         self.next_rule_id = 0
+        self._scanner = None
 
     def get_dir(self, path):
         path = path.split('/')
@@ -49,10 +110,10 @@ class FileFinder:
                 i = j + 2
             else:
                 # match within the dir
-                regex += '[^\/]*'
+                regex += '[^/]*'
                 i = j + 1
         regex += re.escape(wildcard[i:])
-        regex += "($|\/)"
+        regex += "(?:$|/)"
         return regex
 
     def add_filter(self, root_path, what, include = True):
@@ -68,6 +129,7 @@ class FileFinder:
         if wildcard_part is not None and len(wildcard_part) > 0:
             wildcard_regex = self.build_wildcard_regex(wildcard_part)
             shared_part_dir.wildcards.append(FileFinderWildcard(wildcard_regex, include, self.next_rule_id))
+            shared_part_dir.matcher = None
         elif include:
             shared_part_dir.include = self.next_rule_id
         else:
@@ -82,19 +144,26 @@ class FileFinder:
             if line[:2] == "- ":
                 self.add_filter(root_path, line[2:], False)
 
-    @staticmethod
-    def _process_simple_dir(root_path, path, wildcards, include_id, exclude_id, file_cb, dir_cb):
-        dir_cb(path)
-        for e in os.scandir(os.path.join(root_path, path)):
+    def _process_simple_dir(self, root_path, path, wildcards, include_id, exclude_id, file_cb, dir_cb, dir_done_cb,
+                            entry):
+        dir_cb(path, entry)
+        entries = []
+        for e in self._scanner.scandir(os.path.join(root_path, path)):
             e_path = os.path.join(path, e.name)
             e_include_id, e_exclude_id = FileFinder._process_wildcards(e_path, wildcards, include_id, exclude_id)
             if e_include_id <= e_exclude_id:
                 continue
+            entries.append((e_path, not e.is_symlink() and e.is_dir(), e))
+        self._scanner.prefetch(os.path.join(root_path, e_path) for e_path, is_dir, e in entries if is_dir)
 
-            if not e.is_symlink() and e.is_dir():
-                FileFinder._process_simple_dir(root_path, e_path, wildcards, include_id, exclude_id, file_cb, dir_cb)
+        for e_path, is_dir, e in entries:
+            if is_dir:
+                self._process_simple_dir(root_path, e_path, wildcards, include_id, exclude_id, file_cb, dir_cb,
+                                         dir_done_cb, e)
             else:
-                file_cb(e_path)
+                file_cb(e_path, e)
+        if dir_done_cb is not None:
+            dir_done_cb(path)
 
     @staticmethod
     def _process_parent_dirs(dstack, path, dir_cb):
@@ -106,50 +175,145 @@ class FileFinder:
             call_vals.append(path)
             dstack[-idx - 1] = (d, True)
         for val in reversed(call_vals):
-            dir_cb(val)
+            dir_cb(val, None)
 
+    # wildcards holds (offset of the path relative to the dir of the rules, FileFinderMatcher). Only the highest
+    # rule id matters, include_id or exclude_id is raised to the id of the winning rule when it's higher.
     @staticmethod
     def _process_wildcards(dpath, wildcards, include_id, exclude_id):
-        for (wlen, w) in wildcards:
-            if max(w.include, w.exclude) < max(include_id, exclude_id):
+        for (wlen, matcher) in wildcards:
+            if matcher.max_id < max(include_id, exclude_id):
                 continue
-            if w.regex.match(dpath[wlen:]):
-                include_id = max(include_id, w.include)
-                exclude_id = max(exclude_id, w.exclude)
+            rule = matcher.match(dpath[wlen:])
+            if rule is not None:
+                include_id = max(include_id, rule[0])
+                exclude_id = max(exclude_id, rule[1])
         return include_id, exclude_id
 
-    def _process(self, d, dstack, root_path, dpath, include_id, exclude_id, wildcards, file_cb, dir_cb):
+    def _process(self, d, dstack, root_path, dpath, include_id, exclude_id, wildcards, file_cb, dir_cb, dir_done_cb):
         full_path = os.path.join(root_path, dpath)
         if not os.path.exists(full_path) or os.path.islink(full_path):
             return
         include_id = max(include_id, d.include)
         exclude_id = max(exclude_id, d.exclude)
-        wildcards = wildcards + list(map(lambda w: (len(dpath) + 1, w), d.wildcards))
+        if d.wildcards:
+            wildcards = wildcards + [(len(dpath) + 1, d.get_matcher())]
         include_id, exclude_id = self._process_wildcards(dpath, wildcards, include_id, exclude_id)
         if include_id > exclude_id:
             # include this dir
             self._process_parent_dirs(dstack, dpath, dir_cb)
-            dir_cb(dpath)
-            for e in os.scandir(full_path):
+            dir_cb(dpath, None)
+            entries = []
+            for e in self._scanner.scandir(full_path):
                 e_path = os.path.join(dpath, e.name)
-                if not e.is_symlink() and e.is_dir() and e.name in d.subdirs:
-                    self._process(d.subdirs[e.name], dstack, root_path, e_path,
-                                  include_id, exclude_id, wildcards, file_cb, dir_cb)
+                is_dir = not e.is_symlink() and e.is_dir()
+                if is_dir and e.name in d.subdirs:
+                    entries.append((e_path, e, is_dir, d.subdirs[e.name], include_id, exclude_id))
                     continue
                 e_include_id, e_exclude_id = self._process_wildcards(e_path, wildcards, include_id, exclude_id)
                 if e_include_id <= e_exclude_id:
                     continue
+                entries.append((e_path, e, is_dir, None, e_include_id, e_exclude_id))
+            self._scanner.prefetch(os.path.join(root_path, e[0]) for e in entries if e[2] and e[3] is None)
 
-                if not e.is_symlink() and e.is_dir():
-                    self._process_simple_dir(root_path, e_path, wildcards, e_include_id, e_exclude_id, file_cb, dir_cb)
+            for e_path, e, is_dir, subdir, e_include_id, e_exclude_id in entries:
+                if subdir is not None:
+                    self._process(subdir, dstack, root_path, e_path,
+                                  include_id, exclude_id, wildcards, file_cb, dir_cb, dir_done_cb)
+                elif is_dir:
+                    self._process_simple_dir(root_path, e_path, wildcards, e_include_id, e_exclude_id, file_cb, dir_cb,
+                                             dir_done_cb, e)
                 else:
-                    file_cb(e_path)
+                    file_cb(e_path, e)
+            if dir_done_cb is not None:
+                dir_done_cb(dpath)
         else:
             dstack.append((d, False))
             for sname, sd in d.subdirs.items():
                 self._process(sd, dstack, root_path, os.path.join(dpath, sname),
-                              include_id, exclude_id, wildcards, file_cb, dir_cb)
+                              include_id, exclude_id, wildcards, file_cb, dir_cb, dir_done_cb)
             dstack.pop()
 
-    def process(self, root_path, file_cb, dir_cb):
-        self._process(self.root_dir, [], root_path, "", -1, -1, [], file_cb, dir_cb)
+    # Follows the walk down to path, which is relative to the root of the rules. Returns None when the walk
+    # doesn't pass path to the callbacks as a scanned entry. Otherwise returns (FileFinderDir, wildcards,
+    # include_id, exclude_id): the FileFinderDir is set for the dirs named by the rules, the ids are the ones
+    # _process_simple_dir gets for the other dirs.
+    def _find_rule_state(self, path, is_dir):
+        d = self.root_dir
+        include_id = max(-1, d.include)
+        exclude_id = max(-1, d.exclude)
+        wildcards = [(1, d.get_matcher())] if d.wildcards else []
+        include_id, exclude_id = self._process_wildcards("", wildcards, include_id, exclude_id)
+        # the ids a dir outside of the rule dirs passes to its subdirs
+        simple_ids = None
+        names = path.split('/') if path else []
+        dpath = ""
+        for i, name in enumerate(names):
+            e_path = os.path.join(dpath, name)
+            e_is_dir = is_dir or i < len(names) - 1
+            if d is not None and e_is_dir and name in d.subdirs:
+                d = d.subdirs[name]
+                include_id = max(include_id, d.include)
+                exclude_id = max(exclude_id, d.exclude)
+                if d.wildcards:
+                    wildcards = wildcards + [(len(e_path) + 1, d.get_matcher())]
+                include_id, exclude_id = self._process_wildcards(e_path, wildcards, include_id, exclude_id)
+            else:
+                if include_id <= exclude_id:
+                    # the parent isn't scanned
+                    return None
+                base_ids = simple_ids if simple_ids is not None else (include_id, exclude_id)
+                include_id, exclude_id = self._process_wildcards(e_path, wildcards, *base_ids)
+                if d is not None:
+                    simple_ids = (include_id, exclude_id)
+                d = None
+            dpath = e_path
+        if include_id <= exclude_id:
+            return None
+        if simple_ids is not None:
+            include_id, exclude_id = simple_ids
+        return d, wildcards, include_id, exclude_id
+
+    def is_rule_dir(self, path):
+        d = self.root_dir
+        for name in path.split('/') if path else []:
+            d = d.subdirs.get(name, None)
+            if d is None:
+                return False
+        return True
+
+    # Returns whether the walk passes path to the callbacks as a scanned entry
+    def is_included(self, path, is_dir):
+        return self._find_rule_state(path, is_dir) is not None
+
+    # Walks the included dir at path like process does. Returns False when path is named by the rules or its
+    # parents, those are only walked by process.
+    def process_dir(self, root_path, path, file_cb, dir_cb, dir_done_cb=None, entry=None):
+        state = self._find_rule_state(path, True)
+        if state is None:
+            return True
+        d, wildcards, include_id, exclude_id = state
+        if d is not None:
+            return False
+        self._scanner = _DirScanner(0, 0)
+        try:
+            self._process_simple_dir(root_path, path, wildcards, include_id, exclude_id, file_cb, dir_cb, dir_done_cb,
+                                     entry)
+        finally:
+            self._scanner.close()
+            self._scanner = None
+        return True
+
+    # file_cb and dir_cb get the path and the os.DirEntry from the scan of the parent, which caches the stat
+    # results. It is None for the dirs named by the rules and their parents. dir_done_cb is called once all the
+    # entries of a scanned dir were passed to the callbacks. The parents of included paths are only passed to
+    # dir_cb, they are not scanned.
+    # With scan_threads, the subdirs of a scanned dir are listed ahead by a pool of threads, at most
+    # max_prefetch of them at a time. The callbacks are still called on the calling thread, in the same order.
+    def process(self, root_path, file_cb, dir_cb, dir_done_cb=None, scan_threads=0, max_prefetch=256):
+        self._scanner = _DirScanner(scan_threads, max_prefetch)
+        try:
+            self._process(self.root_dir, [], root_path, "", -1, -1, [], file_cb, dir_cb, dir_done_cb)
+        finally:
+            self._scanner.close()
+            self._scanner = None
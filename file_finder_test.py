@@ -0,0 +1,108 @@
+import unittest
+import os
+import random
+import tempfile
+
+from file_finder import FileFinder, FileFinderMatcher
+
+class FileFinderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmpdir.name)
+        for i in range(5):
+            for j in range(5):
+                path = os.path.join(self.root, f"d{i}", f"e{j}")
+                os.makedirs(path)
+                for name in ('a.txt', 'b.log'):
+                    with open(os.path.join(path, name), 'w') as fh:
+                        fh.write(name)
+        os.symlink('d0', os.path.join(self.root, 'link'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def walk(self, rules, **kwargs):
+        file_finder = FileFinder()
+        file_finder.add_from_text(self.root, rules)
+        calls = []
+
+        def on_entry(kind, path, entry):
+            # the files come with their DirEntry, the dirs named by the rules don't
+            if kind == 'file':
+                self.assertIsNotNone(entry)
+            if entry is not None:
+                self.assertEqual(entry.name, os.path.basename(path))
+            calls.append((kind, path))
+
+        file_finder.process('/', lambda path, entry: on_entry('file', path, entry),
+                            lambda path, entry: on_entry('dir', path, entry), lambda path: calls.append(('done', path)),
+                            **kwargs)
+        return [(kind, os.path.relpath('/' + path, self.root)) for kind, path in calls]
+
+    def test_rules(self):
+        calls = self.walk(['+ .', '- d1', '- **.log', '+ d1/e2', '+ d2/**.log'])
+        files = [path for kind, path in calls if kind == 'file']
+        self.assertIn('d0/e0/a.txt', files)
+        self.assertNotIn('d0/e0/b.log', files)
+        self.assertNotIn('d1/e0/a.txt', files)
+        self.assertIn('d1/e2/a.txt', files)
+        self.assertIn('d2/e4/b.log', files)
+        self.assertIn('link', files)
+
+    def test_parallel_order(self):
+        rules = ['+ d0', '+ d2/**', '- d2/e1', '+ d3/e3', '- **.log']
+        calls = self.walk(rules)
+        self.assertEqual(self.walk(rules, scan_threads=4, max_prefetch=3), calls)
+        seen = set()
+        for kind, path in calls:
+            if kind != 'done' and os.path.dirname(path) not in ('', '..'):
+                self.assertIn(os.path.dirname(path), seen)
+            seen.add(path)
+
+    def test_is_included(self):
+        rules = ['+ d0', '- d0/e1', '+ d0/e1/*.txt', '+ d2/**', '- d2/e1', '+ d3/e3', '- **.log', '+ d4/*/b.log']
+        calls = self.walk(rules)
+        scanned = {path for kind, path in calls if kind in ('file', 'done')}
+        file_finder = FileFinder()
+        file_finder.add_from_text(self.root, rules)
+        prefix = self.root.lstrip('/')
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.relpath(os.path.join(dirpath, name), self.root)
+                is_dir = name in dirnames and not os.path.islink(os.path.join(dirpath, name))
+                self.assertEqual(file_finder.is_included(os.path.join(prefix, path), is_dir), path in scanned, path)
+
+        # a dir outside of the rule dirs is walked the same way on its own
+        sub_calls = []
+        self.assertTrue(file_finder.process_dir('/', os.path.join(prefix, 'd2/e3'),
+                                                lambda path, entry: sub_calls.append(('file', path)),
+                                                lambda path, entry: sub_calls.append(('dir', path)),
+                                                lambda path: sub_calls.append(('done', path))))
+        sub_calls = [(kind, os.path.relpath('/' + path, self.root)) for kind, path in sub_calls]
+        start = calls.index(('dir', 'd2/e3'))
+        self.assertEqual(calls[start:start + len(sub_calls)], sub_calls)
+        self.assertFalse(file_finder.process_dir('/', os.path.join(prefix, 'd3/e3'), None, None))
+
+    def test_matcher(self):
+        rnd = random.Random(1)
+        names = ['a', 'b', 'cache', 'x.log', 'y.txt']
+        file_finder = FileFinder()
+        for i in range(200):
+            parts = [rnd.choice(names + ['*', '**', '*.log']) for j in range(rnd.randint(1, 3))]
+            file_finder.add_filter('/', '/root/' + '/'.join(parts), rnd.random() < 0.5)
+        wildcards = file_finder.get_dir('/root').wildcards
+        matcher = FileFinderMatcher(wildcards)
+        for i in range(1000):
+            path = '/'.join(rnd.choice(names) for j in range(rnd.randint(1, 4)))
+            matching = [w for w in wildcards if w.regex.match(path)]
+            rule = matcher.match(path)
+            if not matching:
+                self.assertIsNone(rule)
+                continue
+            winner = max(matching, key=lambda w: max(w.include, w.exclude))
+            self.assertEqual(rule, (winner.include, winner.exclude))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+from util import *
+
+class HashCache:
+    def __init__(self, file_path, max_entries=1000000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.unneeded_records = 0
+        self.append_handle = None
+        # (dev, inode) -> (size, mtime_ns, ctime_ns, sha256), ordered from the least recently used
+        self.entries = {}
+        self.load()
+
+    @staticmethod
+    def _encode(key, value):
+        buf = bytearray()
+        encode_varint(buf, key[0])
+        encode_varint(buf, key[1])
+        encode_varint(buf, value[0])
+        encode_varint(buf, value[1])
+        encode_varint(buf, value[2])
+        encode_varint(buf, len(value[3]))
+        buf += value[3]
+        return buf
+
+    @staticmethod
+    def _decode(buf, pos):
+        dev, pos = decode_varint_buffer(buf, pos)
+        ino, pos = decode_varint_buffer(buf, pos)
+        size, pos = decode_varint_buffer(buf, pos)
+        mtime, pos = decode_varint_buffer(buf, pos)
+        ctime, pos = decode_varint_buffer(buf, pos)
+        sha256, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+        return (dev, ino), (size, mtime, ctime, sha256), pos
+
+    def load(self):
+        if self.file_path is None or not os.path.exists(self.file_path):
+            return
+        self._close_append_handle()
+        self.entries = {}
+        self.unneeded_records = 0
+        with open(self.file_path, 'rb') as file:
+            data = file.read()
+        pos = 0
+        while pos < len(data):
+            try:
+                key, value, pos = self._decode(data, pos)
+            except EOFError as e:
+                print('Hash cache is truncated', file=sys.stderr)
+                break
+            if self.entries.pop(key, None) is not None:
+                self.unneeded_records += 1
+            self.entries[key] = value
+        self._evict()
+        self._maybe_compact()
+
+    def close(self):
+        self._close_append_handle()
+        self.file_path = None
+
+    def _close_append_handle(self):
+        if self.append_handle is not None:
+            self.append_handle.close()
+            self.append_handle = None
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+            self.unneeded_records += 1
+
+    def _maybe_compact(self):
+        if self.unneeded_records >= max(len(self.entries), 10000):
+            self.rewrite()
+
+    def rewrite(self):
+        self._close_append_handle()
+        self.unneeded_records = 0
+        with open(self.file_path + ".tmp", 'wb') as file:
+            for k, v in self.entries.items():
+                file.write(self._encode(k, v))
+        os.rename(self.file_path + ".tmp", self.file_path)
+
+    @staticmethod
+    def _key(stat):
+        return stat.st_dev, stat.st_ino
+
+    def get(self, stat):
+        key = self._key(stat)
+        value = self.entries.pop(key, None)
+        if value is None:
+            return None
+        # keep the entry as the most recently used one, even when it's no longer valid
+        self.entries[key] = value
+        if value[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns):
+            return None
+        return value[3]
+
+    def put(self, stat, sha256):
+        if stat.st_mtime_ns < 0 or stat.st_ctime_ns < 0:
+            return
+        key = self._key(stat)
+        value = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, sha256)
+        if self.entries.pop(key, None) is not None:
+            self.unneeded_records += 1
+        self.entries[key] = value
+        self._evict()
+        if self.file_path is None:
+            return
+        if self.append_handle is None:
+            self.append_handle = open(self.file_path, 'ab')
+        self.append_handle.write(self._encode(key, value))
+        self._maybe_compact()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import tempfile
+import types
+
+from hash_cache import HashCache
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmpdir.name, 'cache.bin')
+        self.file_path = os.path.join(self.tmpdir.name, 'file.txt')
+        with open(self.file_path, 'w') as fh:
+            fh.write('test')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_simple(self):
+        cache = HashCache(self.cache_path)
+        st = os.stat(self.file_path)
+        self.assertIsNone(cache.get(st))
+        cache.put(st, b'1234')
+        self.assertEqual(cache.get(st), b'1234')
+        cache.close()
+
+        cache = HashCache(self.cache_path)
+        self.assertEqual(cache.get(st), b'1234')
+        with open(self.file_path, 'a') as fh:
+            fh.write('modified')
+        self.assertIsNone(cache.get(os.stat(self.file_path)))
+        cache.close()
+
+    def test_eviction(self):
+        cache = HashCache(self.cache_path, 2)
+        stats = [types.SimpleNamespace(st_dev=1, st_ino=i, st_size=1, st_mtime_ns=i, st_ctime_ns=i) for i in range(3)]
+        for i, s in enumerate(stats):
+            cache.put(s, bytes([i]))
+        self.assertIsNone(cache.get(stats[0]))
+        self.assertEqual(cache.get(stats[1]), b'\x01')
+        cache.put(stats[0], b'\x00')
+        self.assertIsNone(cache.get(stats[2]))
+        cache.close()
+
+        # only the writes are persisted, so the entry which was read last is the one evicted
+        cache = HashCache(self.cache_path, 2)
+        self.assertEqual(cache.get(stats[0]), b'\x00')
+        self.assertIsNone(cache.get(stats[1]))
+        self.assertEqual(cache.get(stats[2]), b'\x02')
+        cache.rewrite()
+        cache.close()
+
+        cache = HashCache(self.cache_path, 2)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.unneeded_records, 0)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import collections
+import concurrent.futures
+import queue
+import sys
+import util
+
+class HashPool:
+    def __init__(self, workers, memory_limit, buffer_size=1024 * 1024, max_pending=None):
+        # every running job holds one buffer, so the memory limit also caps the concurrency
+        buffer_size = max(4096, min(buffer_size, memory_limit))
+        buffer_count = max(1, min(workers, memory_limit // buffer_size))
+        self.buffers = queue.SimpleQueue()
+        for i in range(buffer_count):
+            self.buffers.put(bytearray(buffer_size))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=buffer_count)
+        self.max_pending = max_pending if max_pending is not None else buffer_count * 16
+        self.pending = collections.deque()
+
+    def _hash_file(self, path):
+        b = self.buffers.get()
+        try:
+            with open(path, 'rb') as fh:
+                return util.sha256_file(fh, b)
+        finally:
+            self.buffers.put(b)
+
+    # Queues path for hashing. The callbacks are invoked on the calling thread, in submission order,
+    # with the digest of the file. Passing None as the path only queues the callback behind the
+    # previously submitted files.
+    def submit(self, path, callback):
+        future = None
+        if path is not None:
+            future = self.executor.submit(self._hash_file, path)
+        self.pending.append((path, future, callback))
+        while len(self.pending) > self.max_pending:
+            self._complete_next()
+        self.poll()
+
+    def _complete_next(self):
+        path, future, callback = self.pending.popleft()
+        digest = None
+        if future is not None:
+            try:
+                digest = future.result()
+            except OSError as e:
+                print(f"Error opening {path} for SHA256 calculation: {e}", file=sys.stderr)
+                return
+        callback(digest)
+
+    def poll(self):
+        while len(self.pending) > 0:
+            future = self.pending[0][1]
+            if future is not None and not future.done():
+                return
+            self._complete_next()
+
+    def drain(self):
+        while len(self.pending) > 0:
+            self._complete_next()
+
+    def close(self):
+        self.drain()
+        self.executor.shutdown()
@@ -0,0 +1,126 @@
+import unittest
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import util
+from hash_pool import HashPool
+
+class HashPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sha256_file = util.sha256_file
+        # the hashing of a file waits until its event is set
+        self.events = {}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.buffer_sizes = set()
+
+    def tearDown(self):
+        util.sha256_file = self.sha256_file
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+    def block_hashing(self):
+        def sha256_file(fh, b):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                self.buffer_sizes.add(len(b))
+            try:
+                self.assertTrue(self.events[os.path.basename(fh.name)].wait(5))
+                return self.sha256_file(fh, b)
+            finally:
+                with self.lock:
+                    self.running -= 1
+        util.sha256_file = sha256_file
+
+    def wait_running(self, count):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.running == count:
+                    return
+            time.sleep(0.01)
+        self.fail(f"{self.running} jobs running instead of {count}")
+
+    def test_order(self):
+        paths = [self.write(name, name.encode()) for name in ('a', 'b', 'c')]
+        self.events = {name: threading.Event() for name in ('a', 'b', 'c')}
+        self.block_hashing()
+        pool = HashPool(3, 100 * 1024 * 1024)
+        result = []
+        pool.submit(paths[0], lambda digest: result.append(('a', digest)))
+        pool.submit(None, lambda digest: result.append((None, digest)))
+        pool.submit(paths[1], lambda digest: result.append(('b', digest)))
+        pool.submit(paths[2], lambda digest: result.append(('c', digest)))
+        self.wait_running(3)
+        # the later files are done first, their callbacks wait for the first one
+        for name in ('c', 'b'):
+            self.events[name].set()
+        self.wait_running(1)
+        pool.poll()
+        self.assertEqual(result, [])
+        self.events['a'].set()
+        pool.close()
+        self.assertEqual(result, [('a', hashlib.sha256(b'a').digest()), (None, None),
+                                  ('b', hashlib.sha256(b'b').digest()), ('c', hashlib.sha256(b'c').digest())])
+
+    def test_memory_limit(self):
+        names = [str(i) for i in range(6)]
+        paths = [self.write(name, b'data') for name in names]
+        self.events = {name: threading.Event() for name in names}
+        self.block_hashing()
+        # 3 buffers fit in the limit, they cap the 8 workers
+        pool = HashPool(8, 3 * 65536 + 1000, buffer_size=65536)
+        for path in paths:
+            pool.submit(path, lambda digest: None)
+        self.wait_running(3)
+        time.sleep(0.1)
+        self.assertEqual(self.running, 3)
+        for event in self.events.values():
+            event.set()
+        pool.close()
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(self.buffer_sizes, {65536})
+
+        # a limit below the buffer size still allows one job with a smaller buffer
+        self.max_running = 0
+        self.buffer_sizes = set()
+        pool = HashPool(4, 10000)
+        for path in paths:
+            pool.submit(path, lambda digest: None)
+        pool.close()
+        self.assertEqual(self.max_running, 1)
+        self.assertEqual(self.buffer_sizes, {10000})
+
+    def test_error(self):
+        path = self.write('a', b'a')
+        pool = HashPool(2, 100 * 1024 * 1024)
+        result = []
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            pool.submit(os.path.join(self.tmpdir.name, 'missing'), lambda digest: result.append('missing'))
+            pool.submit(path, lambda digest: result.append(digest))
+            pool.submit(None, lambda digest: result.append(digest))
+            deadline = time.monotonic() + 5
+            while len(result) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+                pool.poll()
+        self.assertEqual(result, [hashlib.sha256(b'a').digest(), None])
+        self.assertIn('missing', stderr.getvalue())
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+# Linux inotify through ctypes. Only dirs are watched, the events name their entries.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+DIR_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+class Inotify:
+    def __init__(self):
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def add_watch(self, full_path, mask=DIR_EVENTS):
+        return _check(_get_libc().inotify_add_watch(self.fd, os.fsencode(full_path), mask))
+
+    def rm_watch(self, wd):
+        _check(_get_libc().inotify_rm_watch(self.fd, wd))
+
+    # Returns a list of (wd, mask, cookie, name), waits up to timeout seconds for the first event
+    def read_events(self, timeout=None):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        ret = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            ret.append((wd, mask, cookie, name))
+        return ret
+
+
+# Watches a set of dirs given by their paths relative to root_dir, and collects the paths of the changed
+# entries in them
+class DirWatcher:
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.inotify = Inotify()
+        self.wd_paths = {}
+        self.path_wds = {}
+        self.overflowed = False
+        self.warned_limit = False
+
+    def close(self):
+        self.inotify.close()
+
+    def add(self, path):
+        if path in self.path_wds:
+            return
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.root_dir, path))
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # the changes in the unwatched dirs are found by the full rescans
+                if not self.warned_limit:
+                    print("Too many watched dirs, raise fs.inotify.max_user_watches", file=sys.stderr)
+                    self.warned_limit = True
+            elif e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise
+            return
+        old_path = self.wd_paths.get(wd, None)
+        if old_path is not None:
+            # the same dir under another path, it was moved
+            self.path_wds.pop(old_path, None)
+        self.wd_paths[wd] = path
+        self.path_wds[path] = wd
+
+    # Stops watching the dir at path and the ones under it
+    def remove_tree(self, path):
+        prefix = path + '/'
+        for watched_path in [p for p in self.path_wds if p == path or p.startswith(prefix)]:
+            wd = self.path_wds.pop(watched_path)
+            self.wd_paths.pop(wd, None)
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                pass
+
+    # Adds the changed paths to changed, returns False when no event came within timeout. self.overflowed is
+    # set when the kernel dropped events.
+    def read_changes(self, changed, timeout):
+        events = self.inotify.read_events(timeout)
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            dir_path = self.wd_paths.get(wd, None)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                self.wd_paths.pop(wd, None)
+                if self.path_wds.get(dir_path, None) == wd:
+                    self.path_wds.pop(dir_path)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # the parent may not be watched, its new path isn't known
+                self.remove_tree(dir_path)
+                changed.add(dir_path)
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_DELETE):
+                self.remove_tree(path)
+            changed.add(path)
+        return len(events) > 0
@@ -0,0 +1,44 @@
+import unittest
+import os
+import tempfile
+
+from inotify import DirWatcher
+
+class DirWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        self.watcher = DirWatcher(self.root)
+        for path in ('', 'a', 'a/b'):
+            self.watcher.add(path)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmpdir.cleanup()
+
+    def read_all(self):
+        changed = set()
+        while self.watcher.read_changes(changed, 0.1):
+            pass
+        return changed
+
+    def test_changes(self):
+        with open(os.path.join(self.root, 'a', 'b', 'file'), 'w') as fh:
+            fh.write('data')
+        os.mkdir(os.path.join(self.root, 'c'))
+        self.assertEqual(self.read_all(), {'a/b/file', 'c'})
+
+        os.rename(os.path.join(self.root, 'a'), os.path.join(self.root, 'moved'))
+        self.assertEqual(self.read_all(), {'a', 'moved'})
+        # the watches of the moved dirs are dropped, the new paths are added by the walk of the moved dir
+        self.assertEqual(set(self.watcher.path_wds), {''})
+        with open(os.path.join(self.root, 'moved', 'b', 'other'), 'w') as fh:
+            fh.write('data')
+        self.assertEqual(self.read_all(), set())
+        self.assertFalse(self.watcher.overflowed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import json
+from util import *
+
+# Binary framing used after both sides agree on the 'binary' feature in getdb. Every command is sent as
+# a varint length followed by the payload: varint op and the op fields, encoded according to OPS. The
+# file data of uploads follows the frame, like it follows the JSON line in the text protocol.
+# With the 'acks' feature, the commands also carry a varint sequence number after the op and the server
+# replies are sent as frames as well, interleaved with OP_ACK frames.
+
+OP_JSON = 0 # payload is a JSON-encoded command, used for the ops which don't have a binary encoding
+OP_UPLOAD = 1
+OP_MKDIR = 2
+OP_SYMLINK = 3
+OP_DELETE = 4
+OP_SIGNATURE = 5
+OP_UPLOAD_DELTA = 6
+OP_SYNC = 7 # asks the server to acknowledge all the previous commands immediately
+OP_ACK = 8 # sent by the server, all commands up to seq were processed, the ones listed in errors failed
+OP_BUNDLE = 9 # small files sent together with their data inside the frame
+OP_UPLOAD_COMPRESSED = 10 # followed by length-prefixed chunks of compressed file data, ending with an empty one
+OP_HAVE = 11 # creates the file from content already on the server, the seq is listed in the ack as missing if not
+OP_SETMETA = 12 # updates the stat and xattrs of a file whose content didn't change, fails if the sha256 differs
+
+OPS = {
+    OP_UPLOAD: ('upload', (('path', 'str'), ('stat', 'stat'), ('size', 'uint'), ('xattrs', 'xattrs'))),
+    OP_MKDIR: ('mkdir', (('path', 'str'), ('stat', 'stat'), ('xattrs', 'xattrs'))),
+    OP_SYMLINK: ('symlink', (('path', 'str'), ('to', 'str'), ('stat', 'stat'), ('xattrs', 'xattrs'))),
+    OP_DELETE: ('delete', (('path', 'str'),)),
+    OP_SIGNATURE: ('signature', (('path', 'str'),)),
+    OP_UPLOAD_DELTA: ('upload_delta', (('path', 'str'), ('stat', 'stat'), ('size', 'uint'), ('block_size', 'uint'),
+                                       ('xattrs', 'xattrs'))),
+    OP_SYNC: ('sync', ()),
+    OP_ACK: ('ack', (('seq', 'uint'), ('errors', 'errors'), ('missing', 'uints'))),
+    OP_BUNDLE: ('bundle', (('files', 'files'),)),
+    OP_UPLOAD_COMPRESSED: ('upload_compressed', (('path', 'str'), ('stat', 'stat'), ('size', 'uint'),
+                                                 ('xattrs', 'xattrs'))),
+    OP_HAVE: ('have', (('path', 'str'), ('stat', 'stat'), ('size', 'uint'), ('sha256', 'bytes'), ('xattrs', 'xattrs'))),
+    OP_SETMETA: ('setmeta', (('path', 'str'), ('stat', 'stat'), ('sha256', 'bytes'), ('xattrs', 'xattrs'))),
+}
+OP_IDS = {name: op for op, (name, fields) in OPS.items()}
+
+STAT_FIELDS = (('mode', 'uint'), ('uid', 'uint'), ('gid', 'uint'), ('atime', 'int'), ('mtime', 'int'))
+# errors are (seq, index, message), index is the position of the failed file within a bundle and 0 otherwise
+ERROR_FIELDS = (('seq', 'uint'), ('index', 'uint'), ('message', 'str'))
+BUNDLE_FILE_FIELDS = (('path', 'str'), ('stat', 'stat'), ('xattrs', 'xattrs'), ('data', 'bytes'))
+
+
+def _encode_field(buf, field_type, val):
+    if field_type == 'uint':
+        encode_varint(buf, val)
+    elif field_type == 'int':
+        encode_signed_varint(buf, val)
+    elif field_type == 'str':
+        val = val.encode()
+        encode_varint(buf, len(val))
+        buf += val
+    elif field_type == 'bytes':
+        encode_varint(buf, len(val))
+        buf += val
+    elif field_type == 'stat':
+        for name, stat_type in STAT_FIELDS:
+            _encode_field(buf, stat_type, val[name])
+    elif field_type == 'xattrs':
+        encode_varint(buf, len(val))
+        for k, v in val:
+            _encode_field(buf, 'bytes', k)
+            _encode_field(buf, 'bytes', v)
+    elif field_type == 'uints':
+        encode_varint(buf, len(val))
+        for v in val:
+            encode_varint(buf, v)
+    elif field_type == 'errors':
+        encode_varint(buf, len(val))
+        for error in val:
+            for (name, error_type), v in zip(ERROR_FIELDS, error):
+                _encode_field(buf, error_type, v)
+    elif field_type == 'files':
+        encode_varint(buf, len(val))
+        for file in val:
+            for name, file_type in BUNDLE_FILE_FIELDS:
+                _encode_field(buf, file_type, file[name])
+    else:
+        raise ValueError('Invalid field type: ' + field_type)
+
+def _decode_field(buf, pos, field_type):
+    if field_type == 'uint':
+        return decode_varint_buffer(buf, pos)
+    if field_type == 'int':
+        return decode_signed_varint_buffer(buf, pos)
+    if field_type == 'str':
+        val, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+        return val.decode(), pos
+    if field_type == 'bytes':
+        return decode_varint_prefixed_bytes_buffer(buf, pos)
+    if field_type == 'stat':
+        ret = {}
+        for name, stat_type in STAT_FIELDS:
+            ret[name], pos = _decode_field(buf, pos, stat_type)
+        return ret, pos
+    if field_type == 'xattrs':
+        count, pos = decode_varint_buffer(buf, pos)
+        ret = []
+        for i in range(count):
+            k, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+            v, pos = decode_varint_prefixed_bytes_buffer(buf, pos)
+            ret.append((k, v))
+        return ret, pos
+    if field_type == 'uints':
+        count, pos = decode_varint_buffer(buf, pos)
+        ret = []
+        for i in range(count):
+            v, pos = decode_varint_buffer(buf, pos)
+            ret.append(v)
+        return ret, pos
+    if field_type == 'errors':
+        count, pos = decode_varint_buffer(buf, pos)
+        ret = []
+        for i in range(count):
+            error = []
+            for name, error_type in ERROR_FIELDS:
+                v, pos = _decode_field(buf, pos, error_type)
+                error.append(v)
+            ret.append(tuple(error))
+        return ret, pos
+    if field_type == 'files':
+        count, pos = decode_varint_buffer(buf, pos)
+        ret = []
+        for i in range(count):
+            file = {}
+            for name, file_type in BUNDLE_FILE_FIELDS:
+                file[name], pos = _decode_field(buf, pos, file_type)
+            ret.append(file)
+        return ret, pos
+    raise ValueError('Invalid field type: ' + field_type)
+
+def encode_command(data, seq=None):
+    payload = bytearray()
+    op = OP_IDS.get(data.get('op', None), OP_JSON)
+    encode_varint(payload, op)
+    if seq is not None:
+        encode_varint(payload, seq)
+    if op == OP_JSON:
+        payload += json.dumps(data).encode()
+    else:
+        for name, field_type in OPS[op][1]:
+            _encode_field(payload, field_type, data[name])
+    buf = bytearray()
+    encode_varint(buf, len(payload))
+    buf += payload
+    return buf
+
+def decode_command(payload, has_seq=False):
+    op, pos = decode_varint_buffer(payload, 0)
+    seq = None
+    if has_seq:
+        seq, pos = decode_varint_buffer(payload, pos)
+    if op == OP_JSON:
+        data = json.loads(payload[pos:])
+        if seq is not None:
+            data['seq'] = seq
+        return data
+    if op not in OPS:
+        raise ValueError('Invalid op: ' + str(op))
+    name, fields = OPS[op]
+    data = {'op': name}
+    if seq is not None:
+        data['seq'] = seq
+    for field_name, field_type in fields:
+        data[field_name], pos = _decode_field(payload, pos, field_type)
+    return data
+
+# Returns None on a clean end of the stream
+def read_command(stream, has_seq=False):
+    try:
+        length = decode_varint_stream(stream)
+    except EOFError:
+        return None
+    return decode_command(read_exactly(stream, length), has_seq)
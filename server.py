@@ -1,8 +1,68 @@
+import argparse
+import os
+import signal
 import sys
 from file_db import FileDb
 from sync_server import SyncServer
+from chunk_store import ChunkStore
+from server_daemon import ServerDaemon, connect_daemon, relay
+from util import lock_file
 
-server = SyncServer(sys.stdin.buffer, sys.stdout.buffer, sys.argv[1], FileDb(sys.argv[2]))
+parser = argparse.ArgumentParser(description='Receives a backup')
+parser.add_argument("rootdir", help="directory where the files are stored", nargs='?')
+parser.add_argument("db", help="file db of the stored files", nargs='?')
+parser.add_argument("--chunk-store", help="store the file data deduplicated in this directory, the files in rootdir only keep the metadata")
+parser.add_argument("--zero-copy", help="move uploaded data into the files with splice", action='store_true')
+parser.add_argument("--listen", help="keep running as a daemon taking the sessions on this Unix socket, the dbs stay loaded between them")
+parser.add_argument("--connect", help="hand the session over to the daemon listening on this Unix socket")
+parser.add_argument("--session", help="with --connect, the id shared by the channels of a session, client.py "
+                                      "sets it in $PSY_SESSION", default=os.environ.get('PSY_SESSION'))
+parser.add_argument("--channel", help="with --connect, the session is an extra channel and is refused instead of "
+                                      "waiting while the root is used by another session, client.py sets "
+                                      "$PSY_CHANNEL for them", action='store_true',
+                    default=bool(os.environ.get('PSY_CHANNEL')))
+args = parser.parse_args()
+
+if args.listen:
+    daemon = ServerDaemon(args.listen, zero_copy=args.zero_copy)
+    daemon.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+    sys.exit(0)
+
+if args.rootdir is None or args.db is None:
+    parser.error("rootdir and db are required")
+
+if args.connect:
+    try:
+        sock = connect_daemon(args.connect, args.rootdir, args.db, args.chunk_store, args.zero_copy, args.session,
+                              args.channel)
+    except (OSError, ValueError, EOFError) as e:
+        print(f"Cannot start the session: {e}", file=sys.stderr)
+        sys.exit(1)
+    relay(sock, sys.stdin.buffer, sys.stdout.buffer)
+    sys.exit(0)
+
+try:
+    db_lock = lock_file(args.db + ".lock")
+except BlockingIOError:
+    print(f"{args.db} is used by another server", file=sys.stderr)
+    sys.exit(1)
+server = SyncServer(sys.stdin.buffer, sys.stdout.buffer, args.rootdir, FileDb(args.db))
+server.zero_copy = args.zero_copy
+if args.chunk_store:
+    server.chunk_store = ChunkStore(args.chunk_store)
+    server.filedb.before_commit = server.chunk_store.sync
 # server.allowdelete = True
 while server.read_command():
-    pass
\ No newline at end of file
+    pass
+with server.db_lock:
+    server.filedb.close()
+if server.chunk_store is not None:
+    server.chunk_store.close()
+db_lock.close()
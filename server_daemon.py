@@ -0,0 +1,314 @@
+import json
+import os
+import socket
+import sys
+import threading
+from chunk_store import ChunkStore
+from file_db import FileDb
+from sync_server import SyncServer
+from util import lock_file
+
+# A server which keeps running and takes the sessions of the clients on a Unix socket, so that the dbs stay loaded
+# between the backups. Every connection starts with a handshake: a JSON line naming the root and its db, answered
+# by a JSON line, then the session goes on as with server.py. The sessions of different roots run at the same
+# time, the ones of the same root wait for each other. A client uploading over several channels names its session
+# in the handshake of each of them, the channels of a session share the root. The connections after the first
+# also say they are extra channels, they are refused instead of waiting when the root is used by another session:
+# they would wait forever for the session they belong to.
+
+# The db and the chunk store of a root, opened by the first session and kept open
+class _Root:
+    def __init__(self, rootdir, db_path, chunk_store_path):
+        self.rootdir = rootdir
+        self.db_path = db_path
+        self.chunk_store_path = chunk_store_path
+        # the session using the root and its number of connections
+        self.cond = threading.Condition()
+        self.session = None
+        self.users = 0
+        # held while the db is used, by the servers of all the channels of the session
+        self.db_lock = threading.RLock()
+        self.lock_handle = None
+        self.filedb = None
+        self.chunk_store = None
+
+    # Waits until the root is free or used by the same session, a connection without a session uses it alone.
+    # Without wait, raises ValueError instead of waiting.
+    def enter(self, session, wait=True):
+        with self.cond:
+            while self.users > 0 and (session is None or session != self.session):
+                if not wait:
+                    raise ValueError(f"{self.rootdir} is used by another session, the channel doesn't belong to it")
+                self.cond.wait()
+            self.session = session
+            self.users += 1
+
+    def leave(self):
+        with self.cond:
+            self.users -= 1
+            if self.users == 0:
+                self.session = None
+                self.cond.notify_all()
+
+    # Called after enter()
+    def open(self):
+        with self.db_lock:
+            if self.filedb is not None:
+                return
+            try:
+                self.lock_handle = lock_file(self.db_path + ".lock")
+            except BlockingIOError:
+                raise ValueError(f"{self.db_path} is used by another server")
+            try:
+                self.filedb = FileDb(self.db_path)
+                if self.chunk_store_path is not None:
+                    self.chunk_store = ChunkStore(self.chunk_store_path)
+                    self.filedb.before_commit = self.chunk_store.sync
+            except:
+                self.close()
+                raise
+
+    # Called after enter()
+    def close(self):
+        with self.db_lock:
+            # the db syncs the chunk store before its last commit
+            if self.filedb is not None:
+                self.filedb.close()
+                self.filedb = None
+            if self.chunk_store is not None:
+                self.chunk_store.close()
+                self.chunk_store = None
+            if self.lock_handle is not None:
+                self.lock_handle.close()
+                self.lock_handle = None
+
+class DbRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # real path of the root dir -> _Root
+        self.roots = {}
+
+    # Returns the _Root of rootdir. A root is always served with the same db and chunk store, and a db or chunk
+    # store with the same root.
+    def get(self, rootdir, db_path, chunk_store_path=None):
+        rootdir = os.path.realpath(rootdir)
+        db_path = os.path.realpath(db_path)
+        if chunk_store_path is not None:
+            chunk_store_path = os.path.realpath(chunk_store_path)
+        if not os.path.isdir(rootdir):
+            raise ValueError(f"{rootdir} is not a directory")
+        with self.lock:
+            root = self.roots.get(rootdir, None)
+            if root is None:
+                for other in self.roots.values():
+                    if other.db_path == db_path or (chunk_store_path is not None and
+                                                     other.chunk_store_path == chunk_store_path):
+                        raise ValueError(f"The db or chunk store is already used for {other.rootdir}")
+                root = _Root(rootdir, db_path, chunk_store_path)
+                self.roots[rootdir] = root
+            elif root.db_path != db_path or root.chunk_store_path != chunk_store_path:
+                raise ValueError(f"{rootdir} is served with {root.db_path}")
+        return root
+
+    # Waits for the sessions of every root and closes the dbs
+    def close(self):
+        with self.lock:
+            roots = list(self.roots.values())
+        for root in roots:
+            root.enter(None)
+            try:
+                root.close()
+            finally:
+                root.leave()
+
+
+class ServerDaemon:
+    BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, socket_path, zero_copy=False):
+        self.socket_path = socket_path
+        self.zero_copy = zero_copy
+        self.registry = DbRegistry()
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.threads = []
+        self.listener = None
+        self.stopping = False
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            # left behind by a daemon which is gone, unless one still answers on it
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+            else:
+                raise ValueError(f"A server already listens on {self.socket_path}")
+            finally:
+                probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the owner can connect, like they can run server.py
+        old_umask = os.umask(0o177)
+        try:
+            self.listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(16)
+
+    # Takes connections until stop() is called
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                if self.stopping:
+                    break
+                raise
+            thread = threading.Thread(target=self._serve_connection, args=(conn,), daemon=True)
+            with self.lock:
+                self.connections.add(conn)
+                self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+            thread.start()
+
+    # Ends the sessions and closes the dbs, can be called from another thread or a signal handler
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        if self.listener is not None:
+            # wakes up accept
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            os.remove(self.socket_path)
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+        self.registry.close()
+
+    def _serve_connection(self, conn):
+        inpipe = conn.makefile('rb', buffering=self.BUFFER_SIZE)
+        outpipe = conn.makefile('wb', buffering=self.BUFFER_SIZE)
+        try:
+            line = inpipe.readline()
+            if not line:
+                return
+            try:
+                hello = json.loads(line)
+                session = hello.get('session', None)
+                if session is not None and not isinstance(session, str):
+                    raise ValueError('Invalid session id')
+                root = self.registry.get(hello['rootdir'], hello['db'], hello.get('chunk_store', None))
+            except (ValueError, KeyError, TypeError) as e:
+                self._write_handshake(outpipe, {'error': str(e)})
+                return
+            try:
+                root.enter(session, wait=not hello.get('channel', False))
+            except ValueError as e:
+                self._write_handshake(outpipe, {'error': str(e)})
+                return
+            try:
+                try:
+                    root.open()
+                except (ValueError, EOFError, OSError) as e:
+                    self._write_handshake(outpipe, {'error': str(e)})
+                    return
+                self._write_handshake(outpipe, {'ok': True})
+                self._run_session(root, inpipe, outpipe, hello.get('zero_copy', False))
+            finally:
+                root.leave()
+        except (OSError, EOFError) as e:
+            print(f"Session ended: {e!r}", file=sys.stderr)
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+            for stream in (inpipe, outpipe, conn):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+
+    def _run_session(self, root, inpipe, outpipe, zero_copy):
+        server = SyncServer(inpipe, outpipe, root.rootdir, root.filedb)
+        server.db_lock = root.db_lock
+        server.zero_copy = self.zero_copy or zero_copy
+        server.chunk_store = root.chunk_store
+        try:
+            while server.read_command():
+                pass
+        finally:
+            # the next session may come much later
+            with root.db_lock:
+                root.filedb.flush()
+            if root.chunk_store is not None:
+                root.chunk_store.flush()
+
+    @staticmethod
+    def _write_handshake(outpipe, data):
+        outpipe.write((json.dumps(data) + '\n').encode())
+        outpipe.flush()
+
+
+# Connects to a daemon and sends the handshake for a root. Returns the socket, ready for the session.
+# The connections with the same session id are the channels of one session, channel is set for the ones after
+# the first.
+def connect_daemon(socket_path, rootdir, db_path, chunk_store_path=None, zero_copy=False, session=None,
+                   channel=False):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        hello = {'rootdir': os.path.abspath(rootdir), 'db': os.path.abspath(db_path), 'zero_copy': zero_copy}
+        if chunk_store_path is not None:
+            hello['chunk_store'] = os.path.abspath(chunk_store_path)
+        if session is not None:
+            hello['session'] = session
+        if channel:
+            hello['channel'] = True
+        sock.sendall((json.dumps(hello) + '\n').encode())
+        # the reply is read a byte at a time, what follows belongs to the session
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            b = sock.recv(1)
+            if not b:
+                raise EOFError('The server closed the connection during the handshake')
+            line += b
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+    except:
+        sock.close()
+        raise
+    return sock
+
+# Copies the data between the standard streams and the socket until both sides are done, a client started through
+# ssh talks to the daemon this way
+def relay(sock, inpipe, outpipe, buffer_size=256 * 1024):
+    def copy_input():
+        try:
+            while True:
+                data = os.read(inpipe.fileno(), buffer_size)
+                if not data:
+                    break
+                sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    thread = threading.Thread(target=copy_input, daemon=True)
+    thread.start()
+    while True:
+        data = sock.recv(buffer_size)
+        if not data:
+            break
+        outpipe.write(data)
+        outpipe.flush()
+    sock.close()
@@ -0,0 +1,165 @@
+import unittest
+import os
+import socket
+import tempfile
+import threading
+import types
+
+from channel_pool import ChannelPool
+from server_daemon import ServerDaemon, connect_daemon
+from sync_client import SyncClient
+
+class ServerDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'server.sock')
+        for name in ('src', 'root1', 'root2'):
+            os.mkdir(os.path.join(self.tmpdir.name, name))
+        self.daemon = ServerDaemon(self.socket_path)
+        self.daemon.listen()
+        self.daemon_thread = threading.Thread(target=self.daemon.serve)
+        self.daemon_thread.start()
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.daemon_thread.join()
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def open_client(self, root, session=None, channel=False):
+        sock = connect_daemon(self.socket_path, self.path(root), self.path(root + '.db'), session=session,
+                              channel=channel)
+        proc = types.SimpleNamespace(stdin=sock.makefile('wb'), stdout=sock.makefile('rb'))
+        client = SyncClient(proc)
+        client.sock = sock
+        return client
+
+    def connect(self, root, session=None):
+        client = self.open_client(root, session)
+        server_files = client.get_file_db(None)
+        return client, server_files
+
+    def disconnect(self, client):
+        client.sync()
+        client.close()
+        self.wait_closed(client)
+
+    def wait_closed(self, client):
+        client.sock.shutdown(socket.SHUT_WR)
+        # the server closes its side once the session is done
+        self.assertEqual(client.inpipe.read(), b'')
+        client.inpipe.close()
+        client.sock.close()
+
+    def upload(self, client, name, data):
+        with open(self.path('src/' + name), 'wb') as fh:
+            fh.write(data)
+        fd = os.open(self.path('src/' + name), os.O_RDONLY)
+        try:
+            client.upload_file(name, fd)
+        finally:
+            os.close(fd)
+
+    def test_sessions(self):
+        client, server_files = self.connect('root1')
+        self.upload(client, 'a', b'data')
+        self.disconnect(client)
+        root = self.daemon.registry.get(self.path('root1'), self.path('root1.db'))
+        filedb = root.filedb
+
+        # the db stays loaded for the next session
+        client, server_files = self.connect('root1')
+        self.assertEqual(server_files.get_path('a').size, 4)
+        self.disconnect(client)
+        self.assertIs(root.filedb, filedb)
+        with open(self.path('root1/a'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'data')
+
+    def test_root_lock(self):
+        client1, server_files = self.connect('root1')
+        connected = threading.Event()
+        result = []
+
+        def connect_second():
+            result.append(self.connect('root1'))
+            connected.set()
+
+        thread = threading.Thread(target=connect_second)
+        thread.start()
+        # another root doesn't wait
+        client2, server_files = self.connect('root2')
+        self.upload(client2, 'b', b'other')
+        self.disconnect(client2)
+        self.assertFalse(connected.wait(0.2))
+        self.upload(client1, 'a', b'first')
+        self.disconnect(client1)
+        self.assertTrue(connected.wait(5))
+        thread.join()
+        client3, server_files = result[0]
+        self.assertEqual(server_files.get_path('a').size, 5)
+        self.assertIsNone(server_files.find_path('b'))
+        self.disconnect(client3)
+
+    def test_channels(self):
+        client, server_files = self.connect('root1', session='s1')
+        channels = []
+        for i in range(2):
+            channels.append(self.open_client('root1', session='s1', channel=True))
+            channels[-1].join(client)
+        pool = ChannelPool(client, channels)
+        # another session waits for the channels to be closed
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.connect('root1')))
+        thread.start()
+
+        os.mkdir(self.path('src/dir'))
+        fd = os.open(self.path('src/dir'), os.O_RDONLY)
+        client.mkdir('dir', fd)
+        os.close(fd)
+        pool.submit('dir/a', lambda channel: self.upload(channel, 'dir/a', b'a' * 100000))
+        # the mkdir was acknowledged before the upload was queued
+        self.assertEqual(len(client.inflight), 0)
+        for i in range(10):
+            pool.submit(f'f{i}', lambda channel, i=i: self.upload(channel, f'f{i}', bytes([i]) * 1000))
+        pool.sync()
+        self.assertEqual(pool.take_failures(), [])
+        self.assertEqual(result, [])
+        pool.close()
+        for channel in channels:
+            self.wait_closed(channel)
+        self.disconnect(client)
+
+        thread.join(5)
+        client, server_files = result[0]
+        self.assertEqual(server_files.get_path('dir/a').size, 100000)
+        for i in range(10):
+            self.assertEqual(server_files.get_path(f'f{i}').size, 1000)
+        self.disconnect(client)
+        with open(self.path('root1/dir/a'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'a' * 100000)
+
+    def test_channel_without_session(self):
+        client, server_files = self.connect('root1')
+        # like the command of an extra channel run through ssh without the session id
+        with self.assertRaises(ValueError):
+            self.open_client('root1', channel=True)
+        self.upload(client, 'a', b'data')
+        self.disconnect(client)
+
+    def test_handshake_errors(self):
+        with self.assertRaises(ValueError):
+            connect_daemon(self.socket_path, self.path('missing'), self.path('missing.db'))
+        client, server_files = self.connect('root1')
+        self.disconnect(client)
+        # a db is only used for one root
+        with self.assertRaises(ValueError):
+            connect_daemon(self.socket_path, self.path('root2'), self.path('root1.db'))
+        with self.assertRaises(ValueError):
+            ServerDaemon(self.socket_path).listen()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,54 @@
 import json
+import sys
 import pickle
 import os
-import shutil
+import hashlib
+import time
+import compression
+import errno
+import stat
+import collections
+import threading
+import delta
+import protocol
+from util import *
 from file_db import FileDb, FileDbEntry
 
 class SyncClient:
+    FEATURES = ['delta', 'chunked_getdb', 'incremental_getdb', 'binary', 'acks', 'bundle', 'upload_sha256',
+                'compression', 'have', 'setmeta', 'join']
+    WINDOW = 256
+
     def __init__(self, proc):
         self.proc = proc
         self.inpipe = self.proc.stdout
         self.outpipe = self.proc.stdin
+        self.features = set()
+        self.next_seq = 0
+        # (seq, op, path) of the commands which were not acknowledged yet
+        self.inflight = collections.deque()
+        self.failures = []
+        self.missing = []
+        # With acks, a thread reads the output of the server, so the acks are taken while the commands are written
+        # and the server never blocks on them. A reply is handed to read_reply() and the thread waits until its
+        # caller read the data following it and called end_reply(). The fields above and below are guarded by
+        # the condition.
+        self.cond = threading.Condition()
+        self.reader = None
+        self.reply = None
+        self.reader_error = None
+        self.bundle_size = 1024 * 1024
+        # file data is sent with sendfile when the transport is a pipe or a socket, can't be used together
+        # with the 'upload_sha256' feature, which needs the data to be read
+        self.zero_copy = False
+        self._can_sendfile = None
+        # codecs to request in the order of preference, compression is used only when one of them is known to
+        # the server
+        self.codecs = []
+        self.codec = None
+        self.compression_stats = compression.CompressionStats()
+        self.bundle = []
+        self.bundle_data_size = 0
 
     def read_line(self):
         line = self.inpipe.readline()
@@ -16,13 +56,150 @@ class SyncClient:
             return None
         return line.decode().rstrip('\n')
 
-    def write_command(self, data):
+    # With the binary protocol the commands are only buffered, the buffer is flushed once it fills up or
+    # before waiting for a reply.
+    # With acks, at most WINDOW commands are sent before waiting for the server to acknowledge them.
+    def write_command(self, data, xattrs=None):
+        if self.bundle and data['op'] != 'bundle':
+            # keep the order of the commands
+            self.flush_bundle()
+        if 'binary' in self.features:
+            if xattrs is not None:
+                data['xattrs'] = xattrs
+            seq = None
+            if 'acks' in self.features:
+                if self.reader is None:
+                    self.reader = threading.Thread(target=self._read_output, daemon=True)
+                    self.reader.start()
+                if len(self.inflight) >= self.WINDOW:
+                    self.outpipe.flush()
+                    self._wait_for_acks(self.WINDOW - 1)
+                seq = self.next_seq
+                self.next_seq += 1
+                path = data.get('path', None)
+                if data['op'] == 'bundle':
+                    path = [file['path'] for file in data['files']]
+                with self.cond:
+                    self.inflight.append((seq, data['op'], path))
+            self.outpipe.write(protocol.encode_command(data, seq))
+            return
+        if xattrs is not None:
+            xattr_data = pickle.dumps(xattrs)
+            data['xattr_size'] = len(xattr_data)
         self.outpipe.write((json.dumps(data) + '\n').encode())
+        if xattrs is not None:
+            self.outpipe.write(xattr_data)
         self.outpipe.flush()
 
+    def _end_command(self):
+        if 'binary' not in self.features:
+            self.outpipe.flush()
+
+    # With acks, end_reply() needs to be called once the data following the reply was read
+    def read_reply(self):
+        if 'acks' not in self.features:
+            return json.loads(self.read_line())
+        with self.cond:
+            while self.reply is None:
+                self._check_reader()
+                self.cond.wait()
+            return self.reply
+
+    def end_reply(self):
+        if 'acks' not in self.features:
+            return
+        with self.cond:
+            self.reply = None
+            self.cond.notify_all()
+
+    def _check_reader(self):
+        if self.reader_error is not None:
+            raise self.reader_error
+        if self.reader is None:
+            raise ValueError('No command is waiting for a reply')
+
+    def _read_output(self):
+        try:
+            while True:
+                data = protocol.read_command(self.inpipe)
+                if data is None:
+                    raise EOFError('Server closed the connection')
+                with self.cond:
+                    if data.get('op', None) == 'ack':
+                        self._handle_ack(data)
+                    else:
+                        self.reply = data
+                    self.cond.notify_all()
+                    while self.reply is not None:
+                        self.cond.wait()
+        except Exception as e:
+            with self.cond:
+                self.reader_error = e
+                self.cond.notify_all()
+
+    # Waits until at most count commands are not acknowledged
+    def _wait_for_acks(self, count):
+        with self.cond:
+            while len(self.inflight) > count:
+                self._check_reader()
+                self.cond.wait()
+
+    # Called with the condition held
+    def _handle_ack(self, data):
+        errors = {}
+        for seq, index, message in data['errors']:
+            errors.setdefault(seq, []).append((index, message))
+        missing = set(data['missing'])
+        while self.inflight and self.inflight[0][0] <= data['seq']:
+            seq, op, path = self.inflight.popleft()
+            if seq in missing:
+                self.missing.append(path)
+            for index, message in errors.get(seq, []):
+                if op == 'bundle':
+                    # the files of a bundle are reported as separate uploads
+                    self.failures.append(('upload', path[index], message))
+                else:
+                    self.failures.append((op, path, message))
+
+    # Waits until all the sent commands are processed by the server
+    def sync(self):
+        self.flush_bundle()
+        if 'acks' not in self.features:
+            self.outpipe.flush()
+            return
+        self.write_command({'op': 'sync'})
+        self.outpipe.flush()
+        self._wait_for_acks(0)
+
+    # Returns (op, path, message) of the commands which failed on the server since the last call
+    def take_failures(self):
+        with self.cond:
+            ret = self.failures
+            self.failures = []
+        return ret
+
+    # Returns the paths offered with have() whose content the server didn't find, their data needs to be
+    # uploaded
+    def take_missing(self):
+        with self.cond:
+            ret = self.missing
+            self.missing = []
+        return ret
+
+    # Returns (seq, op, path) of the commands which were not acknowledged yet
+    def unacknowledged(self):
+        with self.cond:
+            return list(self.inflight)
+
+    def close(self):
+        self.flush_bundle()
+        self.outpipe.close()
+
+    # f_stat can be a stat result the caller already has, the file isn't stat'ed again then
     @staticmethod
-    def _get_file_stat(fd, follow_symlinks=True):
-        f_stat = os.stat(fd, follow_symlinks=follow_symlinks)
+    def _get_file_stat(fd, follow_symlinks=True, f_stat=None):
+        if f_stat is None:
+            f_stat = os.stat(fd, follow_symlinks=follow_symlinks)
         stat_data = {'mode': f_stat.st_mode, 'uid': f_stat.st_uid, 'gid': f_stat.st_gid,
                      'atime': f_stat.st_atime_ns, 'mtime': f_stat.st_mtime_ns}
         return stat_data
@@ -37,41 +214,271 @@ class SyncClient:
 
     def mkdir(self, server_filename, fd):
         stat_data = self._get_file_stat(fd)
-        xattr_data = pickle.dumps(self._get_xattrs(fd))
-        self.write_command({'op': 'mkdir', 'path': server_filename, 'stat': stat_data, 'xattr_size': len(xattr_data)})
-        self.outpipe.write(xattr_data)
-        self.outpipe.flush()
+        self.write_command({'op': 'mkdir', 'path': server_filename, 'stat': stat_data}, self._get_xattrs(fd))
+
+    def symlink(self, server_filename, server_to, local_filename, stat_info=None):
+        stat_data = self._get_file_stat(local_filename, False, stat_info)
+        self.write_command({'op': 'symlink', 'path': server_filename, 'to': server_to, 'stat': stat_data},
+                           self._get_xattrs(local_filename, False))
+
+    # Lets the server create the file from the same content stored elsewhere, requires the 'have' feature.
+    # The path is returned by take_missing() when the content isn't there.
+    def have(self, server_filename, fd, sha256, stat_info=None):
+        if stat_info is None:
+            stat_info = os.stat(fd)
+        stat_data = self._get_file_stat(fd, f_stat=stat_info)
+        file_size = stat_info.st_size
+        self.write_command({'op': 'have', 'path': server_filename, 'stat': stat_data, 'size': file_size,
+                            'sha256': sha256}, self._get_xattrs(fd))
+
+    # Sends the new stat and xattrs of a file whose content is still sha256 on the server, requires the 'setmeta'
+    # feature. The command fails on the server when its content differs.
+    def setmeta(self, server_filename, local_filename, sha256, stat_info=None):
+        stat_data = self._get_file_stat(local_filename, f_stat=stat_info)
+        self.write_command({'op': 'setmeta', 'path': server_filename, 'stat': stat_data, 'sha256': sha256},
+                           self._get_xattrs(local_filename))
+        self._end_command()
+
+    # With a negotiated codec, the files which look compressible are sent compressed. stat_info may come from
+    # before the file was opened, a file which got shorter since then is padded with zeros to keep the stream
+    # in sync, the size differs from the recorded one on the next run then.
+    def upload_file(self, server_filename, fd, stat_info=None):
+        if stat_info is None:
+            stat_info = os.stat(fd)
+        stat_data = self._get_file_stat(fd, f_stat=stat_info)
+        file_size = stat_info.st_size
+        compressed = self.codec is not None and compression.is_compressible(fd, file_size)
+        self.write_command({'op': 'upload_compressed' if compressed else 'upload', 'path': server_filename,
+                            'stat': stat_data, 'size': file_size}, self._get_xattrs(fd))
+        if not compressed and 'upload_sha256' not in self.features and self._sendfile(fd, file_size):
+            self._end_command()
+            return
+        hasher = hashlib.sha256()
+        with os.fdopen(os.dup(fd), 'rb') as source:
+            if compressed:
+                self._send_compressed(source, file_size, hasher)
+            else:
+                missing = copy_file_limited(source, self.outpipe, file_size, hasher)
+                self._write_padding(missing, hasher)
+        if 'upload_sha256' in self.features:
+            # lets the server check the data it wrote
+            self.outpipe.write(hasher.digest())
+        self._end_command()
+
+    def _send_compressed(self, source, file_size, hasher):
+        start_cpu_time = time.thread_time()
+        compressor = compression.compressor(self.codec)
+        compressed_size = 0
+        remaining = file_size
+        while True:
+            data = source.read(min(remaining, 1024 * 1024))
+            remaining -= len(data)
+            hasher.update(data)
+            chunk = compressor.compress(data) if data else compressor.flush()
+            if chunk:
+                buf = bytearray()
+                encode_varint(buf, len(chunk))
+                self.outpipe.write(buf)
+                self.outpipe.write(chunk)
+                compressed_size += len(buf) + len(chunk)
+            if not data:
+                break
+        self.outpipe.write(b'\0')
+        self.compression_stats.add(file_size - remaining, compressed_size + 1, start_cpu_time)
+
+    def _write_padding(self, size, hasher=None):
+        while size > 0:
+            chunk = bytes(min(size, 128 * 1024))
+            if hasher is not None:
+                hasher.update(chunk)
+            self.outpipe.write(chunk)
+            size -= len(chunk)
 
-    def symlink(self, server_filename, server_to, local_filename):
-        stat_data = self._get_file_stat(local_filename, False)
-        xattr_data = pickle.dumps(self._get_xattrs(local_filename, False))
-        self.write_command({'op': 'symlink', 'path': server_filename, 'to': server_to,
-                            'stat': stat_data, 'xattr_size': len(xattr_data)})
-        self.outpipe.write(xattr_data)
+    # Returns False when sendfile can't be used and nothing was sent
+    def _sendfile(self, fd, file_size):
+        if not self.zero_copy:
+            return False
+        if self._can_sendfile is None:
+            mode = os.fstat(self.outpipe.fileno()).st_mode
+            self._can_sendfile = stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+        if not self._can_sendfile:
+            return False
         self.outpipe.flush()
+        offset = 0
+        while offset < file_size:
+            try:
+                n = os.sendfile(self.outpipe.fileno(), fd, offset, file_size - offset)
+            except OSError as e:
+                if offset == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    # the source file system doesn't support it
+                    return False
+                raise
+            if n == 0:
+                self._write_padding(file_size - offset)
+                break
+            offset += n
+        return True
 
-    def upload_file(self, server_filename, fd):
-        stat_data = self._get_file_stat(fd)
-        file_size = os.stat(fd).st_size
-        xattr_data = pickle.dumps(self._get_xattrs(fd))
-        self.write_command({'op': 'upload', 'path': server_filename, 'stat': stat_data, 'size': file_size,
-                            'xattr_size': len(xattr_data)})
-        self.outpipe.write(xattr_data)
+    # Small files are collected and sent together once their data reaches bundle_size. Requires the 'bundle'
+    # feature. A file whose size changed since it was stat'ed is uploaded on its own, padded or truncated.
+    def bundle_file(self, server_filename, fd, stat_info=None):
+        if stat_info is None:
+            stat_info = os.stat(fd)
         with os.fdopen(os.dup(fd), 'rb') as source:
-            shutil.copyfileobj(source, self.outpipe, file_size)
+            data = source.read(stat_info.st_size + 1)
+        if len(data) != stat_info.st_size:
+            os.lseek(fd, 0, os.SEEK_SET)
+            self.upload_file(server_filename, fd, stat_info)
+            return
+        stat_data = self._get_file_stat(fd, f_stat=stat_info)
+        xattrs = self._get_xattrs(fd)
+        self.bundle.append({'path': server_filename, 'stat': stat_data, 'xattrs': xattrs, 'data': data})
+        self.bundle_data_size += len(data)
+        if self.bundle_data_size >= self.bundle_size:
+            self.flush_bundle()
+
+    def flush_bundle(self):
+        if not self.bundle:
+            return
+        files = self.bundle
+        self.bundle = []
+        self.bundle_data_size = 0
+        self.write_command({'op': 'bundle', 'files': files})
+
+    def upload_file_delta(self, server_filename, fd, stat_info=None):
+        self.write_command({'op': 'signature', 'path': server_filename})
         self.outpipe.flush()
+        sig_info = self.read_reply()
+        block_size = sig_info['block_size']
+        try:
+            signature = delta.read_signature(self.inpipe, sig_info['count'])
+        finally:
+            self.end_reply()
+
+        if stat_info is None:
+            stat_info = os.stat(fd)
+        stat_data = self._get_file_stat(fd, f_stat=stat_info)
+        file_size = stat_info.st_size
+        self.write_command({'op': 'upload_delta', 'path': server_filename, 'stat': stat_data, 'size': file_size,
+                            'block_size': block_size}, self._get_xattrs(fd))
+        with os.fdopen(os.dup(fd), 'rb') as source:
+            writer = delta.DeltaWriter(self.outpipe)
+            sha256 = delta.write_delta(source, block_size, signature, writer)
+        self.outpipe.write(sha256)
+        self._end_command()
+        return writer.literal_size
 
     def delete(self, server_filename):
         self.write_command({'op': 'delete', 'path': server_filename})
+        self._end_command()
+
+    # When cache_path is given, a copy of the server db is kept there and on the next call only the
+    # records added since then are transferred.
+    def get_file_db(self, cache_path=None):
+        request = {'op': 'getdb', 'features': self.FEATURES, 'window': self.WINDOW}
+        if self.codecs:
+            request['codecs'] = self.codecs
+        cache_state = None
+        if cache_path is not None:
+            cache_state = self._read_cache_state(cache_path)
+        if cache_state is not None:
+            request['since'] = cache_state
+        self.write_command(request)
+        self.outpipe.flush()
+        data = self.read_reply()
+        # servers which don't know about features ignore the field and don't send it back
+        self.features = set(data.get('features', []))
+        self.codec = data.get('codec', None)
+        if data.get('incremental', False):
+            log = bytearray()
+            while True:
+                chunk = self._read_getdb_chunk()
+                if len(chunk) == 0:
+                    break
+                log += chunk
+            self.end_reply()
+            os.remove(cache_path + ".state")
+            try:
+                ret = FileDb(cache_path)
+                ret.merge_log(log)
+                ret.flush()
+                if len(ret.db) != data['count']:
+                    raise ValueError('Cached server db has an invalid entry count')
+            except (ValueError, EOFError, KeyError) as e:
+                print(f"Cached server db is invalid, downloading it again: {e}", file=sys.stderr)
+                return self.get_file_db(cache_path)
+            self._write_cache_state(cache_path, data)
+            return ret
 
-    def get_file_db(self):
-        self.write_command({'op': 'getdb'})
-        data = json.loads(self.read_line())
         ret = FileDb(None)
-        for i in range(1, data['count']):
-            ent = FileDbEntry.decode(self.inpipe, ret.db)
-            if ent.is_removed():
-                raise ValueError('Server db data cannot contain removed entries')
-            ret.db[ent.id] = ent
-            ent.parent.add_child(ent)
+        if 'chunked_getdb' not in self.features:
+            for i in range(1, data['count']):
+                self._add_server_entry(ret, FileDbEntry.decode(self.inpipe, ret.db))
+            self.end_reply()
+            return ret
+        with paused_gc():
+            while True:
+                chunk = self._read_getdb_chunk()
+                if len(chunk) == 0:
+                    break
+                pos = 0
+                while pos < len(chunk):
+                    ent, pos = FileDbEntry.decode_buffer(chunk, pos, ret.db)
+                    self._add_server_entry(ret, ent)
+        self.end_reply()
+        if len(ret.db) != data['count']:
+            raise ValueError('Server db data has an invalid entry count')
+        if cache_path is not None and 'log_id' in data:
+            if cache_state is not None:
+                os.remove(cache_path + ".state")
+            ret.file_path = cache_path
+            ret.rewrite()
+            self._write_cache_state(cache_path, data)
         return ret
+
+    # Starts an extra channel of the session of main, which already got the db, with the protocol of main
+    def join(self, main):
+        request = {'op': 'join', 'features': sorted(main.features), 'window': self.WINDOW}
+        if main.codec is not None:
+            request['codecs'] = [main.codec]
+        self.write_command(request)
+        self.outpipe.flush()
+        line = self.read_line()
+        if line is None:
+            raise EOFError('Server closed the connection')
+        data = json.loads(line)
+        self.features = set(data.get('features', []))
+        self.codec = data.get('codec', None)
+        if self.features != main.features:
+            raise ValueError('The channel got other features than the session: ' + str(sorted(self.features)))
+        self.zero_copy = main.zero_copy
+        self.bundle_size = main.bundle_size
+
+    def _read_getdb_chunk(self):
+        chunk = decode_varint_prefixed_bytes(self.inpipe)
+        if self.codec is None or len(chunk) == 0:
+            return chunk
+        start_cpu_time = time.thread_time()
+        ret = compression.decompressor(self.codec).decompress(chunk)
+        self.compression_stats.add(len(ret), len(chunk), start_cpu_time)
+        return ret
+
+    @staticmethod
+    def _read_cache_state(cache_path):
+        if not os.path.exists(cache_path) or not os.path.exists(cache_path + ".state"):
+            return None
+        with open(cache_path + ".state", 'r') as file:
+            return json.load(file)
+
+    @staticmethod
+    def _write_cache_state(cache_path, data):
+        with open(cache_path + ".state.tmp", 'w') as file:
+            json.dump({'log_id': data['log_id'], 'offset': data['offset']}, file)
+        os.rename(cache_path + ".state.tmp", cache_path + ".state")
+
+    @staticmethod
+    def _add_server_entry(filedb, ent):
+        if ent.is_removed():
+            raise ValueError('Server db data cannot contain removed entries')
+        filedb.db[ent.id] = ent
+        ent.parent.add_child(ent)
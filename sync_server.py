@@ -1,21 +1,79 @@
 import os
+import io
 import json
 import pickle
 import util
+import delta
+import protocol
 import shutil
 import errno
+import hashlib
+import compression
+import stat
+import threading
 from file_db import FileDbEntry
 import sys
 
+# Writes to the output until the first error, so that the rest of the incoming data can still be consumed.
+# The error is raised by check() afterwards. Without an output, the data is discarded.
+# The written data is hashed on the way, so the file doesn't need to be read again.
+class _DrainingWriter:
+    def __init__(self, output=None):
+        self.output = output
+        self.error = None
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if self.error is not None or self.output is None:
+            return
+        try:
+            self.output.write(data)
+        except OSError as e:
+            self.error = e
+            return
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
 class SyncServer:
+    FEATURES = ['delta', 'chunked_getdb', 'incremental_getdb', 'binary', 'acks', 'bundle', 'upload_sha256',
+                'compression', 'have', 'setmeta', 'join']
+    # features which can only be used together with another one
+    FEATURE_DEPENDENCIES = {'acks': 'binary', 'bundle': 'binary', 'have': 'acks', 'setmeta': 'binary',
+                            'join': 'acks'}
+    GETDB_CHUNK_SIZE = 1024 * 1024
+    MAX_ERROR_MESSAGE_SIZE = 200
+
     def __init__(self, inpipe, outpipe, rootdir, filedb):
         self.inpipe = inpipe
         self.outpipe = outpipe
         self.rootdir = rootdir
         self.filedb = filedb
+        # held while the db is used, the servers of the channels of a session share the db and the lock
+        self.db_lock = threading.RLock()
         self.allowdelete = False
         self.permissions_file = 0o744
         self.permissions_dir = 0o755
+        self.binary = False
+        self.acks = False
+        self.upload_sha256 = False
+        # uploads are moved from the input to the file with splice when the input is a pipe
+        self.zero_copy = False
+        self._can_splice = None
+        self.codec = None
+        # with a ChunkStore, the files in rootdir are empty and only keep the metadata, the data is in the store
+        self.chunk_store = None
+        self.ack_interval = 64
+        self.ack_seq = None
+        self.ack_errors = []
+        self.ack_missing = []
+        self.unacked = 0
+        self.commit_timer = None
 
     def read_line(self):
         line = self.inpipe.readline()
@@ -26,18 +84,84 @@ class SyncServer:
     def write_line(self, line):
         self.outpipe.write((line + '\n').encode())
 
+    def write_reply(self, data):
+        if self.acks:
+            self.outpipe.write(protocol.encode_command(data))
+        else:
+            self.write_line(json.dumps(data))
+
+    def _skip_input(self, size):
+        util.copy_file_limited(self.inpipe, _DrainingWriter(), size)
+
+    # The acknowledged commands are committed to the db first, they are not sent again after a crash
+    def write_ack(self):
+        if self.ack_seq is None:
+            return
+        with self.db_lock:
+            self.filedb.flush()
+        self.outpipe.write(protocol.encode_command({'op': 'ack', 'seq': self.ack_seq, 'errors': self.ack_errors,
+                                                    'missing': self.ack_missing}))
+        self.outpipe.flush()
+        self.ack_errors = []
+        self.ack_missing = []
+        self.unacked = 0
+
     def get_path(self, path):
         path = path.lstrip('/')
         return os.path.join(self.rootdir, path)
 
 
     def read_command(self):
-        line = self.read_line()
-        if line is None:
-            return False
-        data = json.loads(line)
+        if self.binary:
+            data = protocol.read_command(self.inpipe, self.acks)
+            if data is None:
+                return False
+        else:
+            line = self.read_line()
+            if line is None:
+                return False
+            data = json.loads(line)
+            if 'xattr_size' in data:
+                data['xattrs'] = pickle.loads(util.read_exactly(self.inpipe, data['xattr_size']))
         op = data.get("op", None)
-        if op == "upload":
+        try:
+            ret = self._dispatch_command(op, data)
+        except EOFError:
+            raise
+        except Exception as e:
+            # the handlers consume all the data of the command even when they fail, so the session can go on
+            self._report_error(data, data.get('path', ''), e)
+            ret = True
+        if self.acks and 'seq' in data:
+            self.ack_seq = data['seq']
+            self.unacked += 1
+            if op == 'sync' or self.unacked >= self.ack_interval:
+                self.write_ack()
+        self._schedule_commit()
+        return ret
+
+    # The db only checks the age of its pending records when the next ones are appended, the next command may
+    # come much later
+    def _schedule_commit(self):
+        with self.db_lock:
+            if self.commit_timer is not None or len(self.filedb.pending) == 0:
+                return
+            self.commit_timer = threading.Timer(self.filedb.COMMIT_INTERVAL, self._commit_pending)
+            self.commit_timer.daemon = True
+            self.commit_timer.start()
+
+    def _commit_pending(self):
+        with self.db_lock:
+            self.commit_timer = None
+            self.filedb.commit()
+
+    def _report_error(self, data, path, error, index=0):
+        print(f"{data['op']} {path} failed: {error!r}", file=sys.stderr)
+        if self.acks:
+            self.ack_errors.append((data['seq'], index, repr(error)[:self.MAX_ERROR_MESSAGE_SIZE]))
+
+    def _dispatch_command(self, op, data):
+        if op == "upload" or op == "upload_compressed":
             return self.read_upload_file(data)
         if op == "mkdir":
             return self.read_mkdir(data)
@@ -45,8 +169,22 @@ class SyncServer:
             return self.read_symlink(data)
         if op == "getdb":
             return self.read_getdb(data)
+        if op == "join":
+            return self.read_join(data)
         if op == "delete":
             return self.read_delete(data)
+        if op == "signature":
+            return self.read_signature(data)
+        if op == "upload_delta":
+            return self.read_upload_delta(data)
+        if op == "bundle":
+            return self.read_bundle(data)
+        if op == "have":
+            return self.read_have(data)
+        if op == "setmeta":
+            return self.read_setmeta(data)
+        if op == "sync":
+            return True
         return False
 
     @staticmethod
@@ -56,8 +194,6 @@ class SyncServer:
             os.setxattr(fp, 'user.psy.x.'.encode() + k, v, follow_symlinks=False)
 
     def read_mkdir(self, data):
-        xattr_data = pickle.loads(self.inpipe.read(data['xattr_size']))
-
         fp = self.get_path(data['path'])
         if os.path.isfile(fp) and self.allowdelete:
             print(f"mkdir {fp} - already exists; deleting", file=sys.stderr)
@@ -66,22 +202,21 @@ class SyncServer:
             os.mkdir(fp, mode=self.permissions_dir)
         except FileExistsError:
             pass
-        self._set_stat_and_xattr(fp, data['stat'], xattr_data)
-        parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
-        ent = parent_dir.get_child(os.path.basename(data['path']))
-        if ent is not None:
-            if not ent.is_directory():
-                raise ValueError('Dir already exists as a file in the db')
-        else:
-            ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
-        ent.set_directory()
-        ent.mtime = data['stat']['mtime']
-        self.filedb.append(ent)
+        self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
+        with self.db_lock:
+            parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
+            ent = parent_dir.get_child(os.path.basename(data['path']))
+            if ent is not None:
+                if not ent.is_directory():
+                    raise ValueError('Dir already exists as a file in the db')
+            else:
+                ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
+            ent.set_directory()
+            ent.mtime = data['stat']['mtime']
+            self.filedb.append(ent)
         return True
 
     def read_symlink(self, data):
-        xattr_data = pickle.loads(self.inpipe.read(data['xattr_size']))
-
         fp = self.get_path(data['path'])
         to_fp = data['to']
         if to_fp[0] == '/':
@@ -94,39 +229,335 @@ class SyncServer:
             elif self.allowdelete:
                 os.remove(fp)
         os.symlink(to_fp, fp)
-        # self._set_stat_and_xattr(fp, data['stat'], xattr_data)
+        # self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
 
-        parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
-        ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
-        ent.symlink = data['to']
-        ent.mtime = data['stat']['mtime']
-        self.filedb.append(ent)
+        with self.db_lock:
+            parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
+            ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
+            ent.symlink = data['to']
+            ent.mtime = data['stat']['mtime']
+            self.filedb.append(ent)
         return True
 
     def read_upload_file(self, data):
         fp = self.get_path(data['path'])
-        f = os.open(fp, os.O_WRONLY | os.O_CREAT, self.permissions_file)
-        xattr_data = pickle.loads(self.inpipe.read(data['xattr_size']))
+        compressed = data['op'] == 'upload_compressed'
+        try:
+            if os.path.lexists(fp) and self.allowdelete:
+                if os.path.islink(fp):
+                    os.remove(fp)
+                elif os.path.isdir(fp):
+                    shutil.rmtree(fp, ignore_errors=True)
+            f = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.permissions_file)
+        except OSError:
+            if compressed:
+                self._receive_compressed(_DrainingWriter())
+            else:
+                self._skip_input(data['size'])
+            if self.upload_sha256:
+                util.read_exactly(self.inpipe, 32)
+            raise
+
+        output = None
+        if not compressed and self._splice_input_allowed():
+            error = None
+            try:
+                self._splice_input(f, data['size'])
+            except OSError as e:
+                error = e
+            finally:
+                os.close(f)
+            # the digest follows the data even when it couldn't be stored
+            expected_sha256 = util.read_exactly(self.inpipe, 32) if self.upload_sha256 else None
+            if error is not None:
+                raise error
+            # the data is still in the page cache
+            with open(fp, 'rb') as fh:
+                sha256 = util.sha256_file(fh)
+        else:
+            with self._open_output(f) as output:
+                writer = _DrainingWriter(output)
+                if compressed:
+                    self._receive_compressed(writer)
+                else:
+                    util.copy_file_limited(self.inpipe, writer, data['size'])
+            expected_sha256 = util.read_exactly(self.inpipe, 32) if self.upload_sha256 else None
+            writer.check()
+            if writer.size != data['size']:
+                raise ValueError('Uploaded file has an invalid size: ' + data['path'])
+            sha256 = writer.sha256.digest()
+        if expected_sha256 is not None and sha256 != expected_sha256:
+            raise ValueError('Uploaded file does not match its digest: ' + data['path'])
+        self._commit_output(output, sha256)
+        self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
+
+        with self.db_lock:
+            parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
+            ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
+            ent.size = data['size']
+            ent.mtime = data['stat']['mtime']
+            ent.sha256 = sha256
+            self.filedb.append(ent)
+        return True
+
+    # A decompression error doesn't stop reading the chunks, so that the stream stays usable
+    def _receive_compressed(self, writer):
+        decompressor = None
+        error = None
+        while True:
+            chunk = util.decode_varint_prefixed_bytes(self.inpipe)
+            if len(chunk) == 0:
+                break
+            if error is not None:
+                continue
+            try:
+                if decompressor is None:
+                    decompressor = compression.decompressor(self.codec)
+                writer.write(decompressor.decompress(chunk))
+            except Exception as e:
+                error = e
+        if error is not None:
+            raise ValueError('Invalid compressed data: ' + str(error))
+
+    # Returns the object receiving the data of the file opened as f
+    def _open_output(self, f):
+        if self.chunk_store is None:
+            return os.fdopen(f, 'wb')
+        os.close(f)
+        return self.chunk_store.writer()
+
+    def _commit_output(self, output, sha256):
+        if self.chunk_store is not None:
+            output.commit(sha256)
+
+    # Returns a reader of the stored data of a file and its size, None when there is no data
+    def _open_stored(self, path):
+        if self.chunk_store is not None:
+            with self.db_lock:
+                ent = self.filedb.find_path(path)
+                sha256 = ent.sha256 if ent is not None else None
+            if sha256 is None:
+                return None
+            reader = self.chunk_store.open(sha256)
+            if reader is None:
+                return None
+            return reader, reader.size
+        fp = self.get_path(path)
+        if not os.path.isfile(fp) or os.path.islink(fp):
+            return None
+        fh = open(fp, 'rb')
+        return fh, os.fstat(fh.fileno()).st_size
+
+    def _splice_input_allowed(self):
+        if not self.zero_copy or self.chunk_store is not None:
+            return False
+        if self._can_splice is None:
+            self._can_splice = hasattr(os, 'splice') and stat.S_ISFIFO(os.fstat(self.inpipe.fileno()).st_mode)
+        return self._can_splice
+
+    def _splice_input(self, f, size):
+        if size == 0:
+            return
+        # the start of the data may already be in the input buffer
+        buffered = self.inpipe.read(min(len(self.inpipe.peek(1)), size))
+        remaining = size - len(buffered)
+        try:
+            os.write(f, buffered)
+            while remaining > 0:
+                try:
+                    n = os.splice(self.inpipe.fileno(), f, remaining)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    # not supported by the file system, the data is copied from now on
+                    self._can_splice = False
+                    size, remaining = remaining, 0
+                    self._copy_input(f, size)
+                    return
+                if n == 0:
+                    raise EOFError()
+                remaining -= n
+        except OSError:
+            self._skip_input(remaining)
+            raise
+
+    # Consumes size bytes of the input even when writing them fails
+    def _copy_input(self, f, size):
+        with open(f, 'wb', closefd=False) as output:
+            writer = _DrainingWriter(output)
+            util.copy_file_limited(self.inpipe, writer, size)
+        writer.check()
+
+    # The files of a bundle fail separately, their entries are added to the db together
+    def read_bundle(self, data):
+        stored = []
+        entries = []
+        for i, file in enumerate(data['files']):
+            try:
+                fp = self.get_path(file['path'])
+                if os.path.lexists(fp) and self.allowdelete:
+                    if os.path.islink(fp):
+                        os.remove(fp)
+                    elif os.path.isdir(fp):
+                        shutil.rmtree(fp, ignore_errors=True)
+                f = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.permissions_file)
+                sha256 = hashlib.sha256(file['data']).digest()
+                with self._open_output(f) as output:
+                    output.write(file['data'])
+                self._commit_output(output, sha256)
+                self._set_stat_and_xattr(fp, file['stat'], file['xattrs'])
+
+                stored.append((i, file, sha256))
+            except Exception as e:
+                self._report_error(data, file['path'], e, i)
+        with self.db_lock:
+            for i, file, sha256 in stored:
+                try:
+                    parent_dir = self.filedb.get_path(os.path.dirname(file['path']))
+                except Exception as e:
+                    self._report_error(data, file['path'], e, i)
+                    continue
+                ent = FileDbEntry(os.path.basename(file['path']), parent_dir)
+                ent.size = len(file['data'])
+                ent.mtime = file['stat']['mtime']
+                ent.sha256 = sha256
+                entries.append(ent)
+            self.filedb.append_many(entries)
+        return True
+
+    # The client sends the data when the content isn't found
+    def read_have(self, data):
+        fp = self.get_path(data['path'])
+        if self.chunk_store is not None:
+            if not self.chunk_store.has_file(data['sha256']):
+                self.ack_missing.append(data['seq'])
+                return True
+            os.close(os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.permissions_file))
+            return self._add_have_entry(fp, data)
+        with self.db_lock:
+            source = self.filedb.find_sha256(data['sha256'])
+            source_path = source.get_path() if source is not None else None
+        if source is None or source.size != data['size'] or source_path == data['path'].lstrip('/'):
+            self.ack_missing.append(data['seq'])
+            return True
+        source_fp = self.get_path(source_path)
+        try:
+            # not a hardlink, the metadata is stored in the xattrs of the inode
+            util.clone_file(source_fp, fp, self.permissions_file)
+        except FileNotFoundError:
+            self.ack_missing.append(data['seq'])
+            return True
+        if os.path.getsize(fp) != data['size']:
+            # changed on the disk since it was recorded
+            os.remove(fp)
+            self.ack_missing.append(data['seq'])
+            return True
+        return self._add_have_entry(fp, data)
+
+    def _add_have_entry(self, fp, data):
+        self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
+
+        with self.db_lock:
+            parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
+            ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
+            ent.size = data['size']
+            ent.mtime = data['stat']['mtime']
+            ent.sha256 = data['sha256']
+            self.filedb.append(ent)
+        return True
+
+    # Only the metadata of the file changed, the entry keeps the recorded content
+    def read_setmeta(self, data):
+        fp = self.get_path(data['path'])
+        with self.db_lock:
+            ent = self.filedb.find_path(data['path'])
+            if ent is None or ent.is_directory() or ent.is_symlink() or ent.sha256 != data['sha256']:
+                raise ValueError('File content differs from the db: ' + data['path'])
+            if not stat.S_ISREG(os.lstat(fp).st_mode):
+                raise ValueError('Not a regular file: ' + data['path'])
+            self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
+
+            new_ent = FileDbEntry(ent.name, ent.parent)
+            new_ent.size = ent.size
+            new_ent.mtime = data['stat']['mtime']
+            new_ent.sha256 = ent.sha256
+            self.filedb.append(new_ent)
+        return True
+
+    def read_signature(self, data):
+        fp = self.get_path(data['path'])
+        block_size = delta.choose_block_size(0)
+        count = 0
+        sig_data = io.BytesIO()
+        try:
+            stored = self._open_stored(data['path'])
+            if stored is not None:
+                with stored[0] as fh:
+                    block_size = delta.choose_block_size(stored[1])
+                    count = delta.write_signature(fh, block_size, sig_data)
+        except OSError as e:
+            # the client is waiting for the reply, the whole file will be sent instead
+            print(f"signature {fp} failed: {e!r}", file=sys.stderr)
+            block_size = delta.choose_block_size(0)
+            count = 0
+            sig_data = io.BytesIO()
+        self.write_reply({'block_size': block_size, 'count': count})
+        self.outpipe.write(sig_data.getbuffer())
+        self.outpipe.flush()
+        return True
+
+    def read_upload_delta(self, data):
+        fp = self.get_path(data['path'])
+        tmp_fp = fp + '.psy-tmp'
+        base = None
+        output = None
+        error = None
+        try:
+            stored = self._open_stored(data['path'])
+            if stored is not None:
+                base = stored[0]
+            output = self._open_output(os.open(tmp_fp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.permissions_file))
+        except OSError as e:
+            error = e
+        writer = _DrainingWriter(output)
+        try:
+            delta.apply_delta(self.inpipe, base, data['block_size'], writer)
+        except ValueError as e:
+            error = error or e
+        finally:
+            if base is not None:
+                base.close()
+            if output is not None:
+                output.close()
+        expected_sha256 = util.read_exactly(self.inpipe, 32)
+        if error is None:
+            error = writer.error
+        if error is not None:
+            if output is not None:
+                os.remove(tmp_fp)
+            raise error
+
+        sha256 = writer.sha256.digest()
+        if sha256 != expected_sha256 or writer.size != data['size']:
+            os.remove(tmp_fp)
+            raise ValueError('Rebuilt file does not match: ' + data['path'])
+        self._commit_output(output, sha256)
 
         if os.path.exists(fp) and self.allowdelete:
             if os.path.islink(fp):
                 os.remove(fp)
             elif os.path.isdir(fp):
                 shutil.rmtree(fp, ignore_errors=True)
+        os.rename(tmp_fp, fp)
+        self._set_stat_and_xattr(fp, data['stat'], data['xattrs'])
 
-        with os.fdopen(os.dup(f), 'wb') as output:
-            util.copy_file_limited(self.inpipe, output, data['size'])
-        self._set_stat_and_xattr(fp, data['stat'], xattr_data)
-
-        parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
-        ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
-        ent.size = data['size']
-        ent.mtime = data['stat']['mtime']
-        with open(fp, 'rb') as fh:
-            ent.sha256 = util.sha256_file(fh)
-        self.filedb.append(ent)
-
-        os.close(f)
+        with self.db_lock:
+            parent_dir = self.filedb.get_path(os.path.dirname(data['path']))
+            ent = FileDbEntry(os.path.basename(data['path']), parent_dir)
+            ent.size = data['size']
+            ent.mtime = data['stat']['mtime']
+            ent.sha256 = sha256
+            self.filedb.append(ent)
         return True
 
     def read_delete(self, data):
@@ -141,15 +572,98 @@ class SyncServer:
         except OSError as e:
             if e.errno != errno.ENOTEMPTY:
                 raise
-        ent = self.filedb.get_path(data['path'])
-        ent.set_removed()
-        self.filedb.append(ent)
+        with self.db_lock:
+            ent = self.filedb.get_path(data['path'])
+            ent.set_removed()
+            self.filedb.append(ent)
         return True
 
+    # With compression, every chunk is compressed separately
+    def _write_getdb_chunk(self, chunk, codec=None):
+        if codec is not None and len(chunk) > 0:
+            compressor = compression.compressor(codec)
+            chunk = compressor.compress(chunk) + compressor.flush()
+        header = bytearray()
+        util.encode_varint(header, len(chunk))
+        self.outpipe.write(header)
+        self.outpipe.write(chunk)
+
+    # Returns the features of the client which are supported here, and the codec
+    def _negotiate(self, data):
+        features = [f for f in data.get('features', []) if f in self.FEATURES]
+        while any(self.FEATURE_DEPENDENCIES.get(f, f) not in features for f in features):
+            features = [f for f in features if self.FEATURE_DEPENDENCIES.get(f, f) in features]
+        codec = None
+        if 'compression' in features:
+            # the first of the client codecs which is known here
+            codec = next((c for c in data.get('codecs', []) if c in compression.CODECS), None)
+            if codec is None:
+                features.remove('compression')
+        return features, codec
+
     def read_getdb(self, data):
-        self.write_line(json.dumps({'count': len(self.filedb.db)}))
+        features, codec = self._negotiate(data)
+        with self.db_lock:
+            self._send_db(data, features, codec)
+        self._use_features(data, features, codec)
+        return True
+
+    # Starts an extra channel of a session, which only uploads, the client got the db on the first channel
+    def read_join(self, data):
+        features, codec = self._negotiate(data)
+        header = {'features': features}
+        if codec is not None:
+            header['codec'] = codec
+        self.write_reply(header)
+        self.outpipe.flush()
+        self._use_features(data, features, codec)
+        return True
+
+    def _use_features(self, data, features, codec):
+        self.codec = codec
+        # the following commands are read using the negotiated protocol
+        self.binary = 'binary' in features
+        self.acks = 'acks' in features
+        self.upload_sha256 = 'upload_sha256' in features
+        if self.acks and 'window' in data:
+            self.ack_interval = max(1, data['window'] // 4)
+
+    def _send_db(self, data, features, codec):
+        header = {'count': len(self.filedb.db), 'features': features}
+        if codec is not None:
+            header['codec'] = codec
+        log_state = None
+        if 'incremental_getdb' in features:
+            log_state = self.filedb.get_log_state()
+        if log_state is not None:
+            header['log_id'], header['offset'] = log_state
+            since = data.get('since', None)
+            if since is not None and since['log_id'] == log_state[0] and since['offset'] <= log_state[1]:
+                # the client has a copy of the db up to the given offset, only send the records after it
+                header['incremental'] = True
+                self.write_reply(header)
+                log = self.filedb.read_log(since['offset'], log_state[1])
+                for i in range(0, len(log), self.GETDB_CHUNK_SIZE):
+                    self._write_getdb_chunk(log[i:i + self.GETDB_CHUNK_SIZE], codec)
+                self._write_getdb_chunk(b'')
+                self.outpipe.flush()
+                return
+        self.write_reply(header)
+        if 'chunked_getdb' not in features:
+            for entry in self.filedb.db.values():
+                if entry != self.filedb.root:
+                    self.outpipe.write(entry.encode())
+            self.outpipe.flush()
+            return
+        # records are sent in length-prefixed chunks, so that the client can decode them from a buffer
+        chunk = bytearray()
         for entry in self.filedb.db.values():
             if entry != self.filedb.root:
-                self.outpipe.write(entry.encode())
+                chunk += entry.encode()
+                if len(chunk) >= self.GETDB_CHUNK_SIZE:
+                    self._write_getdb_chunk(chunk, codec)
+                    chunk = bytearray()
+        if len(chunk) > 0:
+            self._write_getdb_chunk(chunk, codec)
+        self._write_getdb_chunk(b'')
         self.outpipe.flush()
-        return True
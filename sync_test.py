@@ -0,0 +1,418 @@
+import unittest
+import contextlib
+import errno
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import types
+
+import compression
+from chunk_store import ChunkStore
+from file_db import FileDb
+from sync_client import SyncClient
+from sync_server import SyncServer
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.srcdir = os.path.join(self.tmpdir.name, 'src')
+        self.rootdir = os.path.join(self.tmpdir.name, 'root')
+        os.mkdir(self.srcdir)
+        os.mkdir(self.rootdir)
+        self.db_path = os.path.join(self.tmpdir.name, 'db.bin')
+        self.cache_path = None
+        self.client_features = None
+        self.client_codecs = []
+        self.connect()
+
+    def tearDown(self):
+        self.disconnect()
+        self.tmpdir.cleanup()
+
+    def connect(self):
+        c2s_r, c2s_w = os.pipe()
+        s2c_r, s2c_w = os.pipe()
+        self.filedb = FileDb(self.db_path)
+        self.server = SyncServer(os.fdopen(c2s_r, 'rb'), os.fdopen(s2c_w, 'wb'), self.rootdir, self.filedb)
+        self.server_thread = threading.Thread(target=self._run_server)
+        self.server_thread.start()
+        proc = types.SimpleNamespace(stdin=os.fdopen(c2s_w, 'wb'), stdout=os.fdopen(s2c_r, 'rb'))
+        self.client = SyncClient(proc)
+        if self.client_features is not None:
+            self.client.FEATURES = self.client_features
+        self.client.codecs = self.client_codecs
+        self.server_files = self.client.get_file_db(self.cache_path)
+
+    def _run_server(self):
+        try:
+            while self.server.read_command():
+                pass
+        finally:
+            self.server.outpipe.close()
+            self.server.inpipe.close()
+
+    def disconnect(self):
+        self.client.outpipe.close()
+        self.server_thread.join()
+        self.client.inpipe.close()
+        self.server_files.close()
+        self.filedb.close()
+
+    def reconnect(self):
+        self.disconnect()
+        self.connect()
+
+    def write_src(self, name, data):
+        with open(os.path.join(self.srcdir, name), 'wb') as fh:
+            fh.write(data)
+
+    def upload(self, name, use_delta=False):
+        fd = os.open(os.path.join(self.srcdir, name), os.O_RDONLY)
+        try:
+            if use_delta:
+                return self.client.upload_file_delta(name, fd)
+            return self.client.upload_file(name, fd)
+        finally:
+            os.close(fd)
+
+    def read_root(self, name):
+        with open(os.path.join(self.rootdir, name), 'rb') as fh:
+            return fh.read()
+
+    def test_upload(self):
+        self.write_src('test.txt', b'hello')
+        self.upload('test.txt')
+        fd = os.open(self.srcdir, os.O_RDONLY)
+        self.client.mkdir('dir', fd)
+        os.close(fd)
+        self.reconnect()
+        self.assertEqual(self.read_root('test.txt'), b'hello')
+        self.assertEqual(self.server_files.get_path('test.txt').size, 5)
+        self.assertEqual(self.server_files.get_path('test.txt').sha256, hashlib.sha256(b'hello').digest())
+        self.assertTrue(self.server_files.get_path('dir').is_directory())
+
+        self.client.delete('test.txt')
+        self.reconnect()
+        self.assertIsNone(self.server_files.find_path('test.txt'))
+        self.assertFalse(os.path.exists(os.path.join(self.rootdir, 'test.txt')))
+
+    def test_xattrs(self):
+        for features in (None, []):
+            self.client_features = features
+            self.reconnect()
+            self.assertEqual('binary' in self.client.features, features is None)
+            self.write_src('test.txt', b'hello')
+            os.setxattr(os.path.join(self.srcdir, 'test.txt'), 'user.test', b'value')
+            self.upload('test.txt')
+            self.client.delete('test.txt')
+            self.upload('test.txt')
+            self.reconnect()
+            fp = os.path.join(self.rootdir, 'test.txt')
+            self.assertEqual(os.getxattr(fp, 'user.psy.x.user.test'), b'value')
+            self.assertEqual(self.read_root('test.txt'), b'hello')
+            os.remove(fp)
+
+    def test_upload_delta(self):
+        self.assertIn('delta', self.client.features)
+        data = os.urandom(200000)
+        self.write_src('test.bin', data)
+        self.upload('test.bin')
+        data = data[:100000] + b'changed' + data[100000:]
+        self.write_src('test.bin', data)
+        self.assertLess(self.upload('test.bin', True), 10000)
+        self.reconnect()
+        self.assertEqual(self.read_root('test.bin'), data)
+        ent = self.server_files.get_path('test.bin')
+        self.assertEqual(ent.size, len(data))
+
+        self.write_src('new.bin', data)
+        self.assertEqual(self.upload('new.bin', True), len(data))
+        self.reconnect()
+        self.assertEqual(self.read_root('new.bin'), data)
+        self.assertEqual(self.server_files.get_path('new.bin').sha256, ent.sha256)
+
+    def test_failed_commands(self):
+        self.assertIn('acks', self.client.features)
+        data = os.urandom(200000)
+        self.write_src('test.bin', data)
+        fd = os.open(os.path.join(self.srcdir, 'test.bin'), os.O_RDONLY)
+        self.client.upload_file('missing/test.bin', fd)
+        self.client.upload_file_delta('missing/test2.bin', fd)
+        os.close(fd)
+        self.upload('test.bin')
+        self.client.sync()
+        self.assertEqual(self.read_root('test.bin'), data)
+        failures = self.client.take_failures()
+        self.assertEqual([(op, path) for op, path, message in failures],
+                         [('upload', 'missing/test.bin'), ('upload_delta', 'missing/test2.bin')])
+        self.assertIn('FileNotFoundError', failures[0][2])
+        self.assertEqual(self.client.take_failures(), [])
+
+    def test_zero_copy(self):
+        self.client_features = [f for f in SyncClient.FEATURES if f != 'upload_sha256']
+        self.reconnect()
+        self.client.zero_copy = True
+        self.server.zero_copy = True
+        data = os.urandom(300000)
+        self.write_src('test.bin', data)
+        self.upload('test.bin')
+        self.upload('test.bin')
+        self.client.sync()
+        self.assertTrue(self.client._can_sendfile)
+        self.assertTrue(self.server._can_splice)
+        self.reconnect()
+        self.assertEqual(self.read_root('test.bin'), data)
+        self.assertEqual(self.server_files.get_path('test.bin').sha256, hashlib.sha256(data).digest())
+
+    def test_splice_errors(self):
+        self.server.zero_copy = True
+        data = os.urandom(300000)
+        self.write_src('test.bin', data)
+        splice = os.splice
+        calls = []
+
+        def failing_splice(src, dst, count, error=errno.EINVAL):
+            calls.append(count)
+            raise OSError(error, os.strerror(error))
+
+        try:
+            # without splice support, the data is copied for this upload and the next ones
+            os.splice = failing_splice
+            self.upload('test.bin')
+            self.client.sync()
+            self.assertFalse(self.server._can_splice)
+            self.upload('test.bin')
+            self.client.sync()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(self.client.take_failures(), [])
+            self.assertEqual(self.read_root('test.bin'), data)
+
+            # other errors only fail the upload, the session goes on
+            self.server._can_splice = None
+            os.splice = lambda src, dst, count: failing_splice(src, dst, count, errno.EIO)
+            self.upload('test.bin')
+            self.client.sync()
+            self.assertEqual([op for op, path, message in self.client.take_failures()], ['upload'])
+        finally:
+            os.splice = splice
+        self.upload('test.bin')
+        self.client.sync()
+        self.assertEqual(self.client.take_failures(), [])
+        self.assertEqual(self.read_root('test.bin'), data)
+
+    def test_compression(self):
+        text = b'hello world ' * 100000
+        random_data = os.urandom(100000)
+        self.write_src('text.txt', text)
+        self.write_src('random.bin', random_data)
+        for codec in ('zlib', 'lzma'):
+            self.client_codecs = ['unknown', codec]
+            self.reconnect()
+            self.assertEqual(self.client.codec, codec)
+            self.client.compression_stats = compression.CompressionStats()
+            self.upload('text.txt')
+            self.upload('random.bin')
+            self.client.sync()
+            self.assertEqual(self.client.take_failures(), [])
+            self.assertEqual(self.client.compression_stats.raw_size, len(text))
+            self.assertLess(self.client.compression_stats.ratio(), 0.1)
+            self.reconnect()
+            self.assertEqual(self.read_root('text.txt'), text)
+            self.assertEqual(self.read_root('random.bin'), random_data)
+            self.assertEqual(self.server_files.get_path('text.txt').sha256, hashlib.sha256(text).digest())
+            # the db records were compressed as well
+            self.assertGreater(self.client.compression_stats.raw_size, 0)
+
+    def test_upload_digest_mismatch(self):
+        self.assertIn('upload_sha256', self.client.features)
+        stat_data = {'mode': 0o644, 'uid': 0, 'gid': 0, 'atime': 0, 'mtime': 0}
+        self.client.write_command({'op': 'upload', 'path': 'bad.txt', 'stat': stat_data, 'size': 5}, [])
+        self.client.outpipe.write(b'hello' + bytes(32))
+        self.client.sync()
+        self.assertEqual([(op, path) for op, path, message in self.client.take_failures()], [('upload', 'bad.txt')])
+        self.reconnect()
+        self.assertIsNone(self.server_files.find_path('bad.txt'))
+
+    def test_upload_shrunk_file(self):
+        # the stat result from the walk is reused, the file got shorter since then
+        self.write_src('shrunk.txt', b'hello world')
+        stat_info = os.stat(os.path.join(self.srcdir, 'shrunk.txt'))
+        self.write_src('shrunk.txt', b'hello')
+        fd = os.open(os.path.join(self.srcdir, 'shrunk.txt'), os.O_RDONLY)
+        self.client.upload_file('shrunk.txt', fd, stat_info)
+        os.close(fd)
+        self.write_src('next.txt', b'next')
+        self.upload('next.txt')
+        self.reconnect()
+        self.assertEqual(self.read_root('shrunk.txt'), b'hello' + bytes(6))
+        self.assertEqual(self.read_root('next.txt'), b'next')
+
+    def test_bundle(self):
+        self.assertIn('bundle', self.client.features)
+        self.client.bundle_size = 10
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self.write_src(name, name.encode())
+            os.setxattr(os.path.join(self.srcdir, name), 'user.test', b'value')
+        for name in ('a.txt', 'missing/b.txt', 'b.txt', 'c.txt'):
+            fd = os.open(os.path.join(self.srcdir, os.path.basename(name)), os.O_RDONLY)
+            self.client.bundle_file(name, fd)
+            os.close(fd)
+        self.client.sync()
+        self.assertEqual([(op, path) for op, path, message in self.client.take_failures()],
+                         [('upload', 'missing/b.txt')])
+        self.reconnect()
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self.assertEqual(self.read_root(name), name.encode())
+            self.assertEqual(os.getxattr(os.path.join(self.rootdir, name), 'user.psy.x.user.test'), b'value')
+            self.assertEqual(self.server_files.get_path(name).size, 5)
+
+    def test_bundle_size_changed(self):
+        self.write_src('a.txt', b'a' * 10)
+        self.write_src('b.txt', b'b' * 10)
+        fds = [os.open(os.path.join(self.srcdir, name), os.O_RDONLY) for name in ('a.txt', 'b.txt')]
+        stats = [os.stat(fd) for fd in fds]
+        # one grew and one shrank after the stat, the data sent matches the size recorded
+        self.write_src('a.txt', b'a' * 1000)
+        self.write_src('b.txt', b'b' * 5)
+        for name, fd, stat_info in zip(('a.txt', 'b.txt'), fds, stats):
+            self.client.bundle_file(name, fd, stat_info)
+            os.close(fd)
+        self.client.sync()
+        self.assertEqual(self.client.take_failures(), [])
+        self.reconnect()
+        self.assertEqual(self.read_root('a.txt'), b'a' * 10)
+        self.assertEqual(self.read_root('b.txt'), b'b' * 5 + bytes(5))
+        self.assertEqual(self.server_files.get_path('a.txt').size, 10)
+
+    def test_idle_commit(self):
+        # the server waits for the next command, the record of the upload is committed without it
+        self.write_src('a.txt', b'a')
+        self.upload('a.txt')
+        self.client.sync()
+        self.write_src('b.txt', b'b')
+        self.upload('b.txt')
+        self.client.outpipe.flush()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with self.server.db_lock:
+                if self.filedb.find_path('b.txt') is not None and len(self.filedb.pending) == 0:
+                    break
+            time.sleep(0.01)
+        with self.server.db_lock:
+            self.assertEqual(len(self.filedb.pending), 0)
+        filedb = FileDb(self.db_path, readonly=True)
+        self.assertEqual(filedb.get_path('b.txt').size, 1)
+        filedb.close()
+
+    def test_bundle_failures(self):
+        # the acks carry thousands of errors, the server must not block writing them while the client writes
+        self.client.bundle_size = 100
+        self.write_src('a.txt', b'a')
+        with contextlib.redirect_stderr(io.StringIO()):
+            for i in range(20000):
+                fd = os.open(os.path.join(self.srcdir, 'a.txt'), os.O_RDONLY)
+                self.client.bundle_file(f'missing/{i}.txt', fd)
+                os.close(fd)
+            self.client.sync()
+        failures = self.client.take_failures()
+        self.assertEqual(len(failures), 20000)
+        self.assertEqual(failures[-1][:2], ('upload', 'missing/19999.txt'))
+
+    def test_have(self):
+        self.assertIn('have', self.client.features)
+        data = os.urandom(100000)
+        self.write_src('a.bin', data)
+        self.upload('a.bin')
+        fd = os.open(os.path.join(self.srcdir, 'a.bin'), os.O_RDONLY)
+        self.client.have('b.bin', fd, hashlib.sha256(data).digest())
+        self.client.have('c.bin', fd, hashlib.sha256(b'other').digest())
+        os.close(fd)
+        self.client.sync()
+        self.assertEqual(self.client.take_missing(), ['c.bin'])
+        self.reconnect()
+        self.assertEqual(self.read_root('b.bin'), data)
+        self.assertEqual(self.server_files.get_path('b.bin').sha256, hashlib.sha256(data).digest())
+        self.assertIsNone(self.server_files.find_path('c.bin'))
+
+    def test_setmeta(self):
+        self.assertIn('setmeta', self.client.features)
+        self.write_src('test.txt', b'hello')
+        self.upload('test.txt')
+        os.utime(os.path.join(self.srcdir, 'test.txt'), ns=(1, 2000000000))
+        os.setxattr(os.path.join(self.srcdir, 'test.txt'), 'user.test', b'value')
+        local_path = os.path.join(self.srcdir, 'test.txt')
+        self.client.setmeta('test.txt', local_path, hashlib.sha256(b'hello').digest())
+        self.client.setmeta('other.txt', local_path, hashlib.sha256(b'hello').digest())
+        self.client.setmeta('test.txt', local_path, hashlib.sha256(b'other').digest())
+        self.client.sync()
+        self.assertEqual([(op, path) for op, path, message in self.client.take_failures()],
+                         [('setmeta', 'other.txt'), ('setmeta', 'test.txt')])
+        self.reconnect()
+        ent = self.server_files.get_path('test.txt')
+        self.assertEqual(ent.mtime, 2000000000)
+        self.assertEqual(ent.size, 5)
+        self.assertEqual(ent.sha256, hashlib.sha256(b'hello').digest())
+        self.assertEqual(os.getxattr(os.path.join(self.rootdir, 'test.txt'), 'user.psy.x.user.test'), b'value')
+        self.assertEqual(self.read_root('test.txt'), b'hello')
+
+        # the raw digest can't be sent with the text protocol
+        self.client_features = ['setmeta']
+        self.reconnect()
+        self.assertEqual(self.client.features, set())
+
+    def test_chunk_store(self):
+        store = ChunkStore(os.path.join(self.tmpdir.name, 'store'))
+        self.server.chunk_store = store
+        data = os.urandom(300000)
+        self.write_src('test.bin', data)
+        self.upload('test.bin')
+        changed = data[:100000] + b'changed' + data[100000:]
+        self.write_src('test.bin', changed)
+        self.assertLess(self.upload('test.bin', True), 10000)
+        self.client.sync()
+        self.assertEqual(self.client.take_failures(), [])
+        fd = os.open(os.path.join(self.srcdir, 'test.bin'), os.O_RDONLY)
+        self.client.have('copy.bin', fd, hashlib.sha256(changed).digest())
+        os.close(fd)
+        self.client.sync()
+        self.assertEqual(self.client.take_missing(), [])
+        self.reconnect()
+        store.close()
+        self.assertEqual(self.read_root('copy.bin'), b'')
+        sha256 = self.server_files.get_path('copy.bin').sha256
+        self.assertEqual(self.server_files.get_path('test.bin').sha256, sha256)
+        self.assertEqual(ChunkStore(store.path).open(sha256).read(), changed)
+
+    def test_incremental_getdb(self):
+        self.cache_path = os.path.join(self.tmpdir.name, 'cache.bin')
+        self.write_src('test.txt', b'hello')
+        self.upload('test.txt')
+        self.reconnect()
+        self.assertEqual(self.server_files.get_path('test.txt').size, 5)
+
+        self.write_src('test2.txt', b'hello2')
+        self.upload('test2.txt')
+        self.client.delete('test.txt')
+        self.reconnect()
+        log_offset = self.filedb.get_log_state()[1]
+        with open(self.cache_path + '.state', 'r') as file:
+            self.assertIn(str(log_offset), file.read())
+        self.assertIsNone(self.server_files.find_path('test.txt'))
+        self.assertEqual(self.server_files.get_path('test2.txt').size, 6)
+
+        # rewriting the db invalidates the offset
+        self.filedb.rewrite()
+        self.write_src('test3.txt', b'hello3')
+        self.upload('test3.txt')
+        self.reconnect()
+        self.assertEqual(self.server_files.get_path('test2.txt').size, 6)
+        self.assertEqual(self.server_files.get_path('test3.txt').size, 6)
+        self.assertEqual(len(self.server_files.db), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
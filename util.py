@@ -1,8 +1,27 @@
+import contextlib
+import fcntl
+import gc
 import hashlib
+import os
+import shutil
 
-def copy_file_limited(src, dest, limit):
+FICLONE = 0x40049409
+
+# The cyclic GC keeps rescanning the objects created while decoding a large db, pause it meanwhile
+@contextlib.contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# Returns the number of bytes missing when src ends before the limit
+def copy_file_limited(src, dest, limit, hasher=None):
     if limit == 0:
-        return
+        return 0
     b  = bytearray(128 * 1024)
     mv = memoryview(b)
     while True:
@@ -13,17 +32,30 @@ def copy_file_limited(src, dest, limit):
             break
         if n > limit:
             n = limit
-        if n < len(b):
-            dest.write(mv[:n])
-        else:
-            dest.write(mv)
+        chunk = mv[:n] if n < len(b) else mv
+        if hasher is not None:
+            hasher.update(chunk)
+        dest.write(chunk)
         limit -= n
         if limit == 0:
-            return
+            return 0
+    return limit
+
+# Shares the data blocks with a reflink where the file system supports it, copies the data otherwise
+def clone_file(src_path, dest_path, mode):
+    with open(src_path, 'rb') as src:
+        with os.fdopen(os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+            shutil.copyfileobj(src, dest, 1024 * 1024)
 
-def sha256_file(file):
+def sha256_file(file, b=None):
     h  = hashlib.sha256()
-    b  = bytearray(128 * 1024)
+    if b is None:
+        b = bytearray(128 * 1024)
     mv = memoryview(b)
     while True:
         n = file.readinto(mv)
@@ -35,6 +67,14 @@ def sha256_file(file):
             h.update(mv)
     return h.digest()
 
+# Makes a rename or a new file in the directory durable
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def read_exactly(stream, rlen):
     ret = stream.read(rlen)
     if rlen != len(ret):
@@ -52,6 +92,9 @@ def encode_varint(buf, val):
             buf.append(wr)
             return
 
+def encode_signed_varint(buf, val):
+    encode_varint(buf, (val << 1) if val >= 0 else ((-val << 1) - 1))
+
 # https://github.com/fmoo/python-varint/blob/master/varint.py
 def decode_varint_stream(stream):
     shift = 0
@@ -65,7 +108,45 @@ def decode_varint_stream(stream):
 
     return result
 
+def decode_varint_buffer(buf, pos):
+    try:
+        b = buf[pos]
+        if b < 0x80:
+            return b, pos + 1
+        result = b & 0x7f
+        shift = 7
+        while True:
+            pos += 1
+            b = buf[pos]
+            result |= (b & 0x7f) << shift
+            shift += 7
+            if b < 0x80:
+                return result, pos + 1
+    except IndexError:
+        raise EOFError()
+
+def decode_signed_varint_buffer(buf, pos):
+    val, pos = decode_varint_buffer(buf, pos)
+    return (val >> 1) if not val & 1 else -((val + 1) >> 1), pos
+
+def decode_varint_prefixed_bytes_buffer(buf, pos):
+    rlen, pos = decode_varint_buffer(buf, pos)
+    if pos + rlen > len(buf):
+        raise EOFError()
+    return buf[pos:pos + rlen], pos + rlen
+
 def decode_varint_prefixed_bytes(stream):
     rlen = decode_varint_stream(stream)
     return read_exactly(stream, rlen)
 
+
+# Takes an exclusive lock on path, held until the returned file is closed. Raises BlockingIOError when another
+# process holds it.
+def lock_file(path):
+    file = open(path, 'a')
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        raise
+    return file